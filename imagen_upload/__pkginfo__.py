@@ -4,7 +4,7 @@
 modname = 'imagen_upload'
 distname = 'cubicweb-imagen-upload'
 
-numversion = (0, 1, 0)
+numversion = (0, 2, 0)
 version = '.'.join(str(num) for num in numversion)
 
 license = 'CeCILL'
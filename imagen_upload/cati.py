@@ -28,16 +28,56 @@
 # The fact that you are presently reading this means that you have had
 # knowledge of the CeCILL license and that you accept its terms.
 
+from contextlib import contextmanager
 from datetime import datetime
+import errno
+import fcntl
+import hashlib
+import json
 import os
+import sqlite3
+import sys
+import threading
+from multiprocessing.pool import ThreadPool
 
 LOGGER = None
 CATI_WORFLOW_DIRECTORY = None
 SENT_FILE = 'sent.csv'
 RESPONSE_FILE = 'response.csv'
 DONE_FILE = 'done.csv'
+# number of records of response.csv of the done entries, whose responses
+# are consumed: response.csv is only written by the CATI side
+CONSUMED_FILE = 'consumed.csv'
+# SHA-1 of the contents sent, with the entry sending them and its response
+CONTENT_FILE = 'content.csv'
+LEDGER_FILE = 'ledger.sqlite'
+LOCK_FILE = 'ledger.lock'
+# lock files of the entries being sent
+SENDING_DIRECTORY = 'sending'
+METRICS_FILE = 'metrics.json'
+CSV_BACKEND = 'csv'
+SQLITE_BACKEND = 'sqlite'
+LEDGER_BACKEND = CSV_BACKEND
+# instance of transport.Transport, None to only record files as sent
+TRANSPORT = None
+SEND_WORKERS = 1
 LINE_SEP = '\n'
 COL_SEP = ';'
+# ledger lock held by the current thread: None, False (shared) or True
+_LOCK_STATE = threading.local()
+_DB = threading.local()
+# record removing an entry from a ledger file written by this side
+TOMBSTONE = '#done'
+COMPACTION_MIN_RECORDS = 1000
+# parsed ledger files: path -> ((inode, size, mtime), dictionnary, records)
+_CACHE = {}
+# responses not consumed: directory -> (signatures, dictionnary)
+_LIVE = {}
+_RECOVERED = set()
+# metrics of the done entries by cati workflow directory
+_METRICS = {}
+_METRICS_LOCK = threading.Lock()
+UNKNOWN_CENTRE = '?'
 
 
 ##############################################################################
@@ -53,8 +93,12 @@ def is_system_OK():
     paths = [
         get_sent_file_path(),
         get_response_file_path(),
-        get_done_file_path()
+        get_done_file_path(),
+        get_content_file_path(),
+        get_consumed_file_path()
     ]
+    if LEDGER_BACKEND == SQLITE_BACKEND:
+        paths.append(get_ledger_file_path())
     message = ''
     for path in paths:
         if not os.access(path, os.F_OK):
@@ -69,6 +113,9 @@ def is_system_OK():
         LOGGER.critical(message)
         return False
     else:
+        if LEDGER_BACKEND == CSV_BACKEND:
+            with ledger_lock(exclusive=True):
+                recover()
         return True
 
 
@@ -96,6 +143,363 @@ def get_done_file_path():
     return "{0}/{1}".format(CATI_WORFLOW_DIRECTORY, DONE_FILE)
 
 
+##############################################################################
+def get_content_file_path():
+    """ Build and return the file path containing the SHA-1 of the files
+        sent to cati.
+    """
+
+    return "{0}/{1}".format(CATI_WORFLOW_DIRECTORY, CONTENT_FILE)
+
+
+##############################################################################
+def get_consumed_file_path():
+    """ Build and return the file path containing the number of records of
+        the response file consumed by the done entries.
+    """
+
+    return "{0}/{1}".format(CATI_WORFLOW_DIRECTORY, CONSUMED_FILE)
+
+
+##############################################################################
+def get_ledger_file_path():
+    """ Build and return the path of the SQLite ledger. """
+
+    return "{0}/{1}".format(CATI_WORFLOW_DIRECTORY, LEDGER_FILE)
+
+
+##############################################################################
+def get_lock_file_path():
+    """ Build and return the path of the file locked to access the ledger.
+    """
+
+    return "{0}/{1}".format(CATI_WORFLOW_DIRECTORY, LOCK_FILE)
+
+
+##############################################################################
+@contextmanager
+def ledger_lock(exclusive=False):
+    """ Lock the ledger against the other threads and processes, with a
+        fcntl advisory lock on LOCK_FILE: shared to read the ledger,
+        exclusive to write it. The lock is reentrant within a thread, an
+        exclusive lock being required first to write.
+
+    Pameters:
+        exclusive: whether the ledger is written
+    """
+
+    held = getattr(_LOCK_STATE, 'held', None)
+    if held is not None:
+        if exclusive and not held:
+            raise RuntimeError("shared ledger lock held, cannot write")
+        yield
+        return
+    # flock locks of distinct open files also exclude the threads of a
+    # process from each other
+    fd = os.open(get_lock_file_path(), os.O_RDWR | os.O_CREAT, 0o664)
+    try:
+        fcntl.flock(fd, fcntl.LOCK_EX if exclusive else fcntl.LOCK_SH)
+        _LOCK_STATE.held = exclusive
+        try:
+            yield
+        finally:
+            _LOCK_STATE.held = None
+    finally:
+        # closing the file releases the lock
+        os.close(fd)
+
+
+##############################################################################
+@contextmanager
+def claim_entry(entry):
+    """ Claim the sending of an entry against the other threads and
+        processes, with a fcntl advisory lock on a lock file of the entry
+        in SENDING_DIRECTORY.
+
+    Pameters:
+        entry: Representing the file name
+
+    Return:
+        Yield True if the entry is claimed, False if it is being sent by
+        someone else
+    """
+
+    directory = os.path.join(CATI_WORFLOW_DIRECTORY, SENDING_DIRECTORY)
+    if not os.path.isdir(directory):
+        try:
+            os.makedirs(directory)
+        except OSError as e:
+            if e.errno != errno.EEXIST:
+                raise
+    path = os.path.join(directory,
+                        hashlib.sha1(entry.encode('utf-8')).hexdigest())
+    fd = os.open(path, os.O_RDWR | os.O_CREAT, 0o664)
+    try:
+        try:
+            fcntl.flock(fd, fcntl.LOCK_EX | fcntl.LOCK_NB)
+        except IOError as e:
+            if e.errno not in (errno.EAGAIN, errno.EACCES):
+                raise
+            yield False
+            return
+        # the lock file is removed once the entry is sent: a file opened
+        # before its removal is no longer the lock file of the entry
+        try:
+            claimed = os.stat(path).st_ino == os.fstat(fd).st_ino
+        except OSError:
+            claimed = False
+        if not claimed:
+            yield False
+            return
+        try:
+            yield True
+        finally:
+            os.remove(path)
+    finally:
+        os.close(fd)
+
+
+##############################################################################
+def _file_signature(path):
+    """ Return the (inode, size, mtime) of a file, which changes whenever
+        the file is appended to or replaced.
+    """
+
+    stat = os.stat(path)
+    return (stat.st_ino, stat.st_size, stat.st_mtime)
+
+
+##############################################################################
+def _cached_read(path):
+    """ Return the dictionnary parsed from a ledger file, parsing the file
+        again only if it changed since it was last parsed.
+        The returned dictionnary is shared and must not be modified.
+
+    Pameters:
+        path: ledger file path, the response file being parsed by
+              parse_responses, a missing file being empty
+    """
+
+    try:
+        signature = _file_signature(path)
+    except OSError as e:
+        if e.errno != errno.ENOENT:
+            raise
+        # not created yet, by is_system_OK or the CATI side
+        signature = None
+    cached = _CACHE.get(path)
+    if cached is None or cached[0] != signature:
+        if signature is None:
+            values, records = {}, 0
+        elif path == get_response_file_path():
+            values, records = parse_responses(path)
+        else:
+            values, records = _parse_ledger(path)
+        cached = (signature, values, records)
+        _CACHE[path] = cached
+    return cached[1]
+
+
+##############################################################################
+def _append_record(path, key, value):
+    """ Append a record to a ledger file and update its cache, or forget
+        the cache if the file has also been changed by someone else.
+
+    Pameters:
+        path: ledger file path
+        key: first value of the record
+        value: rest of the record, TOMBSTONE to remove key
+    """
+
+    signature = _file_signature(path)
+    value = str(value)
+    line = "{0}{1}{2}{3}".format(key, COL_SEP, value, LINE_SEP)
+    with open(path, 'a') as ledgerfile:
+        ledgerfile.write(line)
+        ledgerfile.flush()
+        os.fsync(ledgerfile.fileno())
+    cached = _CACHE.get(path)
+    new_signature = _file_signature(path)
+    if (cached is not None and cached[0] == signature and
+            new_signature[:2] == (signature[0], signature[1] + len(line))):
+        values = cached[1]
+        if value == TOMBSTONE:
+            values.pop(key, None)
+        else:
+            values[key] = value
+        _CACHE[path] = (new_signature, values, cached[2] + 1)
+    else:
+        _CACHE.pop(path, None)
+
+
+##############################################################################
+def _compact(path):
+    """ Rewrite a ledger file with its live records only, through a
+        temporary file renamed over it, once most records are obsolete.
+        Only the files written by this side, under the ledger lock, are
+        compacted: never the response file.
+
+    Pameters:
+        path: ledger file path
+    """
+
+    _cached_read(path)
+    signature, values, records = _CACHE[path]
+    if records - len(values) < max(COMPACTION_MIN_RECORDS, len(values)):
+        return
+    tmp_path = "{}.tmp".format(path)
+    with open(tmp_path, 'w') as ledgerfile:
+        for key, value in values.items():
+            ledgerfile.write("{0}{1}{2}{3}".format(
+                key, COL_SEP, value, LINE_SEP)
+            )
+        ledgerfile.flush()
+        os.fsync(ledgerfile.fileno())
+    if _file_signature(path) != signature:
+        # appended in the meantime, compact next time
+        os.remove(tmp_path)
+        return
+    os.rename(tmp_path, path)
+    _CACHE[path] = (_file_signature(path), values, len(values))
+    LOGGER.info("{} compacted from {} to {} records".format(
+        path, records, len(values)))
+
+
+##############################################################################
+def _parse_ledger(path):
+    """ Parse a ledger file into a dictionnary whose keys are the first
+        values of the records and values the rest of the records.
+        A later record of a key replaces the earlier ones and a TOMBSTONE
+        record removes the key. A last record without LINE_SEP, whose
+        append has been interrupted, is ignored.
+
+    Return:
+        Return the dictionnary and the number of records of the file
+    """
+
+    values = {}
+    records = 0
+    with open(path) as ledgerfile:
+        for line in ledgerfile:
+            if not line.endswith(LINE_SEP):
+                break
+            split = line.rstrip(LINE_SEP).split(COL_SEP, 1)
+            if len(split) != 2:
+                continue
+            records += 1
+            if split[1] == TOMBSTONE:
+                values.pop(split[0], None)
+            else:
+                values[split[0]] = split[1]
+    return values, records
+
+
+##############################################################################
+def parse_responses(path):
+    """ Parse the response file written by the CATI side into a
+        dictionnary whose keys are the entries and values the number of
+        records of the entry and its last response. A response is consumed
+        by the done entry, the entry having a new response once it has more
+        records than the number recorded when it was done (see set_done).
+        A TOMBSTONE record, written by earlier versions, consumes the
+        response. A last record without LINE_SEP is ignored.
+
+    Pameters:
+        path: response file path
+
+    Return:
+        Return the dictionnary and the number of records of the file
+    """
+
+    values = {}
+    records = 0
+    with open(path) as responsefile:
+        for line in responsefile:
+            if not line.endswith(LINE_SEP):
+                break
+            split = line.rstrip(LINE_SEP).split(COL_SEP, 1)
+            if len(split) != 2:
+                continue
+            records += 1
+            count = values.get(split[0], (0, None))[0] + 1
+            if split[1] == TOMBSTONE:
+                values[split[0]] = (count, None)
+            else:
+                values[split[0]] = (count, split[1])
+    return values, records
+
+
+##############################################################################
+def _live_responses():
+    """ Return a dictionnary of the responses of the response file not
+        consumed by a done entry, see parse_responses. The ledger lock must
+        be held and the returned dictionnary must not be modified.
+    """
+
+    responses = _cached_read(get_response_file_path())
+    consumed = _cached_read(get_consumed_file_path())
+    signatures = (_CACHE[get_response_file_path()][0],
+                  _CACHE[get_consumed_file_path()][0])
+    cached = _LIVE.get(CATI_WORFLOW_DIRECTORY)
+    if cached is None or cached[0] != signatures:
+        live = dict((entry, response)
+                    for entry, (records, response) in responses.items()
+                    if response is not None and
+                    records > int(consumed.get(entry, 0)))
+        cached = (signatures, live)
+        _LIVE[CATI_WORFLOW_DIRECTORY] = cached
+    return cached[1]
+
+
+##############################################################################
+def recover():
+    """ Repair the ledger files written by this side after a crash, once
+        per process: remove an interrupted last record, so that the next
+        record is not appended to it, and complete the set_done calls
+        interrupted after writing the done entries file.
+        The response file is written by the CATI side and is never
+        modified: its interrupted last record, possibly still being
+        written, is only ignored.
+    """
+
+    if CATI_WORFLOW_DIRECTORY in _RECOVERED:
+        return
+    for path in (get_sent_file_path(), get_done_file_path(),
+                 get_content_file_path(), get_consumed_file_path()):
+        with open(path, 'rb+') as ledgerfile:
+            data = ledgerfile.read()
+            if data and not data.endswith(LINE_SEP):
+                size = data.rfind(LINE_SEP) + 1
+                LOGGER.warning("{} interrupted record removed: {!r}".format(
+                    path, data[size:]))
+                ledgerfile.truncate(size)
+    sent = _cached_read(get_sent_file_path())
+    if sent:
+        done = set()
+        with open(get_done_file_path()) as donefile:
+            for line in donefile:
+                split = line.rstrip(LINE_SEP).split(COL_SEP, 3)
+                if len(split) == 4:
+                    done.add((split[1], split[2]))
+        for entry, sent_time in list(sent.items()):
+            if (entry, sent_time) in done:
+                LOGGER.warning("{} done, removed from ledgers".format(entry))
+                _consume_response(entry)
+                _append_record(get_sent_file_path(), entry, TOMBSTONE)
+    _RECOVERED.add(CATI_WORFLOW_DIRECTORY)
+
+
+##############################################################################
+def _consume_response(entry):
+    """ Record that the current response of an entry is consumed, if it is
+        not already.
+    """
+
+    if entry in _live_responses():
+        records = _cached_read(get_response_file_path())[entry][0]
+        _append_record(get_consumed_file_path(), entry, records)
+
+
 ##############################################################################
 def read_sent_file():
     """ Read the file containing the list of sent files and return
@@ -104,14 +508,11 @@ def read_sent_file():
         - sent time as value
         The row file format is 2 values separated by the COL_SEP value
         and endding by the LINE_SEP value.
+        The file is parsed again only if it changed since the last call.
     """
 
-    sent = {}
-    lines = [line.rstrip(LINE_SEP) for line in open(get_sent_file_path())]
-    for line in lines:
-        split = line.split(COL_SEP)
-        sent[split[0]] = split[1]
-    return sent
+    with ledger_lock():
+        return dict(_cached_read(get_sent_file_path()))
 
 
 ##############################################################################
@@ -123,14 +524,14 @@ def read_response_file():
         The status values must be 'Rejected' or 'Validated'.
         The row file format is 2 or 3 values separated by the COL_SEP value
         and endding by the LINE_SEP value.
+        The file is parsed again only if it changed since the last call.
     """
-    responses = {}
 
-    lines = [line.rstrip(LINE_SEP) for line in open(get_response_file_path())]
-    for line in lines:
-        split = line.split(COL_SEP, 1)
-        responses[split[0]] = split[1]
-    return responses
+    if LEDGER_BACKEND == SQLITE_BACKEND:
+        return dict(_connect().execute(
+            "SELECT entry, response FROM response"))
+    with ledger_lock():
+        return dict(_live_responses())
 
 
 ##############################################################################
@@ -141,8 +542,11 @@ def has_sent(entry):
         entry: Representing the file name
     """
 
-    sent = read_sent_file()
-    return entry in sent.keys()
+    if LEDGER_BACKEND == SQLITE_BACKEND:
+        return _db_has_sent(entry)
+    with ledger_lock():
+        sent = _cached_read(get_sent_file_path())
+        return entry in sent
 
 
 ##############################################################################
@@ -153,11 +557,31 @@ def get_response(entry):
     Pameters:
         entry: Representing the file name
     """
-    responses = read_response_file()
-    if not entry in responses.keys():
-        return None
-    else:
-        return responses[entry].split(COL_SEP)
+    if LEDGER_BACKEND == SQLITE_BACKEND:
+        return _db_get_response(entry)
+    with ledger_lock():
+        responses = _live_responses()
+        if not entry in responses:
+            return None
+        else:
+            return responses[entry].split(COL_SEP)
+
+
+##############################################################################
+def get_responses(entries):
+    """ Return a dictionnary with, for each entry having a response, a list
+        containing status and optionnal rejected message.
+        The responses are read once for all the entries.
+
+    Pameters:
+        entries: Representing the file names
+    """
+    if LEDGER_BACKEND == SQLITE_BACKEND:
+        return _db_get_responses(entries)
+    with ledger_lock():
+        responses = _live_responses()
+        return dict((entry, responses[entry].split(COL_SEP))
+                    for entry in entries if entry in responses)
 
 
 ##############################################################################
@@ -168,65 +592,608 @@ def add_sent(entry):
     Pameters:
         entry: Representing the file name
     """
-    if not has_sent(entry):
-        with open(get_sent_file_path(), 'a') as sentfile:
-            sentfile.write("{0}{1}{2}{3}".format(
-                entry, COL_SEP, datetime.now(), LINE_SEP)
-            )
+    if LEDGER_BACKEND == SQLITE_BACKEND:
+        return _db_add_sent(entry)
+    with ledger_lock(exclusive=True):
+        if not has_sent(entry):
+            _append_record(get_sent_file_path(), entry, datetime.now())
 
 
 ##############################################################################
-def send_file_by_sftp(filepath, fields):
-    print('cati.send_file_by_sftp NOT IMPLEMENTED')
+def get_delivered(sha1s):
+    """ Return a dictionnary with, for each SHA-1 of a content already sent
+        to cati, a list containing the entry which sent it and, once this
+        entry is done, the status and optionnal rejected message.
+
+    Pameters:
+        sha1s: SHA-1 of the files to send
+    """
+
+    if LEDGER_BACKEND == SQLITE_BACKEND:
+        return _db_get_delivered(sha1s)
+    with ledger_lock():
+        content = _cached_read(get_content_file_path())
+        return dict((sha1, content[sha1].split(COL_SEP))
+                    for sha1 in sha1s if sha1 in content)
 
 
 ##############################################################################
-def send_entry(entry, filepath, fields):
-    """ Send the file reprensenting by filepath to cati repository
+def add_delivered(sha1hex, entry, response=None):
+    """ Record that the content of an entry has been sent to cati, and its
+        response once the entry is done.
 
     Pameters:
+        sha1hex: SHA-1 of the file sent
         entry: Representing the file name
+        response: status and optionnal rejected message, separated by
+                  COL_SEP
+    """
+
+    if LEDGER_BACKEND == SQLITE_BACKEND:
+        return _db_add_delivered(sha1hex, entry, response)
+    value = entry if response is None else COL_SEP.join((entry, response))
+    with ledger_lock(exclusive=True):
+        if _cached_read(get_content_file_path()).get(sha1hex) != value:
+            _append_record(get_content_file_path(), sha1hex, value)
+            _compact(get_content_file_path())
+
+
+##############################################################################
+def send_file_by_sftp(filepath, fields, entry=None):
+    """ Send a file to cati repository through TRANSPORT.
+
+    Pameters:
         filepath: the file to send (path and file name generated by cubicweb)
         fields: dictionnary of upload fields
+        entry: Representing the file name, by default the name of filepath
     """
 
-    if not has_sent(entry):
-        try:
-            send_file_by_sftp(filepath, fields)
+    if TRANSPORT is None:
+        LOGGER.warning("no transport to cati, {} not sent".format(filepath))
+        return
+    if entry is None:
+        entry = os.path.basename(filepath)
+    TRANSPORT.send(entry, filepath, fields)
+
+
+##############################################################################
+def send_entry(entry, filepath, fields, sha1hex=None):
+    """ Send the file reprensenting by filepath to cati repository, unless
+        another thread or process is sending it (see claim_entry).
+
+    Pameters:
+        entry: Representing the file name
+        filepath: the file to send (path and file name generated by cubicweb)
+        fields: dictionnary of upload fields
+        sha1hex: SHA-1 of the file, recorded in the content file once sent
+    """
+
+    if has_sent(entry):
+        return
+    try:
+        with claim_entry(entry) as claimed:
+            if not claimed:
+                LOGGER.info("{} being sent by another worker".format(entry))
+                return
+            # sent by another worker in the meantime
+            if has_sent(entry):
+                return
+            send_file_by_sftp(filepath, fields, entry)
             add_sent(entry)
+            if sha1hex is not None:
+                add_delivered(sha1hex, entry)
             LOGGER.info("{} sent to cati".format(entry))
+    except BaseException as e:
+        LOGGER.critical("{} not sent to cati cause {}".format(entry, e))
+
+
+##############################################################################
+def send_entries(entries):
+    """ Send to cati repository the files not already sent, SEND_WORKERS
+        files at a time, through TRANSPORT opened for the duration of the
+        sending.
+
+    Pameters:
+        entries: list of (entry, filepath, fields[, sha1hex]) as given to
+                 send_entry
+    """
+
+    pending = [args for args in entries if not has_sent(args[0])]
+    if not pending:
+        return
+    if TRANSPORT is not None:
+        try:
+            TRANSPORT.open()
         except BaseException as e:
-            LOGGER.critical("{} not sent to cati cause {}".format(entry, e))
+            # send_entry retries to connect for each file
+            LOGGER.error("cannot connect to cati cause {}".format(e))
+    workers = min(SEND_WORKERS, len(pending))
+    try:
+        if workers <= 1:
+            for args in pending:
+                send_entry(*args)
+            return
+        pool = ThreadPool(workers)
+        try:
+            pool.map(lambda args: send_entry(*args), pending, chunksize=1)
+        finally:
+            pool.close()
+            pool.join()
+    finally:
+        if TRANSPORT is not None:
+            TRANSPORT.close()
 
 
 ##############################################################################
-def set_done(entry):
+def set_done(entry, sha1hex=None):
     """ Add to the done entries file the entry with sent time and response.
-        Remove also entry in sent and response files
+        Remove also entry from the sent file, by appending a TOMBSTONE
+        record compacted from time to time, and record its response as
+        consumed: the response file is only written by the CATI side.
 
     Pameters:
         entry: Representing the file name
+        sha1hex: SHA-1 of the file, whose response is recorded in the
+                 content file
     """
 
-    sent = read_sent_file()
-    responses = read_response_file()
-    if entry in sent.keys() and entry in responses.keys():
-        with open(get_done_file_path(), 'a') as entryfile:
-            entryfile.write("{0}{1}{2}{3}{4}{5}{6}{7}".format(
-                datetime.now(), COL_SEP,
-                entry, COL_SEP,
-                sent[entry], COL_SEP,
-                responses[entry], LINE_SEP)
-            )
-        value = sent.pop(entry)
-        with open(get_sent_file_path(), 'w') as entryfile:
-            for value in sent.values():
-                entryfile.write("{0}{1}{2}{3}".format(
-                    entry, COL_SEP, value, LINE_SEP)
-                )
-        value = responses.pop(entry)
-        with open(get_response_file_path(), 'w') as entryfile:
-            for key, value in sent.items():
-                entryfile.write("{0}{1}{2}{3}".format(
-                    entry, COL_SEP, value, LINE_SEP)
+    if LEDGER_BACKEND == SQLITE_BACKEND:
+        return _db_set_done(entry, sha1hex)
+    with ledger_lock(exclusive=True):
+        sent = _cached_read(get_sent_file_path())
+        responses = _live_responses()
+        if entry in sent and entry in responses:
+            with open(get_done_file_path(), 'a') as entryfile:
+                entryfile.write("{0}{1}{2}{3}{4}{5}{6}{7}".format(
+                    datetime.now(), COL_SEP,
+                    entry, COL_SEP,
+                    sent[entry], COL_SEP,
+                    responses[entry], LINE_SEP)
                 )
+                entryfile.flush()
+                os.fsync(entryfile.fileno())
+            if sha1hex is not None:
+                add_delivered(sha1hex, entry, responses[entry])
+            _consume_response(entry)
+            _append_record(get_sent_file_path(), entry, TOMBSTONE)
+            _compact(get_sent_file_path())
+            _compact(get_consumed_file_path())
+
+
+##############################################################################
+def _connect():
+    """ Return the connection of the current thread to the SQLite ledger,
+        opened in WAL mode so that readers do not block the writer.
+    """
+
+    path = get_ledger_file_path()
+    cnx = getattr(_DB, 'cnx', None)
+    if cnx is not None and _DB.path == path:
+        return cnx
+    cnx = sqlite3.connect(path, timeout=60)
+    cnx.text_factory = str
+    cnx.execute("PRAGMA journal_mode=WAL")
+    cnx.execute("CREATE TABLE IF NOT EXISTS sent"
+                " (entry TEXT PRIMARY KEY, sent TEXT)")
+    cnx.execute("CREATE TABLE IF NOT EXISTS response"
+                " (entry TEXT PRIMARY KEY, response TEXT, records INTEGER)")
+    if 'records' not in [row[1] for row in cnx.execute(
+            "PRAGMA table_info(response)")]:
+        cnx.execute("ALTER TABLE response ADD COLUMN records INTEGER")
+    cnx.execute("CREATE TABLE IF NOT EXISTS consumed"
+                " (entry TEXT PRIMARY KEY, records INTEGER)")
+    cnx.execute("CREATE TABLE IF NOT EXISTS done"
+                " (done TEXT, entry TEXT, sent TEXT, response TEXT)")
+    cnx.execute("CREATE INDEX IF NOT EXISTS done_entry ON done (entry)")
+    cnx.execute("CREATE TABLE IF NOT EXISTS content"
+                " (sha1 TEXT PRIMARY KEY, entry TEXT, response TEXT)")
+    cnx.commit()
+    _DB.cnx = cnx
+    _DB.path = path
+    return cnx
+
+
+##############################################################################
+def _db_has_sent(entry):
+    """ SQLite version of has_sent. """
+
+    row = _connect().execute("SELECT 1 FROM sent WHERE entry = ?",
+                             (entry,)).fetchone()
+    return row is not None
+
+
+##############################################################################
+def _db_get_response(entry):
+    """ SQLite version of get_response. """
+
+    row = _connect().execute("SELECT response FROM response WHERE entry = ?",
+                             (entry,)).fetchone()
+    if row is None:
+        return None
+    return row[0].split(COL_SEP)
+
+
+##############################################################################
+def _db_get_responses(entries):
+    """ SQLite version of get_responses. """
+
+    cnx = _connect()
+    entries = list(entries)
+    responses = {}
+    # stay below the maximum number of SQLite host parameters
+    for start in range(0, len(entries), 500):
+        chunk = entries[start:start + 500]
+        rows = cnx.execute("SELECT entry, response FROM response"
+                           " WHERE entry IN ({})".format(
+                               ', '.join('?' * len(chunk))), chunk)
+        for entry, response in rows:
+            responses[entry] = response.split(COL_SEP)
+    return responses
+
+
+##############################################################################
+def _db_add_sent(entry):
+    """ SQLite version of add_sent. """
+
+    cnx = _connect()
+    with cnx:
+        cnx.execute("INSERT OR IGNORE INTO sent VALUES (?, ?)",
+                    (entry, str(datetime.now())))
+
+
+##############################################################################
+def _db_get_delivered(sha1s):
+    """ SQLite version of get_delivered. """
+
+    cnx = _connect()
+    sha1s = list(sha1s)
+    delivered = {}
+    for start in range(0, len(sha1s), 500):
+        chunk = sha1s[start:start + 500]
+        rows = cnx.execute("SELECT sha1, entry, response FROM content"
+                           " WHERE sha1 IN ({})".format(
+                               ', '.join('?' * len(chunk))), chunk)
+        for sha1, entry, response in rows:
+            delivered[sha1] = [entry]
+            if response is not None:
+                delivered[sha1].extend(response.split(COL_SEP))
+    return delivered
+
+
+##############################################################################
+def _db_add_delivered(sha1hex, entry, response=None):
+    """ SQLite version of add_delivered. """
+
+    cnx = _connect()
+    with cnx:
+        cnx.execute("INSERT OR REPLACE INTO content VALUES (?, ?, ?)",
+                    (sha1hex, entry, response))
+
+
+##############################################################################
+def _db_set_done(entry, sha1hex=None):
+    """ SQLite version of set_done. """
+
+    cnx = _connect()
+    with cnx:
+        row = cnx.execute("SELECT sent.sent, response.response"
+                          " FROM sent JOIN response"
+                          " ON sent.entry = response.entry"
+                          " WHERE sent.entry = ?", (entry,)).fetchone()
+        if row is None:
+            return
+        cnx.execute("INSERT INTO done VALUES (?, ?, ?, ?)",
+                    (str(datetime.now()), entry, row[0], row[1]))
+        if sha1hex is not None:
+            cnx.execute("INSERT OR REPLACE INTO content VALUES (?, ?, ?)",
+                        (sha1hex, entry, row[1]))
+        cnx.execute("INSERT OR REPLACE INTO consumed"
+                    " SELECT entry, records FROM response WHERE entry = ?",
+                    (entry,))
+        cnx.execute("DELETE FROM sent WHERE entry = ?", (entry,))
+        cnx.execute("DELETE FROM response WHERE entry = ?", (entry,))
+
+
+##############################################################################
+def _read_csv(path, maxsplit):
+    """ Return the rows of a ledger CSV file split in maxsplit + 1 values.
+    """
+
+    with open(path) as csvfile:
+        return [line.rstrip(LINE_SEP).split(COL_SEP, maxsplit)
+                for line in csvfile if line.rstrip(LINE_SEP)]
+
+
+##############################################################################
+def _write_csv(path, rows):
+    """ Replace a ledger CSV file by rows, through a temporary file renamed
+        over it so that the CATI side never reads a partial file. The file
+        is left untouched if its content is unchanged.
+    """
+
+    data = ''.join(COL_SEP.join(str(value) for value in row) + LINE_SEP
+                   for row in rows)
+    with open(path) as csvfile:
+        if csvfile.read() == data:
+            return
+    tmp_path = "{}.tmp".format(path)
+    with open(tmp_path, 'w') as csvfile:
+        csvfile.write(data)
+        csvfile.flush()
+        os.fsync(csvfile.fileno())
+    os.rename(tmp_path, path)
+
+
+##############################################################################
+def import_csv(responses_only=False):
+    """ Import the CSV files into the SQLite ledger.
+
+    Pameters:
+        responses_only: import only the responses written by the CATI side
+                        to response.csv for entries waiting for a response,
+                        otherwise also import sent.csv, done.csv,
+                        content.csv and consumed.csv (to be done once, when
+                        switching to the SQLite backend)
+    """
+
+    cnx = _connect()
+    with ledger_lock(exclusive=True), cnx:
+        if not responses_only:
+            cnx.executemany("INSERT OR IGNORE INTO sent VALUES (?, ?)",
+                            _parse_ledger(get_sent_file_path())[0].items())
+            cnx.executemany("INSERT INTO done VALUES (?, ?, ?, ?)",
+                            _read_csv(get_done_file_path(), 3))
+            cnx.executemany("INSERT OR REPLACE INTO content VALUES (?, ?, ?)",
+                            [(sha1, ) + tuple((value.split(COL_SEP, 1) +
+                                               [None])[:2])
+                             for sha1, value in _parse_ledger(
+                                 get_content_file_path())[0].items()])
+            cnx.executemany("INSERT OR REPLACE INTO consumed VALUES (?, ?)",
+                            _parse_ledger(get_consumed_file_path())[0].items())
+        # the responses not consumed yet by a done entry
+        responses = parse_responses(get_response_file_path())[0]
+        cnx.executemany("INSERT OR REPLACE INTO response"
+                        " SELECT ?, ?, ? WHERE EXISTS"
+                        " (SELECT 1 FROM sent WHERE entry = ?)"
+                        " AND ? > COALESCE((SELECT records FROM consumed"
+                        " WHERE entry = ?), 0)",
+                        [(entry, response, records, entry, records, entry)
+                         for entry, (records, response) in responses.items()
+                         if response is not None])
+
+
+##############################################################################
+def export_csv():
+    """ Export the SQLite ledger to the CSV files read by the CATI side.
+        response.csv, written by the CATI side, is never written: the
+        responses of the done entries are filtered out when imported, see
+        import_csv.
+    """
+
+    cnx = _connect()
+    with ledger_lock(exclusive=True):
+        _write_csv(get_sent_file_path(),
+                   cnx.execute("SELECT entry, sent FROM sent"))
+        _write_csv(get_consumed_file_path(),
+                   cnx.execute("SELECT entry, records FROM consumed"
+                               " WHERE records IS NOT NULL"))
+        _write_csv(get_done_file_path(),
+                   cnx.execute("SELECT done, entry, sent, response FROM done"
+                               " ORDER BY rowid"))
+        _write_csv(get_content_file_path(),
+                   [[value for value in row if value is not None]
+                    for row in cnx.execute(
+                        "SELECT sha1, entry, response FROM content")])
+
+
+##############################################################################
+def start_cycle():
+    """ Prepare the ledger before processing the cati responses. """
+
+    if LEDGER_BACKEND == SQLITE_BACKEND:
+        import_csv(responses_only=True)
+
+
+##############################################################################
+def end_cycle():
+    """ Publish the ledger after processing the cati responses. """
+
+    if LEDGER_BACKEND == SQLITE_BACKEND:
+        export_csv()
+
+
+##############################################################################
+def _parse_time(value):
+    """ Parse a time written by str(datetime.now()). """
+
+    try:
+        return datetime.strptime(value, '%Y-%m-%d %H:%M:%S.%f')
+    except ValueError:
+        return datetime.strptime(value, '%Y-%m-%d %H:%M:%S')
+
+
+##############################################################################
+def get_metrics_file_path():
+    """ Build and return the path of the file saving the metrics computed
+        from the done entries file.
+    """
+
+    return "{0}/{1}".format(CATI_WORFLOW_DIRECTORY, METRICS_FILE)
+
+
+##############################################################################
+def _load_metrics():
+    """ Return the saved metrics of the done entries, empty metrics if there
+        are none.
+    """
+
+    try:
+        with open(get_metrics_file_path()) as metricsfile:
+            return json.load(metricsfile)
+    except (IOError, ValueError):
+        return _empty_metrics()
+
+
+##############################################################################
+def _empty_metrics():
+    """ Return the metrics of an empty done entries file. """
+
+    return {'inode': None, 'position': 0, 'head': None,
+            'latencies': {}, 'days': {}, 'centres': {}}
+
+
+##############################################################################
+def update_metrics(centre_of=None):
+    """ Update the metrics of the done entries with the records appended to
+        the done entries file since the last update, and return them.
+        The metrics are kept in memory and saved in METRICS_FILE:
+        - latencies: number of entries by minutes between sending and done
+        - days: number of entries done by day
+        - centres: numbers of validated and rejected entries by centre
+
+    Pameters:
+        centre_of: function returning a dictionnary with the centres of a
+                   list of entries, UNKNOWN_CENTRE if not given
+    """
+
+    with _METRICS_LOCK:
+        return _update_metrics(centre_of)
+
+
+def _update_metrics(centre_of):
+    path = get_done_file_path()
+    state = _METRICS.get(CATI_WORFLOW_DIRECTORY) or _load_metrics()
+    with ledger_lock():
+        try:
+            stat = os.stat(path)
+        except OSError as e:
+            if e.errno != errno.ENOENT:
+                raise
+            # no entry done yet
+            return state
+        with open(path) as donefile:
+            head = donefile.readline()
+            if stat.st_ino != state['inode']:
+                # replaced, by an export of the SQLite backend for instance:
+                # go on if the already read records are unchanged
+                if head != state['head'] or stat.st_size < state['position']:
+                    state = _empty_metrics()
+            donefile.seek(state['position'])
+            data = donefile.read()
+    state['inode'] = stat.st_ino
+    state['head'] = head
+    size = data.rfind(LINE_SEP) + 1
+    rows = [line.split(COL_SEP, 3) for line in data[:size].split(LINE_SEP)]
+    rows = [row for row in rows if len(row) == 4]
+    centres = centre_of([row[1] for row in rows]) if centre_of and rows else {}
+    for done, entry, sent, response in rows:
+        try:
+            done, sent = _parse_time(done), _parse_time(sent)
+        except ValueError:
+            continue
+        latency = str(int((done - sent).total_seconds() // 60))
+        state['latencies'][latency] = state['latencies'].get(latency, 0) + 1
+        day = done.date().isoformat()
+        state['days'][day] = state['days'].get(day, 0) + 1
+        counts = state['centres'].setdefault(
+            centres.get(entry) or UNKNOWN_CENTRE, [0, 0])
+        counts[response.split(COL_SEP)[0] == 'Rejected'] += 1
+    state['position'] += size
+    _METRICS[CATI_WORFLOW_DIRECTORY] = state
+    if rows:
+        tmp_path = "{}.tmp".format(get_metrics_file_path())
+        with open(tmp_path, 'w') as metricsfile:
+            json.dump(state, metricsfile)
+        os.rename(tmp_path, get_metrics_file_path())
+    return state
+
+
+##############################################################################
+def _percentile(counts, percent):
+    """ Return the smallest value greater than or equal to percent % of the
+        values counted in a dictionnary, None if there are no values.
+    """
+
+    total = sum(counts.values())
+    seen = 0
+    for value in sorted(counts):
+        seen += counts[value]
+        if seen * 100 >= total * percent:
+            return value
+    return None
+
+
+##############################################################################
+def get_metrics(centre_of=None, now=None):
+    """ Return a dictionnary with the metrics of the cati workflow:
+        - done: number of done entries
+        - latency: minutes between sending and done for 50, 90 and 99 % of
+          the done entries (done as soon as the cati response is read)
+        - pending: number of sent entries not done
+        - waiting: number of sent entries without response
+        - oldest: age in minutes of the oldest pending entry
+        - centres: numbers of validated and rejected entries and rejection
+          rate by centre
+        - days: list of (day, number of done entries)
+
+    Pameters:
+        centre_of: function returning a dictionnary with the centres of a
+                   list of entries
+        now: time of the computation, by default the current time
+    """
+
+    state = update_metrics(centre_of)
+    now = now or datetime.now()
+    latencies = dict((int(k), v) for k, v in state['latencies'].items())
+    if LEDGER_BACKEND == SQLITE_BACKEND:
+        pending = list(_connect().execute(
+            "SELECT sent.sent, response.entry IS NOT NULL"
+            " FROM sent LEFT JOIN response USING (entry)"))
+    else:
+        with ledger_lock():
+            responses = _live_responses()
+            pending = [(sent, entry in responses) for entry, sent in
+                       _cached_read(get_sent_file_path()).items()]
+    oldest = min([_parse_time(sent) for sent, _ in pending] or [now])
+    return {
+        'done': sum(latencies.values()),
+        'latency': dict((p, _percentile(latencies, p))
+                        for p in (50, 90, 99)),
+        'pending': len(pending),
+        'waiting': len([1 for _, answered in pending if not answered]),
+        'oldest': int((now - oldest).total_seconds() // 60),
+        'centres': dict(
+            (centre, (validated, rejected,
+                      float(rejected) / (validated + rejected)))
+            for centre, (validated, rejected) in state['centres'].items()),
+        'days': sorted(state['days'].items()),
+    }
+
+
+if __name__ == '__main__':
+    # one-shot import or export of the CSV files of a workflow directory,
+    # or metrics of the workflow:
+    #     python cati.py import|export|metrics <cati_workflow_directory>
+    import logging
+    logging.basicConfig()
+    LOGGER = logging.getLogger('cati')
+    CATI_WORFLOW_DIRECTORY = sys.argv[2]
+    if sys.argv[1] == 'metrics':
+        metrics = get_metrics()
+        print("done: {done}, pending: {pending}, waiting for a response:"
+              " {waiting}, oldest pending: {oldest} min".format(**metrics))
+        print("latency: {} min (50 %), {} min (90 %), {} min (99 %)".format(
+            *[metrics['latency'][p] for p in (50, 90, 99)]))
+        for centre, counts in sorted(metrics['centres'].items()):
+            print("{}: {} validated, {} rejected ({:.1%})".format(
+                centre, *counts))
+        for day, count in metrics['days']:
+            print("{}: {} done".format(day, count))
+        sys.exit(0)
+    LEDGER_BACKEND = SQLITE_BACKEND
+    if not is_system_OK():
+        sys.exit(1)
+    if sys.argv[1] == 'import':
+        import_csv()
+    else:
+        export_csv()
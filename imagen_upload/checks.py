@@ -28,11 +28,19 @@
 # The fact that you are presently reading this means that you have had
 # knowledge of the CeCILL license and that you accept its terms.
 
+import errno
+import fcntl
 import hashlib
+import json
 import os
 import re
+import resource
 import shutil
+import tempfile
+import threading
+import time
 import traceback
+from multiprocessing.pool import ThreadPool
 
 from cubes.rql_upload.tools import get_or_create_logger
 from imagen_databank.sanity import cantab, imaging
@@ -44,20 +52,90 @@ from imagen_databank import (SEQUENCE_LOCALIZER_CALIBRATION,
                              SEQUENCE_B0_MAP, SEQUENCE_DTI,
                              SEQUENCE_RESTING_STATE,
                              SEQUENCE_NODDI)
+from imagen_databank import series_type_from_description
 from . import cati
+from . import extraction
+from . import resumable
+from . import sanity_cache
+from . import scrubber
+from . import transport
+from . import watcher
+from .entities import upload_key
+from .errors import (SID_MALFORMED, ALREADY_UPLOADED, INCONSISTENT_PREFIX,
+                     CONTENT_NOT_CHECKED, SYSTEM_ERROR, CATI_REJECTED)
+from .errors import error_record, sanity_records, dumps, to_html
 
-SID_ERROR_MESSAGE = ("<dl><dt>The subject ID is malformed.</dt>"
-                     "<dd>12 decimal digits required.</dd></dl>")
+CHUNK_SIZE = 1024 * 1024
 
-UPLOAD_ALREADY_EXISTS = ("<dl><dt>A similar upload already exists.</dt>"
-                         "<dd>Same subject ID and time point,"
-                         " and upload not rejected.</dd>"
-                         "<dd>Please contact an administrator if you want"
-                         " to force the upload.</dd></dl>")
+# name check, content check and file name pattern of the Cantab files
+CANTAB_CHECKS = {
+    'cant': (cantab.check_cant_name,
+             cantab.check_cant_content,
+             u'cant_<PSC1><TP>.cclar'),
+    'datasheet': (cantab.check_datasheet_name,
+                  cantab.check_datasheet_content,
+                  u'datasheet_<PSC1><TP>.csv'),
+    'detailed_datasheet': (cantab.check_detailed_datasheet_name,
+                           cantab.check_detailed_datasheet_content,
+                           u'detailed_datasheet_<PSC1><TP>.csv'),
+    'report': (cantab.check_report_name,
+               cantab.check_report_content,
+               u'report_<PSC1><TP>.html'),
+}
 
-SYSTEM_ERROR_RAISED = ("<dl><dt>System error</dt>"
-                       "<dd>Please send the following message"
-                       " to imagendatabase@cea.fr.</dd></dl>")
+SANITY_CHECK_WORKERS = 4
+_SANITY_CHECK_POOL = None
+_SANITY_CHECK_POOL_LOCK = threading.Lock()
+
+# ioctl request of Linux to share the extents of a file (reflink)
+FICLONE = 0x40049409
+
+# definition of the upload forms
+FORMS_FILE = os.path.join(os.path.dirname(__file__), 'data',
+                          'imagen_upload.json')
+_FORMS = None
+
+# maximum number of files checked at once by precheck_upload
+MAX_PRECHECK_FILES = 100
+
+# extraction directories of the sequences and behavioural files expected
+# in the MRI zips, see synchrone_check_rmi
+EXTRACTION_DIRECTORIES = {
+    SEQUENCE_T2: 'T2',
+    SEQUENCE_T2_FLAIR: 'FLAIR',
+    SEQUENCE_ADNI_MPRAGE: 'ADNI_MPRAGE',
+    SEQUENCE_MID: 'MID',
+    MID_CSV: 'MID',
+    SEQUENCE_FT: 'FT',
+    FT_CSV: 'FT',
+    SEQUENCE_SST: 'SST',
+    SS_CSV: 'SST',
+    SEQUENCE_B0_MAP: 'B0',
+    SEQUENCE_DTI: 'DTI',
+    SEQUENCE_RESTING_STATE: 'RS',
+    SEQUENCE_NODDI: 'NODDI',
+    RECOG_CSV: 'RECOG',
+}
+# behavioural files of the MRI zips, by the prefix of their file name
+BEHAVIORAL_FILE = re.compile(r'^(ft|mid|recog|ss)_.*\.csv$', re.I)
+BEHAVIORAL_CSV = {
+    'ft': FT_CSV,
+    'mid': MID_CSV,
+    'recog': RECOG_CSV,
+    'ss': SS_CSV,
+}
+
+# content-addressable store of the validated files, None to store them in
+# the validated directory, and kind of links to its contents
+CAS_DIRECTORY = None
+CAS_LINK = 'hardlink'
+
+# serialize the processing of the cati responses by the MRI asynchronous
+# check and by the watcher, and the cycles of the MRI asynchronous check,
+# whose files are sent without holding _CATI_LOCK
+_CATI_LOCK = threading.Lock()
+_CATI_SEND_LOCK = threading.Lock()
+CATI_WATCHER = None
 
 
 def get_message_error(errors, filename, pattern, filepath):
@@ -71,23 +149,328 @@ def get_message_error(errors, filename, pattern, filepath):
         filepath: file path used by CW for uploaded file
     """
 
-    message = u''
-    if errors:
-        message += u'<dl>'
-        message += u'<dt>File {} [{}]<dt>'.format(filename, pattern)
-        for err in errors:
-            message += u'<dd>'
-            message += err.message
-            if err.path and err.path != filename and err.path != filepath and err.path != os.path.basename(filepath):
-                message += u' [{}]'.format(err.path)
-            if err.sample:
-                sample = repr(err.sample)
-                if len(sample) > 40:
-                    sample = sample[:40] + '...'
-                message += u' [{}]'.format(sample)
-            message += u'</dd>'
-        message += u'</dl>'
-    return message.replace(os.path.basename(filepath), filename)
+    return to_html(sanity_records(errors, filename, pattern, filepath))
+
+
+def _fsync_directory(path):
+    """ Flush a directory entry to disk so that a rename is durable.
+
+    Parameters:
+        path: directory path
+    """
+
+    fd = os.open(path, os.O_RDONLY)
+    try:
+        os.fsync(fd)
+    finally:
+        os.close(fd)
+
+
+def transfer_file(from_file, to_file, sha1hex=None, chunk_size=CHUNK_SIZE):
+    """ Copy a file in fixed-size chunks while computing its SHA-1.
+        Data is written to a temporary file in the destination directory,
+        flushed to disk and atomically renamed to 'to_file', so that a
+        partial or corrupted copy is never visible under the final name.
+
+    Parameters:
+        from_file: source file path
+        to_file: destination file path
+        sha1hex: expected SHA-1 hex digest, the copy is discarded
+                 instead of renamed if it does not match
+        chunk_size: number of bytes read and written at once
+
+    Return:
+        Return a tuple (sha1, size, elapsed) with the SHA-1 hex digest of
+        the copied data, its size in bytes and the copy duration in seconds
+    """
+
+    start = time.time()
+    directory = os.path.dirname(to_file)
+    fd, tmp_file = tempfile.mkstemp(
+        dir=directory, prefix='.{}.'.format(os.path.basename(to_file)))
+    sha1 = hashlib.sha1()
+    size = 0
+    try:
+        with open(from_file, 'rb') as src:
+            with os.fdopen(fd, 'wb') as dst:
+                while True:
+                    chunk = src.read(chunk_size)
+                    if not chunk:
+                        break
+                    sha1.update(chunk)
+                    dst.write(chunk)
+                    size += len(chunk)
+                dst.flush()
+                os.fsync(dst.fileno())
+        digest = unicode(sha1.hexdigest())
+        if sha1hex is not None and digest != sha1hex:
+            os.remove(tmp_file)
+        else:
+            shutil.copystat(from_file, tmp_file)
+            os.rename(tmp_file, to_file)
+            _fsync_directory(directory)
+    except:
+        if os.path.exists(tmp_file):
+            os.remove(tmp_file)
+        raise
+    return digest, size, time.time() - start
+
+
+def _temporary_path(path, suffix):
+    """ Return a new unique path in the directory of 'path', for a file
+        created then renamed to 'path', so that concurrent creations of
+        'path' do not collide.
+
+    Parameters:
+        path: final file path
+        suffix: suffix of the temporary file name
+    """
+
+    fd, tmp_file = tempfile.mkstemp(
+        dir=os.path.dirname(path),
+        prefix='.{}.'.format(os.path.basename(path)), suffix=suffix)
+    os.close(fd)
+    # the name is reserved, the file is replaced by a link or a clone
+    os.remove(tmp_file)
+    return tmp_file
+
+
+def _makedirs(directory):
+    """ Create a directory and its parents, possibly concurrently. """
+
+    try:
+        os.makedirs(directory)
+    except OSError as e:
+        if e.errno != errno.EEXIST or not os.path.isdir(directory):
+            raise
+
+
+def _replace_by_symlink(from_file, to_file):
+    """ Atomically replace 'from_file' by a relative symlink to 'to_file'.
+
+    Parameters:
+        from_file: file to replace
+        to_file: file the symlink points to
+    """
+
+    directory = os.path.dirname(from_file)
+    target = os.path.relpath(to_file, directory)
+    tmp_link = os.path.join(
+        directory, '.{}.symlink'.format(os.path.basename(from_file)))
+    if os.path.lexists(tmp_link):
+        os.remove(tmp_link)
+    os.symlink(target, tmp_link)
+    os.rename(tmp_link, from_file)
+    return target
+
+
+def _clone_file(from_file, to_file):
+    """ Create 'to_file' with the content of 'from_file' without moving the
+        bytes through user space, using a reflink or copy_file_range.
+
+    Parameters:
+        from_file: source file path
+        to_file: destination file path, must not exist
+
+    Return:
+        Return the name of the method used, None if no method is supported
+    """
+
+    with open(from_file, 'rb') as src:
+        fd = os.open(to_file, os.O_WRONLY | os.O_CREAT | os.O_EXCL, 0o600)
+        try:
+            try:
+                fcntl.ioctl(fd, FICLONE, src.fileno())
+                method = 'reflink'
+            except (IOError, OSError):
+                copy_file_range = getattr(os, 'copy_file_range', None)
+                if copy_file_range is None:
+                    method = None
+                else:
+                    while copy_file_range(src.fileno(), fd, CHUNK_SIZE):
+                        pass
+                    method = 'copy_file_range'
+            if method is not None:
+                os.fsync(fd)
+        except:
+            os.close(fd)
+            os.remove(to_file)
+            raise
+    os.close(fd)
+    if method is None:
+        os.remove(to_file)
+    return method
+
+
+def link_file(from_file, to_file):
+    """ Make 'to_file' share the data of 'from_file' when both are on the
+        same filesystem: hard link first, then reflink or copy_file_range
+        when hard links are not supported.
+
+    Parameters:
+        from_file: source file path
+        to_file: destination file path
+
+    Return:
+        Return the name of the method used, None if the files are on
+        different devices or no zero-copy method is supported
+    """
+
+    directory = os.path.dirname(to_file)
+    if os.stat(from_file).st_dev != os.stat(directory).st_dev:
+        return None
+    tmp_file = _temporary_path(to_file, '.link')
+    try:
+        os.link(from_file, tmp_file)
+        method = 'hard link'
+    except OSError as e:
+        if e.errno not in (errno.EPERM, errno.EMLINK, errno.EXDEV,
+                           errno.EOPNOTSUPP):
+            raise
+        try:
+            method = _clone_file(from_file, tmp_file)
+        except (IOError, OSError):
+            method = None
+        if method is None:
+            return None
+        try:
+            shutil.copystat(from_file, tmp_file)
+        except:
+            os.remove(tmp_file)
+            raise
+    os.rename(tmp_file, to_file)
+    _fsync_directory(directory)
+    return method
+
+
+def get_object_path(sha1hex):
+    """ Return the path of a content in the content-addressable store.
+
+    Parameters:
+        sha1hex: SHA-1 hex digest of the content
+    """
+
+    return os.path.join(CAS_DIRECTORY, sha1hex[:2], sha1hex[2:])
+
+
+def _link_object(object_file, to_file):
+    """ Atomically make 'to_file' a link to a content of the store, a hard
+        link if CAS_LINK is 'hardlink' and the filesystem allows it, a
+        relative symlink otherwise.
+
+    Parameters:
+        object_file: file of the content-addressable store
+        to_file: file path in the validated directory
+
+    Return:
+        Return the name of the link created
+    """
+
+    directory = os.path.dirname(to_file)
+    tmp_file = _temporary_path(to_file, '.cas')
+    method = None
+    if CAS_LINK == 'hardlink':
+        try:
+            os.link(object_file, tmp_file)
+            method = 'hard link'
+        except OSError as e:
+            if e.errno not in (errno.EPERM, errno.EMLINK, errno.EXDEV,
+                               errno.EOPNOTSUPP):
+                raise
+    if method is None:
+        os.symlink(os.path.relpath(object_file, directory), tmp_file)
+        method = 'symlink'
+    os.rename(tmp_file, to_file)
+    _fsync_directory(directory)
+    return method
+
+
+def _store_file(from_file, to_file, sha1hex, logger):
+    """ Create 'to_file' with the content of an uploaded file: on the same
+        filesystem the file shares the data of the uploaded file (see
+        link_file), otherwise the file is copied with transfer_file and
+        checked against the SHA-1 computed by CubicWeb at upload time.
+
+    Parameters:
+        from_file: file path used by CW for uploaded file
+        to_file: file path to create
+        sha1hex: SHA-1 hex digest stored in the UploadFile entity
+        logger: logger used to report the copy
+
+    Return:
+        Return True if the file has been created, False otherwise
+    """
+
+    _makedirs(os.path.dirname(to_file))
+    start = time.time()
+    method = link_file(from_file, to_file)
+    if method is None:
+        sha1, size, elapsed = transfer_file(from_file, to_file, sha1hex)
+        if sha1 != sha1hex:
+            logger.critical(
+                "Incorrect copy from '{}' to '{}'".format(from_file, to_file))
+            return False
+        rate = size / elapsed if elapsed > 0 else float(size)
+        peak = resource.getrusage(resource.RUSAGE_SELF).ru_maxrss
+        logger.info(
+            ("Copy from '{}' to '{}'"
+             " ({} bytes in {:.2f}s, {:.0f} bytes/s,"
+             " peak memory {} kB)".format(
+                 from_file, to_file, size, elapsed, rate, peak)))
+    else:
+        logger.info(
+            ("Link ({}) from '{}' to '{}' ({:.2f}s)".format(
+                method, from_file, to_file, time.time() - start)))
+    return True
+
+
+def promote_file(from_file, to_file, sha1hex, logger):
+    """ Move an uploaded file into the validated directory (see
+        _store_file). The uploaded file is then replaced by a relative
+        symlink to its validated copy.
+        When CAS_DIRECTORY is set, the content is stored once in this
+        content-addressable store, under its SHA-1, and the validated file
+        is a link to it: the promotion of a content already stored only
+        creates links.
+
+    Parameters:
+        from_file: file path used by CW for uploaded file
+        to_file: file path in the validated directory
+        sha1hex: SHA-1 hex digest stored in the UploadFile entity
+        logger: logger used to report the promotion
+
+    Return:
+        Return True if the file has been promoted, False otherwise
+    """
+
+    if (os.path.islink(from_file) and
+            os.path.realpath(from_file) == os.path.realpath(to_file)):
+        logger.info("'{}' already promoted to '{}'".format(from_file, to_file))
+        return True
+    if CAS_DIRECTORY and sha1hex:
+        object_file = get_object_path(sha1hex)
+        if os.path.exists(object_file):
+            logger.info("'{}' content already stored in '{}'".format(
+                from_file, object_file))
+        elif _store_file(from_file, object_file, sha1hex, logger):
+            # the content is shared by all the files linked to it; another
+            # worker storing the same content replaces it by the same data
+            os.chmod(object_file, 0o444)
+        elif os.path.exists(object_file):
+            logger.info("'{}' content stored in '{}' by another worker".format(
+                from_file, object_file))
+        else:
+            return False
+        _makedirs(os.path.dirname(to_file))
+        method = _link_object(object_file, to_file)
+        logger.info("Link ({}) from '{}' to '{}'".format(
+            method, to_file, object_file))
+    elif not _store_file(from_file, to_file, sha1hex, logger):
+        return False
+    target = _replace_by_symlink(from_file, to_file)
+    logger.info("Delete '{}' and create symlink to '{}'".format(
+        from_file, target))
+    return True
 
 
 def is_PSC1(value):
@@ -141,6 +524,8 @@ def is_aldready_uploaded(connexion, posted, formname, uid):
             a status different than 'Rejected' and
             an uploadfield with equal SID and
             an uploadfield with equal TIME_POINT
+        These uploads share the same indexed 'upload_key' attribute,
+        maintained by hooks.
 
     Parameters:
         connexion: connexion use to query
@@ -151,24 +536,208 @@ def is_aldready_uploaded(connexion, posted, formname, uid):
     Return:
         Return True if an equivalent upload is already done, False otherwise
     """
-    rql = ("Any COUNT(X) WHERE X is CWUpload,"
-           " NOT X eid '{}',"
-           " X form_name ILIKE '{}',"
-           " NOT X status 'Rejected',"
-           " X upload_fields F1, F1 name 'sid', F1 value '{}',"
-           " X upload_fields F2, F2 name 'time_point', F2 value '{}'"
-           )
-    rql = rql.format(
-        uid,
-        formname,
-        posted['sid'],
-        posted['time_point']
-    )
-    rset = connexion.execute(rql)
-    if rset.rows[0][0] == 0:
+    key = upload_key(formname, posted['sid'], posted['time_point'])
+    if key is None:
         return False
-    else:
+    rql = ("Any X LIMIT 1 WHERE X is CWUpload,"
+           " X upload_key %(key)s, NOT X eid %(uid)s")
+    rset = connexion.execute(rql, {'key': key, 'uid': uid})
+    if rset:
         return True
+    else:
+        return False
+
+
+def get_form_fields(formname):
+    """ Return the definitions of the fields of an upload form, read from
+        FORMS_FILE.
+
+    Parameters:
+        formname: form name, case insensitive
+
+    Return:
+        Return a dictionnary of the field definitions by field name, None
+        if the form is unknown
+    """
+
+    global _FORMS
+    if _FORMS is None:
+        with open(FORMS_FILE) as json_file:
+            forms = json.load(json_file)
+        _FORMS = dict(
+            (name.lower(), dict((field['name'], field)
+                                for field in form['Fields']))
+            for name, form in forms.items())
+    return _FORMS.get((formname or u'').lower())
+
+
+def preflight_manifest(connexion, rows):
+    """ Validate a manifest of planned uploads before an acquisition
+        campaign: known form and time point, PSC1 format, Stratify/Imagen
+        consistency, rows repeated in the manifest and existing uploads
+        not rejected. Existing uploads of the whole manifest are retrieved
+        with a single query on the upload keys.
+
+    Parameters:
+        connexion: connexion use to query
+        rows: list of (sid, time_point, form) tuples
+
+    Return:
+        Return a list of (sid, time_point, form, errors) tuples in rows
+        order, errors being a list of messages, empty if the row is valid
+    """
+
+    report = []
+    keys = {}
+    seen = {}
+    for index, (sid, tid, formname) in enumerate(rows):
+        errors = []
+        fields = get_form_fields(formname)
+        time_points = (fields or {}).get('time_point', {}).get('choices')
+        if not sid or not tid or not formname:
+            errors.append(u'Subject ID, time point and form are required.')
+        elif fields is None:
+            errors.append(u'Unknown form {}.'.format(formname))
+        elif time_points and tid not in time_points:
+            errors.append(u'Unknown time point {}.'.format(tid))
+        elif not is_PSC1(sid):
+            errors.append(u'The subject ID is malformed.')
+        elif not _consistent_prefix_suffix(sid, tid):
+            errors.append(
+                u'PSC1 codes starting with {} cannot be used'
+                u' with time point {}.'.format(sid[:6], tid))
+        row = ((formname or u'').lower(), sid, tid)
+        if row in seen:
+            errors.append(u'Same upload as row {}.'.format(seen[row] + 1))
+        else:
+            seen[row] = index
+        key = upload_key(formname, sid, tid)
+        # a repeated row queries its key once
+        if key is not None and key not in keys:
+            keys[key] = u'k{}'.format(len(keys))
+        report.append((sid, tid, formname, errors, key))
+
+    existing = set()
+    if keys:
+        rql = ("Any K WHERE X is CWUpload, X upload_key K,"
+               " X upload_key IN ({})".format(
+                   u', '.join(u'%({})s'.format(k) for k in keys.values())))
+        rset = connexion.execute(
+            rql, dict((name, key) for key, name in keys.items()))
+        existing = set(row[0] for row in rset)
+
+    result = []
+    for sid, tid, formname, errors, key in report:
+        if key in existing:
+            errors.append(u'A similar upload already exists.')
+        result.append((sid, tid, formname, errors))
+    return result
+
+
+def precheck_upload(connexion, formname, sid, tid, sha1s):
+    """ Check, before the files are sent, whether an upload would be a
+        duplicate: an upload not rejected with the same subject ID, time
+        point and form, or files with the same content in uploads not
+        rejected.
+
+    Parameters:
+        connexion: connexion use to query
+        formname: name of the upload form
+        sid: subject ID
+        tid: time point
+        sha1s: SHA-1 hex digests of the files, computed by the browser
+
+    Return:
+        Return a dictionnary with the eid of the similar upload, None if
+        there is none, and for each SHA-1 already uploaded the list of
+        the (upload eid, file name, status) of its files
+    """
+
+    key = upload_key(formname, sid, tid)
+    upload = None
+    if key is not None:
+        rset = connexion.execute(
+            "Any X LIMIT 1 WHERE X is CWUpload, X upload_key %(key)s",
+            {'key': key})
+        if rset:
+            upload = rset[0][0]
+
+    files = {}
+    sha1s = [sha1 for sha1 in set(sha1s)
+             if re.match(r'^[0-9a-f]{40}$', sha1)][:MAX_PRECHECK_FILES]
+    if sha1s:
+        rql = ("Any S, X, N, T WHERE F is UploadFile, F data_sha1hex S,"
+               " F data_name N, X upload_files F, X status T,"
+               " NOT X status 'Rejected',"
+               " F data_sha1hex IN ({})".format(u', '.join(
+                   u'%(s{})s'.format(i) for i in range(len(sha1s)))))
+        rset = connexion.execute(rql, dict(
+            (u's{}'.format(i), sha1) for i, sha1 in enumerate(sha1s)))
+        for sha1, eid, name, status in rset:
+            files.setdefault(sha1, []).append((eid, name, status))
+    return {'upload': upload, 'files': files}
+
+
+def _sanity_check_pool():
+    """ Return the thread pool shared by the synchronous checks to run
+        the sanity checks of the files of an upload concurrently.
+    """
+
+    global _SANITY_CHECK_POOL
+    with _SANITY_CHECK_POOL_LOCK:
+        if _SANITY_CHECK_POOL is None:
+            _SANITY_CHECK_POOL = ThreadPool(SANITY_CHECK_WORKERS)
+    return _SANITY_CHECK_POOL
+
+
+def _configure_sanity_cache(config):
+    """ Set up the sanity check cache from the instance configuration.
+
+    Parameters:
+        config: A cubicweb configuration object
+    """
+
+    sanity_cache.LOGGER = get_or_create_logger(config)
+    sanity_cache.CACHE_FILE = config["sanity_cache_file"]
+    sanity_cache.CACHE_SIZE = config["sanity_cache_size"]
+
+
+def _configure_cas(config):
+    """ Set up the content-addressable store from the instance
+        configuration.
+
+    Parameters:
+        config: A cubicweb configuration object
+    """
+
+    global CAS_DIRECTORY, CAS_LINK
+    CAS_DIRECTORY = config["cas_directory"] or None
+    CAS_LINK = config["cas_link"]
+
+
+def _check_cantab_file(name, data_name, filepath, sha1hex, tid, sid, date):
+    """ Run the name and content sanity checks of a Cantab file.
+
+    Parameters:
+        name: name of the form file field
+        data_name: file name provide by user during upload
+        filepath: file path used by CW for uploaded file
+        sha1hex: SHA-1 hex digest of the uploaded file
+        tid: time point
+        sid: PSC1 code
+        date: acquisition date
+
+    Return:
+        Return the list of error records, empty if checks pass
+    """
+
+    check_name, check_content, pattern = CANTAB_CHECKS[name]
+    psc1, errors = check_name(data_name, tid, sid)
+    records = sanity_records(errors, data_name, pattern, data_name)
+    psc1, errors = sanity_cache.cached_check(
+        check_content, sha1hex, filepath, tid, sid, date)
+    records += sanity_records(errors, data_name, pattern, filepath)
+    return records
 
 
 def synchrone_check_cantab(connexion, posted, upload, files, fields):
@@ -187,7 +756,8 @@ def synchrone_check_cantab(connexion, posted, upload, files, fields):
         Return None if checks pass, error message otherwise
     """
 
-    message = ''
+    records = []
+    _configure_sanity_cache(connexion.vreg.config)
 
     sid = posted['sid']
     tid = posted['time_point']
@@ -195,76 +765,146 @@ def synchrone_check_cantab(connexion, posted, upload, files, fields):
 
     # checks
     if not is_PSC1(sid):
-        message += SID_ERROR_MESSAGE
+        records.append(error_record(SID_MALFORMED))
     if is_aldready_uploaded(connexion, posted, upload.form_name, upload.eid):
-        message += UPLOAD_ALREADY_EXISTS
+        records.append(error_record(ALREADY_UPLOADED))
 
-    # Dimitri's sanity check
-    errors = None
-    for ufile in files:
-        if ufile.name == 'cant':
-            psc1, errors = cantab.check_cant_name(
-                ufile.data_name, tid, sid)
-            message += get_message_error(
-                errors, ufile.data_name,
-                u'cant_&lt;PSC1&gt;&lt;TP&gt;.cclar', ufile.data_name)
-            filepath = ufile.get_file_path()
-            psc1, errors = cantab.check_cant_content(filepath, tid, sid, date)
-            message += get_message_error(
-                errors, ufile.data_name,
-                u'cant_&lt;PSC1&gt;&lt;TP&gt;.cclar', filepath)
-        elif ufile.name == 'datasheet':
-            psc1, errors = cantab.check_datasheet_name(
-                ufile.data_name, tid, sid)
-            message += get_message_error(
-                errors, ufile.data_name,
-                u'datasheet_&lt;PSC1&gt;&lt;TP&gt;.csv', ufile.data_name)
-            filepath = ufile.get_file_path()
-            psc1, errors = cantab.check_datasheet_content(
-                filepath, tid, sid, date)
-            message += get_message_error(
-                errors, ufile.data_name,
-                u'datasheet_&lt;PSC1&gt;&lt;TP&gt;.csv', filepath)
-        elif ufile.name == 'detailed_datasheet':
-            psc1, errors = cantab.check_detailed_datasheet_name(
-                ufile.data_name, tid, sid)
-            message += get_message_error(
-                errors, ufile.data_name,
-                u'detailed_datafunctionsheet_&lt;PSC1&gt;&lt;TP&gt;.csv',
-                ufile.data_name)
-            filepath = ufile.get_file_path()
-            psc1, errors = cantab.check_detailed_datasheet_content(
-                filepath, tid, sid, date)
-            message += get_message_error(
-                errors, ufile.data_name,
-                u'detailed_datasheet_&lt;PSC1&gt;&lt;TP&gt;.csv', filepath)
-        elif ufile.name == 'report':
-            psc1, errors = cantab.check_report_name(
-                ufile.data_name, tid, sid)
-            message += get_message_error(
-                errors, ufile.data_name,
-                u'report_&lt;PSC1&gt;&lt;TP&gt;.html', ufile.data_name)
-            filepath = ufile.get_file_path()
-            psc1, errors = cantab.check_report_content(
-                filepath, tid, sid, date)
-            message += get_message_error(
-                errors, ufile.data_name,
-                u'report_&lt;PSC1&gt;&lt;TP&gt;.html', filepath)
+    # Dimitri's sanity check, one task per file, merged in files order
+    pool = _sanity_check_pool()
+    results = [
+        pool.apply_async(_check_cantab_file,
+                         (ufile.name, ufile.data_name, ufile.get_file_path(),
+                          ufile.data_sha1hex, tid, sid, date))
+        for ufile in files if ufile.name in CANTAB_CHECKS
+    ]
+    for result in results:
+        records += result.get()
     # new check to distinguish Stratify from Imagen
     if not _consistent_prefix_suffix(sid, tid):
-        message += u'<dl>'
-        message += u'<dt>PSC1 code {}<dt>'.format(sid)
-        message += u'<dd>PSC1 codes starting with {}'.format(sid[:6])
-        message += u' cannot be used with time point {}</dd>'.format(tid)
-        message += u'</dl>'
-
-    # return
-    if message:
-        return message
+        records.append(error_record(INCONSISTENT_PREFIX, sid=sid, tid=tid))
+
+    # return, the message is displayed at once by the upload form
+    if records:
+        return to_html(records)
     else:
         return None
 
 
+def _reject_upload(cnx, entity, logger):
+    """ Set status 'Rejected' and the current stack trace as error message
+        to a CWUpload whose asynchronous check raised.
+
+    Parameters:
+        cnx: connexion use to query
+        entity: CWUpload entity
+        logger: logger used to report the error
+    """
+
+    error = dumps([error_record(SYSTEM_ERROR, trace=traceback.format_exc())])
+    logger.critical("A system error raised")
+    rql = ("SET X status 'Rejected', X error %(error)s"
+           " WHERE X is CWUpload, X eid %(eid)s")
+    cnx.execute(rql, {'error': error, 'eid': entity.eid})
+
+
+def process_uploads(repository, form_name, process, logger, eids=None):
+    """ Apply an asynchronous check to each 'Quarantine' CWUpload of a form.
+        If option 'async_check_workers' is greater than 1, uploads are
+        processed in parallel by a pool of threads and each upload is
+        checked and committed in its own transaction, so that a failure
+        neither rolls back nor delays the other uploads.
+        Otherwise uploads are processed sequentially by increasing eid and
+        the transaction is committed every 'async_check_batch_size' uploads
+        or 'async_check_batch_seconds' seconds. The last processed eid is
+        kept as a cursor, so that uploads left in 'Quarantine' are not
+        selected twice in a cycle and a crashed cycle resumes where its
+        last commit stopped.
+
+    Parameters:
+        repository: A cubicweb repository object
+        form_name: name of the form of the CWUpload entities to check
+        process: function called with a connexion and a CWUpload entity,
+                 it may return a function to call once the transaction
+                 is committed
+        logger: logger used to report errors
+        eids: if given, only the CWUpload entities with these eids are
+              checked
+    """
+
+    config = repository.vreg.config
+    workers = config["async_check_workers"]
+    batch_size = max(config["async_check_batch_size"], 1)
+    batch_seconds = config["async_check_batch_seconds"]
+
+    def commit(cnx, callbacks):
+        cnx.commit()
+        for callback in callbacks:
+            callback()
+        del callbacks[:]
+
+    if workers <= 1:
+        rql = ("Any X ORDERBY X LIMIT {} WHERE X is CWUpload,"
+               " X form_name ILIKE %(form)s, X status 'Quarantine',"
+               " X eid > %(cursor)s".format(batch_size))
+        cursor = 0
+        with repository.internal_cnx() as cnx:
+            callbacks = []
+            count = 0
+            start = time.time()
+            while True:
+                rset = cnx.execute(rql, {'form': form_name, 'cursor': cursor})
+                if not rset:
+                    break
+                for entity in rset.entities():
+                    cursor = entity.eid
+                    if eids is not None and entity.eid not in eids:
+                        continue
+                    try:
+                        callback = process(cnx, entity)
+                        if callback is not None:
+                            callbacks.append(callback)
+                    except:
+                        _reject_upload(cnx, entity, logger)
+                    count += 1
+                    if (count >= batch_size or
+                            time.time() - start >= batch_seconds):
+                        commit(cnx, callbacks)
+                        logger.info(
+                            "{} {} uploads committed up to eid {}".format(
+                                count, form_name, cursor))
+                        count = 0
+                        start = time.time()
+            commit(cnx, callbacks)
+        return
+
+    def process_one(eid):
+        with repository.internal_cnx() as cnx:
+            entity = cnx.entity_from_eid(eid)
+            callbacks = []
+            try:
+                callback = process(cnx, entity)
+                if callback is not None:
+                    callbacks.append(callback)
+                commit(cnx, callbacks)
+            except:
+                cnx.rollback()
+                entity = cnx.entity_from_eid(eid)
+                _reject_upload(cnx, entity, logger)
+                cnx.commit()
+
+    rql = ("Any X WHERE X is CWUpload,"
+           " X form_name ILIKE %(form)s, X status 'Quarantine'")
+    with repository.internal_cnx() as cnx:
+        selected = [row[0] for row in cnx.execute(rql, {'form': form_name})
+                    if eids is None or row[0] in eids]
+    pool = ThreadPool(min(workers, max(len(selected), 1)))
+    try:
+        pool.map(process_one, selected, chunksize=1)
+    finally:
+        pool.close()
+        pool.join()
+
+
 def asynchrone_check_cantab(repository):
     """ Copy uploaded cantab files from 'upload_dir' to 'validated_dir/...'
         and set status 'validated'
@@ -275,59 +915,32 @@ def asynchrone_check_cantab(repository):
 
     logger = get_or_create_logger(repository.vreg.config)
     validated_dir = repository.vreg.config["validated_directory"]
+    _configure_cas(repository.vreg.config)
 
-    rql = ("Any X WHERE X is CWUpload,"
-           " X form_name ILIKE 'cantab', X status 'Quarantine'")
-    with repository.internal_cnx() as cnx:
-        rset = cnx.execute(rql)
-        for entity in rset.entities():
-            try:
-                sid = entity.get_field_value('sid')
-                centre = entity.get_field_value('centre')
-                tp = entity.get_field_value('time_point')
-                for eUFile in entity.upload_files:
-                    from_file = eUFile.get_file_path()
-                    to_file = os.path.join(validated_dir,
-                                           tp, 'RAW', 'PSC1',
-                                           centre, sid, 'AdditionalData')
-                    if not os.path.exists(to_file):
-                        os.makedirs(to_file)
-                    to_file = os.path.join(to_file, eUFile.data_name)
-                    shutil.copy2(from_file, to_file)
-                    sha1 = unicode(
-                        hashlib.sha1(open(to_file, 'rb').read()).hexdigest())
-                    if sha1 == eUFile.data_sha1hex:
-                        os.remove(from_file)
-                        to_file = os.path.relpath(to_file, os.path.dirname(from_file))
-                        os.symlink(to_file, from_file)
-                        logger.info(
-                            ("Copy from '{}' to '{}'"
-                             ", delete and create symlink".format(
-                                 from_file, to_file)))
-                    else:
-                        logger.critical(
-                            "Incorrect copy from '{}' to '{}'".format(
-                                from_file, to_file))
-                rql = ("SET X status 'Validated'"
-                       " WHERE X is CWUpload, X eid '{}'".format(entity.eid))
-                cnx.execute(rql)
-            except:
-                stacktrace = traceback.format_exc()
-                stacktrace = stacktrace.replace('"', "'").replace("'", "\\'")
-                logger.critical("A system error raised")
-                rql = ("SET X status 'Rejected', X error '{} <br/> {}'"
-                       " WHERE X is CWUpload, X eid '{}'".format(
-                           SYSTEM_ERROR_RAISED,
-                           stacktrace,
-                           entity.eid))
-                cnx.execute(rql)
-        cnx.commit()
+    def validate(cnx, entity):
+        sid = entity.get_field_value('sid')
+        centre = entity.get_field_value('centre')
+        tp = entity.get_field_value('time_point')
+        for eUFile in entity.upload_files:
+            to_file = os.path.join(validated_dir,
+                                   tp, 'RAW', 'PSC1',
+                                   centre, sid, 'AdditionalData',
+                                   eUFile.data_name)
+            promote_file(eUFile.get_file_path(), to_file,
+                         eUFile.data_sha1hex, logger)
+        rql = ("SET X status 'Validated'"
+               " WHERE X is CWUpload, X eid '{}'".format(entity.eid))
+        cnx.execute(rql)
+
+    process_uploads(repository, u'cantab', validate, logger)
 
 
 def synchrone_check_rmi(connexion, posted, upload, files, fields):
     """ Call is_PSC1 and is_aldready_uploaded methods first.
         Then call methods of imagen_databank.sanity.imaging
-        than checks name file and content
+        than checks name file and content.
+        If option 'fail_fast_checks' is set, the zip content is not
+        scanned when the cheaper checks already failed.
 
     Parameters:
         connexion: connexion use to query
@@ -339,7 +952,8 @@ def synchrone_check_rmi(connexion, posted, upload, files, fields):
         Return None if checks pass, error message otherwise
     """
 
-    message = ''
+    records = []
+    _configure_sanity_cache(connexion.vreg.config)
 
     sid = posted['sid']
     tid = posted['time_point']
@@ -361,45 +975,229 @@ def synchrone_check_rmi(connexion, posted, upload, files, fields):
         RECOG_CSV: posted['recog'],
     }
 
-    # checks
+    # stage 1: cheap checks on posted fields and file name
     if not is_PSC1(sid):
-        message += SID_ERROR_MESSAGE
+        records.append(error_record(SID_MALFORMED))
     if is_aldready_uploaded(connexion, posted, upload.form_name, upload.eid):
-        message += UPLOAD_ALREADY_EXISTS
-
+        records.append(error_record(ALREADY_UPLOADED))
+    # new check to distinguish Stratify from Imagen
+    if not _consistent_prefix_suffix(sid, tid):
+        records.append(error_record(INCONSISTENT_PREFIX, sid=sid, tid=tid))
     # Dimitri's sanity check
-    psc1 = True
-    errors = None
-    filepath = files[0].get_file_path()
     psc1, errors = imaging.check_zip_name(files[0].data_name, tid, sid)
-    message += get_message_error(
-        errors, files[0].data_name,
-        u'&lt;PSC1&gt;&lt;TP&gt;.zip', files[0].data_name)
-    psc1, errors = imaging.check_zip_content(filepath, tid, sid, date, expected)
-    message += get_message_error(
+    records += sanity_records(
         errors, files[0].data_name,
-        u'&lt;PSC1&gt;&lt;TP&gt;.zip', filepath)
-    # new check to distinguish Stratify from Imagen
-    if not _consistent_prefix_suffix(sid, tid):
-        message += u'<dl>'
-        message += u'<dt>PSC1 code {}<dt>'.format(sid)
-        message += u'<dd>PSC1 codes starting with {}'.format(sid[:6])
-        message += u' cannot be used with time point {}</dd>'.format(tid)
-        message += u'</dl>'
-
-    # return
-    if message:
-        return message
+        u'<PSC1><TP>.zip', files[0].data_name)
+
+    # stage 2: scan the zip content, unless stage 1 already failed
+    if records and connexion.vreg.config["fail_fast_checks"]:
+        records.append(error_record(CONTENT_NOT_CHECKED))
+    else:
+        filepath = files[0].get_file_path()
+        psc1, errors = sanity_cache.cached_check(
+            imaging.check_zip_content, files[0].data_sha1hex,
+            filepath, tid, sid, date, expected)
+        records += sanity_records(
+            errors, files[0].data_name,
+            u'<PSC1><TP>.zip', filepath)
+
+    # return, the message is displayed at once by the upload form
+    if records:
+        return to_html(records)
     else:
         return None
 
 
+def _configure_cati(config, logger):
+    """ Configure the cati module for a cycle of the MRI asynchronous check.
+
+    Parameters:
+        config: the cubicweb configuration
+        logger: the logger of the cycle
+
+    Return:
+        True if the cati workflow directory is usable.
+    """
+
+    cati.LOGGER = logger
+    cati.CATI_WORFLOW_DIRECTORY = config["cati_workflow_directory"]
+    cati.LEDGER_BACKEND = config["cati_ledger_backend"]
+    return cati.is_system_OK()
+
+
+def _configure_cati_transport(config, logger):
+    """ Configure the sending of the files to cati.
+
+    Parameters:
+        config: the cubicweb configuration
+        logger: the logger of the cycle
+    """
+
+    transport.LOGGER = logger
+    cati.TRANSPORT = transport.get_transport(
+        config["cati_transport_url"],
+        config["cati_transport_key"] or None)
+    cati.SEND_WORKERS = config["cati_send_workers"]
+    transport.BANDWIDTH.rate = config["cati_bandwidth"] * 1024
+    night_bandwidth = config["cati_night_bandwidth"]
+    transport.BANDWIDTH.night_rate = (None if night_bandwidth < 0
+                                      else night_bandwidth * 1024)
+    transport.BANDWIDTH.night_hours = transport.parse_hours(
+        config["cati_night_hours"])
+
+
+def _link_cati_entries(files, logger):
+    """ Find the cati entry of MRI CWUpload: the entry which already sent
+        the same content to cati if any, so that it is not sent again,
+        the file name otherwise.
+
+    Parameters:
+        files: list of (eid, file name, SHA-1, file path, upload fields)
+        logger: logger used to report the linked files
+
+    Return:
+        A dictionnary of the (cati entry, SHA-1) by CWUpload eid, and the
+        list of the files to send as expected by cati.send_entries.
+    """
+
+    delivered = cati.get_delivered(set(f[2] for f in files))
+    uploads = {}
+    to_send = []
+    for eid, name, sha1hex, filepath, args in files:
+        record = delivered.get(sha1hex)
+        if record is not None:
+            # the same name is the most usual case, a zip name being
+            # <PSC1><TP>.zip: waiting for the response of the sent entry,
+            # or linked to the response of the done entry
+            if record[0] != name or len(record) > 1:
+                logger.info("{} has the content of {}, not sent".format(
+                    name, record[0]))
+            uploads[eid] = (record[0], sha1hex)
+        else:
+            # link the next files with the same content to this one
+            delivered.setdefault(sha1hex, [name])
+            uploads[eid] = (name, sha1hex)
+            to_send.append((name, filepath, args, sha1hex))
+    return uploads, to_send
+
+
+def _apply_cati_responses(repository, uploads, logger):
+    """ Define status and error message of the MRI CWUpload having a
+        response from cati, following response content.
+
+    Parameters:
+        repository: A cubicweb repository object
+        uploads: dictionnary of the (cati entry, SHA-1) by CWUpload eid
+        logger: logger used to report errors
+
+    Return:
+        Return the list of the extraction jobs of the validated zips, empty
+        if option 'mri_extraction_directory' is not set.
+    """
+
+    validated_dir = repository.vreg.config["validated_directory"]
+    extraction_dir = repository.vreg.config["mri_extraction_directory"]
+    _configure_cas(repository.vreg.config)
+    jobs = []
+    # retrieve all the ready responses from cati, and the responses of the
+    # done entries to which uploads of the same content are linked
+    responses = cati.get_responses(set(u[0] for u in uploads.values()))
+    delivered = cati.get_delivered(set(u[1] for u in uploads.values()))
+    verdicts = {}
+    for eid, (entry, sha1hex) in uploads.items():
+        # the response stored with the content first: the entry may have
+        # been sent again since, with another content
+        record = delivered.get(sha1hex)
+        if record and record[0] == entry and len(record) > 1:
+            response = record[1:]
+        else:
+            response = responses.get(entry)
+        if response:
+            verdicts[eid] = response
+
+    def validate(cnx, entity):
+        centre = entity.get_field_value('centre')
+        tp = entity.get_field_value('time_point')
+        eUFile = entity.upload_files[0]
+        response = verdicts[entity.eid]
+        if response[0] == "Rejected":
+            message = response[1] if len(response) > 1 else None
+            error = dumps([error_record(CATI_REJECTED, message=message)])
+            rql = ("SET X status 'Rejected', X error %(error)s"
+                   " WHERE X is CWUpload, X eid %(eid)s")
+            cnx.execute(rql, {'error': error, 'eid': entity.eid})
+        else:
+            to_file = os.path.join(validated_dir,
+                                   tp, 'RAW', 'PSC1',
+                                   centre, eUFile.data_name)
+            promote_file(eUFile.get_file_path(), to_file,
+                         eUFile.data_sha1hex, logger)
+            rql = ("SET X status 'Validated'"
+                   " WHERE X is CWUpload, X eid '{}'".format(entity.eid))
+            cnx.execute(rql)
+            if extraction_dir:
+                name = os.path.splitext(eUFile.data_name)[0]
+                jobs.append(extraction.Job(
+                    to_file, os.path.join(extraction_dir, tp, centre, name),
+                    cati.COL_SEP.join((tp, centre, name))))
+        # forget the entry only once the new status is committed, the
+        # entry of a linked upload is done by its own upload
+        entry, sha1hex = uploads[entity.eid]
+        if entry == eUFile.data_name:
+            return lambda: cati.set_done(entry, sha1hex)
+
+    if verdicts:
+        process_uploads(repository, u'MRI', validate, logger, set(verdicts))
+    return jobs
+
+
+def identify_sequence(series, filename):
+    """ Identify a member of a MRI zip the way the content checks do: the
+        behavioural files by their file name, the images by the description
+        of their series, the name of their directory.
+
+    Parameters:
+        series: name of the directory of the member, None at the root
+        filename: file name of the member
+
+    Return:
+        Return the extraction directory of the member, None if it is not an
+        expected sequence nor behavioural file
+    """
+
+    match = BEHAVIORAL_FILE.match(filename)
+    if match:
+        return EXTRACTION_DIRECTORIES[BEHAVIORAL_CSV[match.group(1).lower()]]
+    if series:
+        return EXTRACTION_DIRECTORIES.get(
+            series_type_from_description(series))
+    return None
+
+
+def _extract_zips(config, jobs, logger):
+    """ Extract the validated MRI zips into a per-sequence layout, with the
+        zips whose extraction is still pending, see extraction.extract_all.
+
+    Parameters:
+        config: A cubicweb configuration object
+        jobs: extraction jobs returned by _apply_cati_responses
+        logger: logger used to report the extraction
+    """
+
+    if config["mri_extraction_directory"]:
+        extraction.LOGGER = logger
+        extraction.IDENTIFY = identify_sequence
+        extraction.extract_all(config["mri_extraction_directory"], jobs,
+                               config["mri_extraction_workers"])
+
+
 def asynchrone_check_rmi(repository):
     """ For each 'Quarantine' CWUpload,
-        send the file to cati repository if not already sent.
-        Retrieve a response from cati.
-        If there is a response then define status and error message to
-        CWUpload following response content
+        send the file to cati repository if not already sent, nor the same
+        content under another name.
+        Then retrieve at once the responses from cati and,
+        for each CWUpload with a response, define status and error message
+        following response content
 
     Parameters:
         upload: A cubicweb repository object
@@ -407,73 +1205,158 @@ def asynchrone_check_rmi(repository):
 
     config = repository.vreg.config
     logger = get_or_create_logger(config)
-    validated_dir = config["validated_directory"]
 
-    cati.LOGGER = logger
-    cati.CATI_WORFLOW_DIRECTORY = config["cati_workflow_directory"]
-    if not cati.is_system_OK():
+    with _CATI_SEND_LOCK:
+        with _CATI_LOCK:
+            if not _configure_cati(config, logger):
+                return
+            # list the uploaded files, then send them to cati once the
+            # connexion is released
+            files = []
+            rql = ("Any X WHERE X is CWUpload,"
+                   " X form_name ILIKE 'MRI', X status 'Quarantine'")
+            with repository.internal_cnx() as cnx:
+                for entity in cnx.execute(rql).entities():
+                    args = {f.name: f.value for f in entity.upload_fields}
+                    eUFile = entity.upload_files[0]
+                    files.append((entity.eid, eUFile.data_name,
+                                  eUFile.data_sha1hex,
+                                  eUFile.get_file_path(), args))
+            uploads, to_send = _link_cati_entries(files, logger)
+        # the sending may last hours: do not hold back the watcher, the
+        # ledger being protected by cati.ledger_lock
+        _configure_cati_transport(config, logger)
+        cati.send_entries(to_send)
+        with _CATI_LOCK:
+            cati.start_cycle()
+            try:
+                jobs = _apply_cati_responses(repository, uploads, logger)
+            finally:
+                cati.end_cycle()
+    # do not hold back the next cycles
+    _extract_zips(config, jobs, logger)
+
+
+def process_cati_responses(repository):
+    """ Define status and error message of the 'Quarantine' MRI CWUpload
+        listed in the cati response file, or having the same content,
+        without sending files.
+
+    Parameters:
+        repository: A cubicweb repository object
+    """
+
+    config = repository.vreg.config
+    logger = get_or_create_logger(config)
+
+    def select(cnx, restriction, values):
+        """ Return the (eid, file name, SHA-1) of the 'Quarantine' MRI
+            CWUpload whose restricted attribute is in values.
+        """
+        rows = []
+        for start in range(0, len(values), 500):
+            chunk = values[start:start + 500]
+            rql = ("Any X, N, S WHERE X is CWUpload,"
+                   " X form_name ILIKE 'MRI', X status 'Quarantine',"
+                   " X upload_files F, F data_name N, F data_sha1hex S,"
+                   " {} IN ({})".format(restriction, u', '.join(
+                       u'%(v{})s'.format(i) for i in range(len(chunk)))))
+            rows.extend(cnx.execute(rql, dict(
+                (u'v{}'.format(i), value)
+                for i, value in enumerate(chunk))))
+        return rows
+
+    with _CATI_LOCK:
+        if not _configure_cati(config, logger):
+            return
+        cati.start_cycle()
+        try:
+            names = list(cati.read_response_file())
+            with repository.internal_cnx() as cnx:
+                rows = select(cnx, "F data_name", names)
+                rows = select(cnx, "F data_sha1hex",
+                              list(set(row[2] for row in rows)))
+            files = [(eid, name, sha1hex, None, None)
+                     for eid, name, sha1hex in rows]
+            uploads = _link_cati_entries(files, logger)[0]
+            jobs = []
+            if uploads:
+                logger.info("{} cati responses to process".format(
+                    len(uploads)))
+                jobs = _apply_cati_responses(repository, uploads, logger)
+        finally:
+            cati.end_cycle()
+    _extract_zips(config, jobs, logger)
+
+
+def start_cati_watcher(repository):
+    """ Process the cati responses as soon as the response file changes.
+
+    Parameters:
+        repository: A cubicweb repository object
+    """
+
+    global CATI_WATCHER
+    config = repository.vreg.config
+    if CATI_WATCHER is not None or not config["cati_workflow_directory"]:
         return
+    watcher.LOGGER = get_or_create_logger(config)
+    # only new responses trigger a call, not a rewrite of the file
+    CATI_WATCHER = watcher.FileWatcher(
+        config["cati_workflow_directory"], cati.RESPONSE_FILE,
+        lambda: process_cati_responses(repository),
+        poll_interval=config["cati_watcher_poll_interval"],
+        parse=lambda path: cati.parse_responses(path)[0])
+    CATI_WATCHER.start()
 
-    rql = ("Any X WHERE X is CWUpload,"
-           " X form_name ILIKE 'MRI', X status 'Quarantine'")
-    with repository.internal_cnx() as cnx:
-        rset = cnx.execute(rql)
-        for entity in rset.entities():
-            args = {f.name: f.value for f in entity.upload_fields}
-            sid = args['sid']
-            centre = args['centre']
-            tp = args['time_point']
-            try:
-                # send uploaded file to cati
-                cati.send_entry(
-                    entity.upload_files[0].data_name,
-                    entity.upload_files[0].get_file_path(),
-                    args
-                )
-                # retrieve response from cati
-                response = cati.get_response(entity.upload_files[0].data_name)
-                if response is None:
-                    continue
-                if response[0] == "Rejected":
-                    rql = ("SET X status 'Rejected', X error '{}'"
-                           " WHERE X is CWUpload, X eid {}".format(
-                               response[1], entity.eid))
-                else:
-                    from_file = entity.upload_files[0].get_file_path()
-                    to_file = os.path.join(validated_dir,
-                                           tp, 'RAW', 'PSC1',
-                                           centre)
-                    if not os.path.exists(to_file):
-                        os.makedirs(to_file)
-                    to_file = os.path.join(to_file, entity.upload_files[0].data_name)
-                    shutil.copy2(from_file, to_file)
-                    sha1 = unicode(
-                        hashlib.sha1(open(to_file, 'rb').read()).hexdigest())
-                    if sha1 == entity.upload_files[0].data_sha1hex:
-                        os.remove(from_file)
-                        to_file = os.path.relpath(to_file, os.path.dirname(from_file))
-                        os.symlink(to_file, from_file)
-                        logger.info(
-                            ("Copy from '{}' to '{}'"
-                             ", delete and create symlink".format(
-                                 from_file, to_file)))
-                    else:
-                        logger.critical(
-                            "Incorrect copy from '{}' to '{}'".format(
-                                from_file, to_file))
-                    rql = ("SET X status 'Validated'"
-                           " WHERE X is CWUpload, X eid '{}'".format(
-                               entity.eid))
-                cati.set_done(entity.upload_files[0].data_name)
-                cnx.execute(rql)
-            except:
-                stacktrace = traceback.format_exc()
-                stacktrace = stacktrace.replace('"', "'").replace("'", "\\'")
-                logger.critical("A system error raised")
-                rql = ("SET X status 'Rejected', X error '{} <br/> {}'"
-                       " WHERE X is CWUpload, X eid '{}'".format(
-                           SYSTEM_ERROR_RAISED,
-                           stacktrace,
-                           entity.eid))
-                cnx.execute(rql)
-        cnx.commit()
+
+def stop_cati_watcher():
+    """ Stop the thread started by start_cati_watcher. """
+
+    global CATI_WATCHER
+    if CATI_WATCHER is not None:
+        CATI_WATCHER.stop()
+        CATI_WATCHER = None
+
+
+def scrub_validated_files(repository):
+    """ Verify the next slice of the validated files against the SHA-1 of
+        their UploadFile, see scrubber.scrub.
+
+    Parameters:
+        repository: A cubicweb repository object
+    """
+
+    config = repository.vreg.config
+    scrubber.LOGGER = get_or_create_logger(config)
+    scrubber.STATE_FILE = config["scrub_state_file"]
+    scrubber.PERIOD = config["scrub_period"] * 24 * 3600
+    scrubber.RATE = config["scrub_rate"] * 1024
+
+    rql = ("Any F ORDERBY F LIMIT 100 WHERE X is CWUpload,"
+           " X status 'Validated', X upload_files F, F eid > %(cursor)s")
+
+    def get_files(cursor):
+        # the uploaded files are symlinks to the validated files
+        with repository.internal_cnx() as cnx:
+            return [(eUFile.eid, eUFile.get_file_path(), eUFile.data_sha1hex)
+                    for eUFile in cnx.execute(
+                        rql, {'cursor': cursor}).entities()]
+
+    scrubber.scrub('validated', get_files,
+                   config["scrub_slice_size"] * 1024 * 1024,
+                   config["scrub_slice_files"])
+
+
+def expire_resumable_uploads(repository):
+    """ Remove the resumable uploads left without activity for
+        'resumable_upload_expiry' hours, see resumable.expire.
+
+    Parameters:
+        repository: A cubicweb repository object
+    """
+
+    config = repository.vreg.config
+    resumable.LOGGER = get_or_create_logger(config)
+    resumable.DIRECTORY = config["resumable_upload_directory"]
+    resumable.expire(config["resumable_upload_expiry"] * 3600)
@@ -0,0 +1,256 @@
+/* Duplicate pre-check of the upload forms.
+ *
+ * Before the files of an upload form are sent, their SHA-1 are computed
+ * in the browser, and the 'upload-precheck' controller tells whether a
+ * similar upload, or the same file contents, already exist.
+ *
+ * Web Crypto can only digest a whole buffer at once, which would load
+ * multi-GB files in memory: the SHA-1 is computed here incrementally over
+ * slices of the files.
+ */
+
+(function ($) {
+    "use strict";
+
+    var SLICE_SIZE = 4 * 1024 * 1024;
+
+    /* Incremental SHA-1 (FIPS 180-4) */
+    function Sha1() {
+        this.h = [0x67452301, 0xefcdab89, 0x98badcfe, 0x10325476,
+                  0xc3d2e1f0];
+        this.block = new Uint8Array(64);
+        this.blockLength = 0;
+        this.length = 0;
+        this.w = new Int32Array(80);
+    }
+
+    Sha1.prototype.update = function (bytes) {
+        var i = 0, n = bytes.length;
+        this.length += n;
+        if (this.blockLength) {
+            while (i < n && this.blockLength < 64) {
+                this.block[this.blockLength++] = bytes[i++];
+            }
+            if (this.blockLength < 64) {
+                return;
+            }
+            this.compress(this.block, 0);
+            this.blockLength = 0;
+        }
+        for (; i + 64 <= n; i += 64) {
+            this.compress(bytes, i);
+        }
+        while (i < n) {
+            this.block[this.blockLength++] = bytes[i++];
+        }
+    };
+
+    Sha1.prototype.compress = function (bytes, offset) {
+        var w = this.w, h = this.h, a, b, c, d, e, f, k, t, i, j;
+        for (i = 0; i < 16; i++) {
+            j = offset + 4 * i;
+            w[i] = (bytes[j] << 24) | (bytes[j + 1] << 16) |
+                (bytes[j + 2] << 8) | bytes[j + 3];
+        }
+        for (i = 16; i < 80; i++) {
+            t = w[i - 3] ^ w[i - 8] ^ w[i - 14] ^ w[i - 16];
+            w[i] = (t << 1) | (t >>> 31);
+        }
+        a = h[0];
+        b = h[1];
+        c = h[2];
+        d = h[3];
+        e = h[4];
+        for (i = 0; i < 80; i++) {
+            if (i < 20) {
+                f = (b & c) | (~b & d);
+                k = 0x5a827999;
+            } else if (i < 40) {
+                f = b ^ c ^ d;
+                k = 0x6ed9eba1;
+            } else if (i < 60) {
+                f = (b & c) | (b & d) | (c & d);
+                k = 0x8f1bbcdc;
+            } else {
+                f = b ^ c ^ d;
+                k = 0xca62c1d6;
+            }
+            t = (((a << 5) | (a >>> 27)) + f + e + k + w[i]) | 0;
+            e = d;
+            d = c;
+            c = (b << 30) | (b >>> 2);
+            b = a;
+            a = t;
+        }
+        h[0] = (h[0] + a) | 0;
+        h[1] = (h[1] + b) | 0;
+        h[2] = (h[2] + c) | 0;
+        h[3] = (h[3] + d) | 0;
+        h[4] = (h[4] + e) | 0;
+    };
+
+    Sha1.prototype.hexdigest = function () {
+        var bits = this.length * 8,
+            size = (this.blockLength < 56 ? 56 : 120) - this.blockLength + 8,
+            padding = new Uint8Array(size),
+            high = Math.floor(bits / 0x100000000),
+            low = bits >>> 0,
+            hex = "",
+            i;
+        padding[0] = 0x80;
+        for (i = 0; i < 4; i++) {
+            padding[size - 8 + i] = (high >>> (24 - 8 * i)) & 0xff;
+            padding[size - 4 + i] = (low >>> (24 - 8 * i)) & 0xff;
+        }
+        this.update(padding);
+        for (i = 0; i < 5; i++) {
+            hex += ("00000000" + (this.h[i] >>> 0).toString(16)).slice(-8);
+        }
+        return hex;
+    };
+
+    /* Call done with the SHA-1 of a file, read slice by slice */
+    function hashFile(file, progress, done, fail) {
+        var sha1 = new Sha1(), offset = 0, reader = new FileReader();
+
+        function next() {
+            if (offset >= file.size) {
+                done(sha1.hexdigest());
+                return;
+            }
+            reader.readAsArrayBuffer(file.slice(offset, offset + SLICE_SIZE));
+        }
+
+        reader.onload = function () {
+            sha1.update(new Uint8Array(reader.result));
+            offset += SLICE_SIZE;
+            progress(Math.min(offset, file.size));
+            next();
+        };
+        reader.onerror = function () {
+            fail(reader.error);
+        };
+        next();
+    }
+
+    /* Value of a form field, whose name may have a suffix */
+    function fieldValue(form, name) {
+        var field = form.find("[name='" + name + "'], [name^='" + name + "-']");
+        return field.first().val() || "";
+    }
+
+    function formName(form) {
+        var match = /[?&](?:form_name|form)=([^&]*)/.exec(
+            window.location.search);
+        return fieldValue(form, "form_name") ||
+            (match ? decodeURIComponent(match[1]) : "");
+    }
+
+    function precheck(form, status, submit) {
+        var files = form.find("input[type=file]").map(function () {
+                return this.files && this.files[0];
+            }).get(),
+            total = 0,
+            read = 0,
+            hashes = [];
+
+        $.each(files, function (i, file) {
+            total += file.size;
+        });
+
+        function hashNext() {
+            var file = files[hashes.length], before = read;
+            if (!file) {
+                check();
+                return;
+            }
+            hashFile(file, function (offset) {
+                read = before + offset;
+                status.text("Checking the files: " +
+                            Math.floor(100 * read / (total || 1)) + " %");
+            }, function (hash) {
+                hashes.push(hash);
+                hashNext();
+            }, submit);
+        }
+
+        function check() {
+            $.ajax({
+                url: baseuri() + "upload-precheck",
+                data: {
+                    form: formName(form),
+                    sid: fieldValue(form, "sid"),
+                    time_point: fieldValue(form, "time_point"),
+                    sha1: hashes
+                },
+                traditional: true,
+                dataType: "json"
+            }).done(function (result) {
+                var names = [];
+                if (result.already_uploaded) {
+                    status.attr("class", "alert alert-danger").html(
+                        "Already uploaded: <a href='" + result.upload +
+                            "'>see the existing upload</a>.");
+                    return;
+                }
+                $.each(result.files, function (sha1, uploads) {
+                    $.each(uploads, function (i, upload) {
+                        names.push(upload.name + " (" + upload.status + ")");
+                    });
+                });
+                if (names.length && !window.confirm(
+                        "The content of these files has already been" +
+                        " uploaded:\n" + names.join("\n") +
+                        "\nSend the files anyway?")) {
+                    status.remove();
+                    return;
+                }
+                submit();
+            }).fail(function () {
+                // the files are checked again once sent
+                submit();
+            });
+        }
+
+        hashNext();
+    }
+
+    $(function () {
+        $("form").has("input[type=file]").each(function () {
+            var form = $(this), button = null;
+            if (!form.find("[name='sid'], [name^='sid-']").length) {
+                return;
+            }
+            form.find("[type=submit]").on("click", function () {
+                button = this;
+            });
+            form.on("submit", function (event) {
+                var status;
+                if (typeof FileReader === "undefined") {
+                    return true;
+                }
+                event.preventDefault();
+                status = $("<div class='alert alert-info'/>").prependTo(form);
+                precheck(form, status, function () {
+                    function submit() {
+                        status.text("Sending the files...");
+                        // the native submit does not send the clicked button
+                        if (button && button.name) {
+                            $("<input type='hidden'/>").attr(
+                                {name: button.name, value: button.value}
+                            ).appendTo(form);
+                        }
+                        form[0].submit();
+                    }
+                    // files sent in chunks when resumable uploads are enabled
+                    if (window.imagen && window.imagen.sendResumable) {
+                        window.imagen.sendResumable(form, formName(form),
+                                                    status, submit);
+                    } else {
+                        submit();
+                    }
+                });
+            });
+        });
+    });
+}(jQuery));
@@ -0,0 +1,266 @@
+/* Resumable sending of the files of the upload forms.
+ *
+ * When the 'resumable-upload' controller is enabled, the files of the MRI
+ * and Cantab forms are sent in chunks with the tus 1.0.0 protocol instead
+ * of a single form submission: a lost connection resumes from the offset
+ * received by the server. The URLs of the uploads of a form are kept in
+ * the local storage, so that sending the same files again after a reload
+ * of the page resumes them too.
+ *
+ * Once the last file is complete, the server creates and checks the
+ * upload: the page goes to the upload, or shows the errors of the checks.
+ */
+
+(function ($) {
+    "use strict";
+
+    var TUS_VERSION = "1.0.0",
+        CHUNK_SIZE = 8 * 1024 * 1024,
+        RETRY_DELAYS = [1000, 3000, 10000, 30000, 60000],
+        STORAGE_PREFIX = "imagen.resumable.",
+        imagen = window.imagen = window.imagen || {};
+
+    function url() {
+        return baseuri() + "resumable-upload";
+    }
+
+    function encode(value) {
+        return window.btoa(unescape(encodeURIComponent(value)));
+    }
+
+    function request(method, target, headers, data) {
+        return $.ajax({
+            url: target,
+            type: method,
+            headers: $.extend({"Tus-Resumable": TUS_VERSION}, headers),
+            data: data,
+            processData: false,
+            contentType: false,
+            dataType: "text",
+            cache: false
+        });
+    }
+
+    /* Name of a form field, without the suffix of the edited entity */
+    function baseName(name) {
+        return name.split("-")[0];
+    }
+
+    /* Form fields given in the metadata of every upload */
+    function formFields(form) {
+        var fields = {};
+        $.each(form.serializeArray(), function (i, field) {
+            var name = baseName(field.name);
+            if (name && name.charAt(0) !== "_") {
+                fields[name] = field.value;
+            }
+        });
+        return fields;
+    }
+
+    function storage() {
+        try {
+            return window.localStorage || null;
+        } catch (e) {
+            return null;
+        }
+    }
+
+    /* Key of the stored state of a form, given its fields and files */
+    function storageKey(name, fields, files) {
+        return STORAGE_PREFIX + JSON.stringify([name, fields, $.map(
+            files, function (file) {
+                return [[file.field, file.name, file.size,
+                         file.lastModified || 0]];
+            })]);
+    }
+
+    function send(form, name, status, fallback) {
+        var fields = formFields(form),
+            files = form.find("input[type=file]").map(function () {
+                var file = this.files && this.files[0];
+                if (file) {
+                    file.field = baseName(this.name);
+                }
+                return file;
+            }).get(),
+            key = storageKey(name, fields, files),
+            store = storage(),
+            state = null,
+            total = 0,
+            sent = 0,
+            index = 0,
+            retries = 0;
+
+        $.each(files, function (i, file) {
+            total += file.size;
+        });
+        if (store && store.getItem(key)) {
+            state = JSON.parse(store.getItem(key));
+        } else {
+            state = {
+                batch: new Date().getTime().toString(16) +
+                    Math.random().toString(16).slice(2),
+                urls: {}
+            };
+        }
+
+        function save() {
+            if (store) {
+                store.setItem(key, JSON.stringify(state));
+            }
+        }
+
+        function forget() {
+            if (store) {
+                store.removeItem(key);
+            }
+        }
+
+        function progress(offset) {
+            status.text("Sending the files: " +
+                        Math.floor(100 * (sent + offset) / (total || 1)) +
+                        " %");
+        }
+
+        function fail(message) {
+            status.attr("class", "alert alert-danger").html(message);
+        }
+
+        /* Retry after a failure, or give up after the last delay */
+        function retry(file, xhr) {
+            if (retries >= RETRY_DELAYS.length) {
+                fail("The files could not be sent (" +
+                     (xhr.status || "no connection") + "), please try" +
+                     " again: the files already received are kept.");
+                return;
+            }
+            status.text("Connection lost, sending again...");
+            window.setTimeout(function () {
+                resume(file);
+            }, RETRY_DELAYS[retries++]);
+        }
+
+        function finish(xhr) {
+            var location = xhr.getResponseHeader("Location");
+            forget();
+            status.attr("class", "alert alert-success").text(
+                "The files have been sent.");
+            if (location) {
+                window.location.href = location;
+            }
+        }
+
+        function nextFile() {
+            var file = files[index], metadata;
+            if (!file) {
+                return;
+            }
+            if (state.urls[file.field]) {
+                resume(file);
+                return;
+            }
+            metadata = $.extend({}, fields, {
+                filename: file.name,
+                form: name,
+                field: file.field,
+                batch: state.batch,
+                files: String(files.length)
+            });
+            request("POST", url(), {
+                "Upload-Length": file.size,
+                "Upload-Metadata": $.map(metadata, function (value, key) {
+                    return key + " " + encode(value);
+                }).join(",")
+            }).done(function (data, textStatus, xhr) {
+                retries = 0;
+                state.urls[file.field] = xhr.getResponseHeader("Location");
+                save();
+                patch(file, 0);
+            }).fail(function (xhr) {
+                if (xhr.status >= 400 && xhr.status < 500) {
+                    fail(xhr.responseText || "The files were refused.");
+                } else {
+                    retry(file, xhr);
+                }
+            });
+        }
+
+        /* Ask the server the offset from which an upload is resumed */
+        function resume(file) {
+            request("HEAD", state.urls[file.field]).done(
+                function (data, textStatus, xhr) {
+                    patch(file, parseInt(
+                        xhr.getResponseHeader("Upload-Offset"), 10));
+                }
+            ).fail(function (xhr) {
+                if (xhr.status === 404) {
+                    // expired, or removed with its rejected batch
+                    forget();
+                    fail("The upload of " + file.name + " has expired," +
+                         " please send the files again.");
+                } else {
+                    retry(file, xhr);
+                }
+            });
+        }
+
+        /* Send the chunk at offset, an empty chunk at the end of a
+         * complete upload hands its batch off again */
+        function patch(file, offset) {
+            progress(offset);
+            request("PATCH", state.urls[file.field], {
+                "Upload-Offset": offset,
+                "Content-Type": "application/offset+octet-stream"
+            }, file.slice(offset, offset + CHUNK_SIZE)).done(
+                function (data, textStatus, xhr) {
+                    var next = parseInt(
+                        xhr.getResponseHeader("Upload-Offset"), 10);
+                    retries = 0;
+                    if (next < file.size) {
+                        patch(file, next);
+                        return;
+                    }
+                    sent += file.size;
+                    index += 1;
+                    if (index < files.length) {
+                        nextFile();
+                    } else {
+                        finish(xhr);
+                    }
+                }
+            ).fail(function (xhr) {
+                if (xhr.status === 422) {
+                    forget();
+                    fail(xhr.responseText);
+                } else if (xhr.status === 404 || xhr.status === 413) {
+                    forget();
+                    fail(xhr.responseText || "The upload was refused.");
+                } else {
+                    retry(file, xhr);
+                }
+            });
+        }
+
+        // resumable uploads may be disabled
+        request("OPTIONS", url()).done(function () {
+            nextFile();
+        }).fail(function () {
+            fallback();
+        });
+    }
+
+    /* Send the files of an upload form, calling fallback to submit the form
+     * when resumable uploads are not available */
+    imagen.sendResumable = function (form, name, status, fallback) {
+        if (typeof Blob === "undefined" || !Blob.prototype.slice ||
+                typeof JSON === "undefined" ||
+                form.find("input[type=file]").filter(function () {
+                    return this.files && this.files[0];
+                }).length === 0) {
+            fallback();
+            return;
+        }
+        send(form, name, status, fallback);
+    };
+}(jQuery));
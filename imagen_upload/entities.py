@@ -32,6 +32,31 @@
 
 from cubes.rql_upload.entities import EntityCWUpload
 
+# maximum size of the CWUpload 'upload_key' attribute (see schema)
+UPLOAD_KEY_SIZE = 64
+
+
+def upload_key(form_name, sid, time_point):
+    """ Build the key identifying equivalent uploads: same form,
+        same subject ID and same time point.
+
+    Parameters:
+        form_name: form name
+        sid: PSC1 code
+        time_point: time point
+
+    Return:
+        Return the key, None if a value is missing or too long to be valid
+    """
+
+    if not form_name or not sid or not time_point:
+        return None
+    key = u'{}:{}:{}'.format(form_name.lower(), sid, time_point)
+    if len(key) > UPLOAD_KEY_SIZE:
+        # a malformed subject ID, rejected by the checks
+        return None
+    return key
+
 
 class EntityCWUpload(EntityCWUpload):
     """ Override the 'CWUpload' entity associated functions. """
@@ -47,3 +72,14 @@ class EntityCWUpload(EntityCWUpload):
             self.creation_date.strftime('%Y/%m/%d'),
             self.creation_date.strftime('%H:%M:%S')
         )
+
+    def compute_upload_key(self):
+        """ Return the duplicate upload key of this upload,
+            None if the upload is rejected.
+        """
+
+        if self.status == 'Rejected':
+            return None
+        return upload_key(self.form_name,
+                          self.get_field_value('sid'),
+                          self.get_field_value('time_point'))
@@ -0,0 +1,208 @@
+# -*- coding: utf-8 -*-
+
+# Copyright (c) 2019 CEA
+#
+# This software is governed by the CeCILL license under French law and
+# abiding by the rules of distribution of free software. You can use,
+# modify and/ or redistribute the software under the terms of the CeCILL
+# license as circulated by CEA, CNRS and INRIA at the following URL
+# "http://www.cecill.info".
+#
+# As a counterpart to the access to the source code and rights to copy,
+# modify and redistribute granted by the license, users are provided only
+# with a limited warranty and the software's author, the holder of the
+# economic rights, and the successive licensors have only limited
+# liability.
+#
+# In this respect, the user's attention is drawn to the risks associated
+# with loading, using, modifying and/or developing or reproducing the
+# software by the user in light of its specific status of free software,
+# that may mean that it is complicated to manipulate, and that also
+# therefore means that it is reserved for developers and experienced
+# professionals having in-depth computer knowledge. Users are therefore
+# encouraged to load and test the software's suitability as regards their
+# requirements in conditions enabling the security of their systems and/or
+# data to be ensured and, more generally, to use and operate it in the
+# same conditions as regards security.
+#
+# The fact that you are presently reading this means that you have had
+# knowledge of the CeCILL license and that you accept its terms.
+
+
+""" Structured errors of the uploads.
+
+The errors of an upload are stored in CWUpload.error as a compact JSON list
+of records, each one a dictionary with an error 'code' and its details
+(file, pattern, path, sample...). They are rendered to HTML only when
+displayed. Errors stored as HTML by earlier versions are displayed verbatim.
+"""
+
+import json
+import os
+import string
+
+from logilab.mtconverter import xml_escape
+
+SID_MALFORMED = u'sid'
+ALREADY_UPLOADED = u'duplicate'
+INCONSISTENT_PREFIX = u'prefix'
+SANITY_ERROR = u'sanity'
+CONTENT_NOT_CHECKED = u'unchecked'
+SYSTEM_ERROR = u'system'
+CATI_REJECTED = u'cati'
+
+SAMPLE_LENGTH = 40
+
+
+class _Details(dict):
+    """ Error details, missing ones being rendered empty. """
+
+    def __missing__(self, key):
+        return u''
+
+
+TEMPLATES = {
+    SID_MALFORMED: (u"<dl><dt>The subject ID is malformed.</dt>"
+                    u"<dd>12 decimal digits required.</dd></dl>"),
+    ALREADY_UPLOADED: (u"<dl><dt>A similar upload already exists.</dt>"
+                       u"<dd>Same subject ID and time point,"
+                       u" and upload not rejected.</dd>"
+                       u"<dd>To upload it again, please ask an"
+                       u" administrator to reject the existing"
+                       u" upload first.</dd></dl>"),
+    INCONSISTENT_PREFIX: (u"<dl><dt>PSC1 code {sid}</dt>"
+                          u"<dd>PSC1 codes starting with {prefix}"
+                          u" cannot be used with time point {tid}</dd></dl>"),
+    CONTENT_NOT_CHECKED: (u"<dl><dt>The file content has not been"
+                          u" checked.</dt><dd>Please fix the errors above"
+                          u" and upload again.</dd></dl>"),
+    SYSTEM_ERROR: (u"<dl><dt>System error</dt>"
+                   u"<dd>Please send the following message"
+                   u" to imagendatabase@cea.fr.</dd></dl>"
+                   u"<pre>{trace}</pre>"),
+    CATI_REJECTED: (u"<dl><dt>Rejected after CATI quality control</dt>"
+                    u"<dd>{message}</dd></dl>"),
+}
+
+
+##############################################################################
+def error_record(code, **details):
+    """ Build an error record, leaving out empty details.
+
+    Parameters:
+        code: error code, one of the module constants
+        details: error details used to render the error
+    """
+
+    record = {u'code': code}
+    for key, value in details.items():
+        if value:
+            record[key] = value
+    return record
+
+
+##############################################################################
+def sanity_records(errors, filename, pattern, filepath):
+    """ Build the error records of a sanity check of an uploaded file.
+
+    Parameters:
+        errors: error list returned by an imagen_databank sanity check
+        filename: file name provide by user during upload
+        pattern: pattern expected for file name
+        filepath: file path used by CW for uploaded file
+    """
+
+    records = []
+    basename = os.path.basename(filepath)
+    for err in errors or []:
+        path = err.path
+        if path in (filename, filepath, basename):
+            path = None
+        sample = None
+        if err.sample:
+            sample = repr(err.sample)
+            if len(sample) > SAMPLE_LENGTH:
+                sample = sample[:SAMPLE_LENGTH] + '...'
+        records.append(error_record(
+            SANITY_ERROR,
+            file=filename, pattern=pattern,
+            message=err.message.replace(basename, filename),
+            path=path and path.replace(basename, filename),
+            sample=sample))
+    return records
+
+
+##############################################################################
+def dumps(records):
+    """ Return the compact JSON representation of error records,
+        None if there is no error.
+    """
+
+    if not records:
+        return None
+    return unicode(json.dumps(records, separators=(',', ':')))
+
+
+##############################################################################
+def loads(error):
+    """ Return the error records stored in a CWUpload error attribute,
+        None if the error is not structured.
+    """
+
+    if not error or not error.startswith(u'[{'):
+        return None
+    try:
+        return json.loads(error)
+    except ValueError:
+        return None
+
+
+##############################################################################
+def to_html(records):
+    """ Render error records to HTML, consecutive sanity errors of a file
+        being grouped in one definition list.
+    """
+
+    html = u''
+    group = None
+    for record in records:
+        code = record[u'code']
+        if code != SANITY_ERROR:
+            if group is not None:
+                html += u'</dl>'
+                group = None
+            details = _Details((key, xml_escape(unicode(value)))
+                               for key, value in record.items())
+            details[u'prefix'] = details[u'sid'][:6]
+            template = TEMPLATES.get(code, u'<dl><dt>{code}</dt></dl>')
+            html += string.Formatter().vformat(template, (), details)
+            continue
+        key = (record.get(u'file'), record.get(u'pattern'))
+        if key != group:
+            if group is not None:
+                html += u'</dl>'
+            html += u'<dl><dt>File {} [{}]</dt>'.format(
+                xml_escape(key[0] or u''), xml_escape(key[1] or u''))
+            group = key
+        html += u'<dd>' + xml_escape(record.get(u'message', u''))
+        for detail in (u'path', u'sample'):
+            if detail in record:
+                html += u' [{}]'.format(xml_escape(record[detail]))
+        html += u'</dd>'
+    if group is not None:
+        html += u'</dl>'
+    return html
+
+
+##############################################################################
+def render(error):
+    """ Render the error attribute of a CWUpload to HTML.
+
+    Parameters:
+        error: structured or legacy HTML error
+    """
+
+    records = loads(error)
+    if records is None:
+        return error or u''
+    return to_html(records)
@@ -0,0 +1,314 @@
+# -*- coding: utf-8 -*-
+
+# Copyright (c) 2019 CEA
+#
+# This software is governed by the CeCILL license under French law and
+# abiding by the rules of distribution of free software. You can use,
+# modify and/ or redistribute the software under the terms of the CeCILL
+# license as circulated by CEA, CNRS and INRIA at the following URL
+# "http://www.cecill.info".
+#
+# As a counterpart to the access to the source code and rights to copy,
+# modify and redistribute granted by the license, users are provided only
+# with a limited warranty and the software's author, the holder of the
+# economic rights, and the successive licensors have only limited
+# liability.
+#
+# In this respect, the user's attention is drawn to the risks associated
+# with loading, using, modifying and/or developing or reproducing the
+# software by the user in light of its specific status of free software,
+# that may mean that it is complicated to manipulate, and that also
+# therefore means that it is reserved for developers and experienced
+# professionals having in-depth computer knowledge. Users are therefore
+# encouraged to load and test the software's suitability as regards their
+# requirements in conditions enabling the security of their systems and/or
+# data to be ensured and, more generally, to use and operate it in the
+# same conditions as regards security.
+#
+# The fact that you are presently reading this means that you have had
+# knowledge of the CeCILL license and that you accept its terms.
+
+
+
+""" Extraction of the validated MRI zips into a per-sequence layout.
+
+The members of a zip are classified by the name of their series directory
+and streamed to <destination>/<sequence>/<member path>. A manifest.json
+file lists the extracted members of each zip, and INDEX_FILE at the root of
+the extraction directory has one line per extracted zip.
+
+The zips to extract are first recorded in PENDING_FILE, and removed from it
+once extracted: an interrupted or failed extraction is resumed by the next
+call of extract_all.
+"""
+
+from collections import namedtuple
+from contextlib import contextmanager
+import errno
+import fcntl
+import json
+import os
+import shutil
+import time
+import zipfile
+import zlib
+from multiprocessing.pool import ThreadPool
+
+LOGGER = None
+CHUNK_SIZE = 1024 * 1024
+MANIFEST_FILE = 'manifest.json'
+INDEX_FILE = 'index.csv'
+PENDING_FILE = 'pending.json'
+# locked to update PENDING_FILE and INDEX_FILE, and to extract the zips
+LOCK_FILE = '.lock'
+EXTRACTION_LOCK_FILE = '.extracting'
+OTHER = 'Other'
+COL_SEP = ';'
+LINE_SEP = '\n'
+
+# function called with the series directory name and the file name of a
+# member, returning its sequence directory, None for OTHER: set by checks
+# from the sequence identification of imagen_databank, see
+# checks.identify_sequence
+IDENTIFY = None
+
+Job = namedtuple('Job', ['zip_path', 'destination', 'key'])
+
+
+##############################################################################
+def classify(member):
+    """ Return the sequence directory of a zip member and its path relative
+        to this directory: the whole member path, so that members of
+        distinct directories never collide.
+        The member is classified by IDENTIFY, from the names of its series
+        directory and of its file.
+
+    Parameters:
+        member: path of the member in the zip
+    """
+
+    parts = [part for part in member.split('/')
+             if part not in ('', '.', '..')]
+    series = parts[-2] if len(parts) > 1 else None
+    sequence = IDENTIFY(series, parts[-1]) if IDENTIFY and parts else None
+    return sequence or OTHER, '/'.join(parts)
+
+
+##############################################################################
+def _safe_path(destination, relative):
+    """ Return the path of a member in the destination directory, None if
+        it would be outside the destination directory.
+    """
+
+    path = os.path.normpath(os.path.join(destination, relative))
+    if not path.startswith(os.path.normpath(destination) + os.sep):
+        return None
+    return path
+
+
+##############################################################################
+def _is_extracted(path, info):
+    """ Return True if a member has already been extracted to path: same
+        size and same CRC.
+    """
+
+    if not os.path.isfile(path) or os.path.getsize(path) != info.file_size:
+        return False
+    crc = 0
+    with open(path, 'rb') as data:
+        for chunk in iter(lambda: data.read(CHUNK_SIZE), b''):
+            crc = zlib.crc32(chunk, crc)
+    return crc & 0xffffffff == info.CRC
+
+
+##############################################################################
+def extract_zip(zip_path, destination):
+    """ Stream the members of a zip into a per-sequence layout and write its
+        manifest. Members already extracted with the same size and CRC are
+        kept, so that an interrupted extraction resumes.
+
+    Parameters:
+        zip_path: path of the validated zip
+        destination: directory of the extracted zip
+
+    Return:
+        Return the manifest: a list of dictionnaries with the member name,
+        its sequence, its extracted path relative to destination, its size
+        and CRC.
+    """
+
+    manifest = []
+    with zipfile.ZipFile(zip_path) as archive:
+        for info in archive.infolist():
+            if info.filename.endswith('/'):
+                continue
+            sequence, relative = classify(info.filename)
+            path = _safe_path(destination, os.path.join(sequence, relative))
+            if path is None:
+                LOGGER.warning("{}: {} skipped".format(
+                    zip_path, info.filename))
+                continue
+            if not _is_extracted(path, info):
+                directory = os.path.dirname(path)
+                if not os.path.isdir(directory):
+                    os.makedirs(directory)
+                tmp_path = path + '.part'
+                with archive.open(info) as src:
+                    with open(tmp_path, 'wb') as dst:
+                        shutil.copyfileobj(src, dst, CHUNK_SIZE)
+                os.rename(tmp_path, path)
+            manifest.append({
+                'member': info.filename,
+                'sequence': sequence,
+                'path': os.path.relpath(path, destination),
+                'size': info.file_size,
+                'crc': info.CRC,
+            })
+    tmp_path = os.path.join(destination, MANIFEST_FILE + '.part')
+    with open(tmp_path, 'w') as manifest_file:
+        json.dump(manifest, manifest_file, indent=1, sort_keys=True)
+    os.rename(tmp_path, os.path.join(destination, MANIFEST_FILE))
+    return manifest
+
+
+##############################################################################
+@contextmanager
+def _lock(root, name, blocking=True):
+    """ Lock a lock file of the extraction directory against the other
+        threads and processes.
+
+    Return:
+        Yield True if the lock is held, False if it is not and blocking is
+        False
+    """
+
+    fd = os.open(os.path.join(root, name), os.O_RDWR | os.O_CREAT, 0o664)
+    try:
+        try:
+            fcntl.flock(fd, fcntl.LOCK_EX | (0 if blocking else fcntl.LOCK_NB))
+        except IOError as e:
+            if e.errno not in (errno.EAGAIN, errno.EACCES):
+                raise
+            yield False
+            return
+        yield True
+    finally:
+        os.close(fd)
+
+
+def _replace(path, data):
+    """ Replace the content of a file through a temporary file. """
+
+    tmp_path = path + '.part'
+    with open(tmp_path, 'w') as tmp_file:
+        tmp_file.write(data)
+    os.rename(tmp_path, path)
+
+
+##############################################################################
+def _read_pending(root):
+    """ Return the list of the pending jobs. """
+
+    try:
+        with open(os.path.join(root, PENDING_FILE)) as pending_file:
+            return [Job(*job) for job in json.load(pending_file)]
+    except IOError as e:
+        if e.errno != errno.ENOENT:
+            raise
+        return []
+
+
+def _update_pending(root, added=(), removed=()):
+    """ Add jobs to and remove jobs from the pending jobs. """
+
+    with _lock(root, LOCK_FILE):
+        pending = [job for job in _read_pending(root) if job not in removed]
+        pending += [job for job in added if job not in pending]
+        _replace(os.path.join(root, PENDING_FILE), json.dumps(pending))
+
+
+##############################################################################
+def _index(root, job, manifest):
+    """ Write the summary of an extracted zip to the index file, replacing
+        the line of an earlier extraction of the zip.
+    """
+
+    counts = {}
+    for member in manifest:
+        counts[member['sequence']] = counts.get(member['sequence'], 0) + 1
+    line = COL_SEP.join([
+        job.key, os.path.relpath(job.destination, root),
+        ','.join('{}:{}'.format(s, n) for s, n in sorted(counts.items())),
+    ]) + LINE_SEP
+    path = os.path.join(root, INDEX_FILE)
+    prefix = job.key + COL_SEP
+    with _lock(root, LOCK_FILE):
+        lines = []
+        if os.path.exists(path):
+            with open(path) as index_file:
+                lines = [old for old in index_file
+                         if not old.startswith(prefix)]
+        _replace(path, ''.join(lines) + line)
+
+
+##############################################################################
+def extract_all(root, jobs, workers=1):
+    """ Extract zips in parallel, see extract_zip. The jobs are added to
+        the pending jobs, then all the pending jobs are extracted, unless
+        another thread or process is extracting them.
+
+    Parameters:
+        root: the extraction directory, where the index is written
+        jobs: list of Job with the zip path, the destination directory and
+              the key of the zip in the index
+        workers: number of zips extracted at the same time
+
+    Return:
+        Return the list of the jobs which failed, left pending.
+    """
+
+    try:
+        os.makedirs(root)
+    except OSError as e:
+        if e.errno != errno.EEXIST:
+            raise
+    if jobs:
+        _update_pending(root, added=jobs)
+    with _lock(root, EXTRACTION_LOCK_FILE, blocking=False) as locked:
+        if not locked:
+            # extracted by the current extraction, or the next one
+            return []
+        return _extract_pending(root, workers)
+
+
+def _extract_pending(root, workers):
+    jobs = _read_pending(root)
+
+    def extract(job):
+        start = time.time()
+        try:
+            manifest = extract_zip(job.zip_path, job.destination)
+            _index(root, job, manifest)
+        except Exception:
+            LOGGER.exception("{} not extracted".format(job.zip_path))
+            return job
+        LOGGER.info("{} extracted to {}: {} files in {:.1f}s".format(
+            job.zip_path, job.destination, len(manifest),
+            time.time() - start))
+        return None
+
+    if not jobs:
+        return []
+    workers = min(workers, len(jobs))
+    if workers <= 1:
+        results = [extract(job) for job in jobs]
+    else:
+        pool = ThreadPool(workers)
+        try:
+            results = pool.map(extract, jobs, chunksize=1)
+        finally:
+            pool.close()
+            pool.join()
+    failed = [job for job in results if job is not None]
+    _update_pending(root, removed=[job for job in jobs if job not in failed])
+    return failed
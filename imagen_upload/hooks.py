@@ -30,7 +30,11 @@
 
 """cubicweb-imagen-upload specific hooks and operations"""
 
+from cubicweb.predicates import is_instance
+from cubicweb.server.hook import DataOperationMixIn
 from cubicweb.server.hook import Hook
+from cubicweb.server.hook import Operation
+from cubicweb.server.hook import match_rtype
 
 
 class ServerStartupHook(Hook):
@@ -53,3 +57,111 @@ class ServerStartupHook(Hook):
                 self.repo._extid_cache[
                     'cn={0},ou=Groups,dc=imagen2,dc=cea,dc=fr'.format(
                         egroup.name)] = egroup.eid
+
+
+class UploadKeyOperation(DataOperationMixIn, Operation):
+    """
+        Update the duplicate upload key of the CWUpload entities whose
+        status, subject ID or time point changed in the transaction
+    """
+
+    def precommit_event(self):
+        for eid in self.get_data():
+            if self.cnx.deleted_in_transaction(eid):
+                continue
+            entity = self.cnx.entity_from_eid(eid)
+            entity.cw_clear_all_caches()
+            key = entity.compute_upload_key()
+            if entity.upload_key != key:
+                entity.cw_set(upload_key=key)
+
+
+class UploadStatusHook(Hook):
+    """
+        Maintain the upload key when a CWUpload is created or its
+        status changes
+    """
+    __regid__ = 'imagen.upload_status_hook'
+    __select__ = Hook.__select__ & is_instance('CWUpload')
+    events = ('after_add_entity', 'after_update_entity')
+
+    def __call__(self):
+        if (self.event == 'after_add_entity' or
+                'status' in self.entity.cw_edited):
+            UploadKeyOperation.get_instance(self._cw).add_data(
+                self.entity.eid)
+
+
+class UploadFieldsHook(Hook):
+    """
+        Maintain the upload key when fields are attached to a CWUpload
+    """
+    __regid__ = 'imagen.upload_fields_hook'
+    __select__ = Hook.__select__ & match_rtype('upload_fields')
+    events = ('after_add_relation',)
+
+    def __call__(self):
+        UploadKeyOperation.get_instance(self._cw).add_data(self.eidfrom)
+
+
+class UploadFieldValueHook(Hook):
+    """
+        Maintain the upload key when the value of a field changes
+    """
+    __regid__ = 'imagen.upload_field_value_hook'
+    __select__ = Hook.__select__ & is_instance('UploadField')
+    events = ('after_update_entity',)
+
+    def __call__(self):
+        if 'value' not in self.entity.cw_edited:
+            return
+        for upload in self.entity.reverse_upload_fields:
+            UploadKeyOperation.get_instance(self._cw).add_data(upload.eid)
+
+
+class CatiResponseWatcherHook(Hook):
+    """
+        Start watching the cati response file, so that the verdicts are
+        applied as soon as they are written
+    """
+    __regid__ = 'imagen.cati_response_watcher_hook'
+    events = ('server_startup', 'server_shutdown')
+
+    def __call__(self):
+        from cubes.imagen_upload.checks import (start_cati_watcher,
+                                                stop_cati_watcher)
+        if self.event == 'server_shutdown':
+            stop_cati_watcher()
+        elif self.repo.vreg.config["cati_response_watcher"]:
+            start_cati_watcher(self.repo)
+
+
+class ScrubberStartupHook(Hook):
+    """
+        Verify periodically a slice of the validated files against their
+        SHA-1
+    """
+    __regid__ = 'imagen.scrubber_startup_hook'
+    events = ('server_startup',)
+
+    def __call__(self):
+        config = self.repo.vreg.config
+        if config["scrub_state_file"] and config["scrub_interval"] > 0:
+            from cubes.imagen_upload.checks import scrub_validated_files
+            self.repo.looping_task(config["scrub_interval"],
+                                   scrub_validated_files, self.repo)
+
+
+class ResumableExpiryStartupHook(Hook):
+    """
+        Remove periodically the resumable uploads left without activity
+    """
+    __regid__ = 'imagen.resumable_expiry_startup_hook'
+    events = ('server_startup',)
+
+    def __call__(self):
+        config = self.repo.vreg.config
+        if (config["resumable_upload_directory"] and
+                config["resumable_upload_expiry"] > 0):
+            from cubes.imagen_upload.checks import expire_resumable_uploads
+            self.repo.looping_task(3600, expire_resumable_uploads, self.repo)
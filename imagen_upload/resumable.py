@@ -0,0 +1,423 @@
+# -*- coding: utf-8 -*-
+
+# Copyright (c) 2019 CEA
+#
+# This software is governed by the CeCILL license under French law and
+# abiding by the rules of distribution of free software. You can use,
+# modify and/ or redistribute the software under the terms of the CeCILL
+# license as circulated by CEA, CNRS and INRIA at the following URL
+# "http://www.cecill.info".
+#
+# As a counterpart to the access to the source code and rights to copy,
+# modify and redistribute granted by the license, users are provided only
+# with a limited warranty and the software's author, the holder of the
+# economic rights, and the successive licensors have only limited
+# liability.
+#
+# In this respect, the user's attention is drawn to the risks associated
+# with loading, using, modifying and/or developing or reproducing the
+# software by the user in light of its specific status of free software,
+# that may mean that it is complicated to manipulate, and that also
+# therefore means that it is reserved for developers and experienced
+# professionals having in-depth computer knowledge. Users are therefore
+# encouraged to load and test the software's suitability as regards their
+# requirements in conditions enabling the security of their systems and/or
+# data to be ensured and, more generally, to use and operate it in the
+# same conditions as regards security.
+#
+# The fact that you are presently reading this means that you have had
+# knowledge of the CeCILL license and that you accept its terms.
+
+
+
+""" Storage of the resumable uploads, sent in chunks at increasing offsets.
+
+Each upload is stored in DIRECTORY as <id>.part, with its length and
+metadata in <id>.json. The SHA-1 of the received data is updated as chunks
+arrive, and computed again from <id>.part only when the process receiving a
+chunk did not receive the previous one. Complete uploads are moved to
+DIRECTORY/files/<id>/<filename>.
+
+The uploads of a batch are handed off once, under a lock file of the batch
+in DIRECTORY/batches. Uploads left without activity are removed by expire.
+"""
+
+from contextlib import contextmanager
+import errno
+import fcntl
+import hashlib
+import json
+import os
+import shutil
+import threading
+import time
+import uuid
+
+LOGGER = None
+DIRECTORY = None
+MAX_SIZE = 0
+CHUNK_SIZE = 1024 * 1024
+BATCHES_DIRECTORY = 'batches'
+
+# SHA-1 of the data received by this process: id -> (offset, sha1)
+_HASHES = {}
+_HASHES_LOCK = threading.Lock()
+
+
+##############################################################################
+class ResumableError(Exception):
+    """ Invalid request on a resumable upload, with its HTTP status. """
+
+    def __init__(self, status, message):
+        super(ResumableError, self).__init__(message)
+        self.status = status
+
+
+##############################################################################
+def _is_uid(uid):
+    return bool(uid) and all(c in '0123456789abcdef' for c in uid)
+
+
+def _path(uid, extension):
+    # ids are generated by create, refuse anything else
+    if not _is_uid(uid):
+        raise ResumableError(404, "unknown upload")
+    return os.path.join(DIRECTORY, uid + extension)
+
+
+def _try_lock(fd):
+    """ Take a non blocking exclusive lock, return whether it is taken. """
+
+    try:
+        fcntl.flock(fd, fcntl.LOCK_EX | fcntl.LOCK_NB)
+    except IOError as e:
+        if e.errno not in (errno.EAGAIN, errno.EACCES):
+            raise
+        return False
+    return True
+
+
+def _write_info(uid, info):
+    tmp_path = _path(uid, '.json.tmp')
+    with open(tmp_path, 'w') as info_file:
+        json.dump(info, info_file)
+    os.rename(tmp_path, _path(uid, '.json'))
+
+
+##############################################################################
+def create(length, metadata, login):
+    """ Create an empty upload and return its id.
+
+    Parameters:
+        length: number of bytes of the upload
+        metadata: dictionnary of the upload metadata
+        login: login of the user sending the upload
+    """
+
+    if length < 0 or (MAX_SIZE and length > MAX_SIZE):
+        raise ResumableError(413, "upload length not allowed")
+    if not os.path.isdir(DIRECTORY):
+        os.makedirs(DIRECTORY)
+    uid = uuid.uuid4().hex
+    open(_path(uid, '.part'), 'wb').close()
+    _write_info(uid, {'length': length, 'metadata': metadata,
+                      'login': login, 'sha1': None, 'path': None,
+                      'handed_off': False})
+    return uid
+
+
+##############################################################################
+def get_info(uid, login=None):
+    """ Return the information of an upload with its current offset.
+
+    Parameters:
+        uid: id of the upload
+        login: if given, the upload must have been created by this user
+    """
+
+    try:
+        with open(_path(uid, '.json')) as info_file:
+            info = json.load(info_file)
+    except IOError as e:
+        if e.errno == errno.ENOENT:
+            raise ResumableError(404, "unknown upload")
+        raise
+    if login is not None and info['login'] != login:
+        raise ResumableError(404, "unknown upload")
+    if info['path'] is None:
+        info['offset'] = os.path.getsize(_path(uid, '.part'))
+    else:
+        info['offset'] = info['length']
+    return info
+
+
+##############################################################################
+def _sha1(uid, offset):
+    """ Return the SHA-1 object of the first offset bytes of an upload. """
+
+    with _HASHES_LOCK:
+        cached = _HASHES.pop(uid, None)
+    if cached is not None and cached[0] == offset:
+        return cached[1]
+    sha1 = hashlib.sha1()
+    with open(_path(uid, '.part'), 'rb') as part:
+        for chunk in iter(lambda: part.read(CHUNK_SIZE), b''):
+            sha1.update(chunk)
+    return sha1
+
+
+##############################################################################
+def append(uid, offset, stream, login=None):
+    """ Append a chunk to an upload, and move the upload to its final path
+        once complete.
+
+    Parameters:
+        uid: id of the upload
+        offset: offset of the chunk, must be the current size of the upload
+        stream: file object of the chunk
+        login: if given, the upload must have been created by this user
+
+    Return:
+        Return the information of the upload with its new offset. An empty
+        chunk at the end of a complete upload is accepted, so that the
+        hand off of its batch can be retried.
+    """
+
+    info = get_info(uid, login)
+    if info['path'] is not None:
+        return _check_complete(info, offset, stream)
+    # the part of an upload completed meanwhile must not be created again
+    try:
+        part = open(_path(uid, '.part'), 'r+b')
+    except IOError as e:
+        if e.errno != errno.ENOENT:
+            raise
+        return _check_complete(get_info(uid, login), offset, stream)
+    with part:
+        # chunks of an upload sent concurrently are refused
+        if not _try_lock(part):
+            raise ResumableError(423, "upload in progress")
+        # the previous holder of the lock may have completed the upload
+        info = get_info(uid, login)
+        if info['path'] is not None:
+            return _check_complete(info, offset, stream)
+        part.seek(0, os.SEEK_END)
+        current = part.tell()
+        if offset != current:
+            raise ResumableError(409, "offset {} expected".format(current))
+        sha1 = _sha1(uid, current)
+        while True:
+            chunk = stream.read(CHUNK_SIZE)
+            if not chunk:
+                break
+            if current + len(chunk) > info['length']:
+                raise ResumableError(413, "upload longer than its length")
+            part.write(chunk)
+            sha1.update(chunk)
+            current += len(chunk)
+        part.flush()
+        os.fsync(part.fileno())
+        if current < info['length']:
+            with _HASHES_LOCK:
+                _HASHES[uid] = (current, sha1)
+        else:
+            _complete(uid, info, sha1.hexdigest())
+    info['offset'] = current
+    return info
+
+
+def _check_complete(info, offset, stream):
+    if offset != info['length']:
+        raise ResumableError(409, "offset {} expected".format(info['length']))
+    if stream.read(1):
+        raise ResumableError(413, "upload longer than its length")
+    return info
+
+
+def _complete(uid, info, sha1hex):
+    filename = os.path.basename(info['metadata'].get('filename') or uid)
+    directory = os.path.join(DIRECTORY, 'files', uid)
+    if not os.path.isdir(directory):
+        os.makedirs(directory)
+    path = os.path.join(directory, filename)
+    # the part is removed only once the information points to the file, so
+    # that an upload whose information has no path always has its part;
+    # a link left by an interrupted completion is replaced
+    if os.path.exists(path):
+        os.remove(path)
+    os.link(_path(uid, '.part'), path)
+    info['sha1'] = sha1hex
+    info['path'] = path
+    _write_info(uid, dict((k, v) for k, v in info.items() if k != 'offset'))
+    os.remove(_path(uid, '.part'))
+    LOGGER.info("resumable upload {} complete: {} ({})".format(
+        uid, path, sha1hex))
+
+
+##############################################################################
+def get_batch(batch, login):
+    """ Return the (id, information) of the complete uploads of a batch.
+
+    Parameters:
+        batch: id of the batch given in the metadata of its uploads
+        login: login of the user sending the uploads
+    """
+
+    uploads = []
+    for name in os.listdir(DIRECTORY):
+        if not name.endswith('.json'):
+            continue
+        uid = name[:-len('.json')]
+        try:
+            info = get_info(uid, login)
+        except ResumableError:
+            continue
+        if info['metadata'].get('batch') == batch and info['path']:
+            uploads.append((uid, info))
+    return uploads
+
+
+##############################################################################
+@contextmanager
+def claim_batch(batch, login):
+    """ Claim the hand off of a batch against the other threads and
+        processes, with a fcntl advisory lock on a lock file of the batch
+        in BATCHES_DIRECTORY.
+
+    Parameters:
+        batch: id of the batch given in the metadata of its uploads
+        login: login of the user sending the uploads
+
+    Return:
+        Yield True if the batch is claimed, False if it is being handed off
+        by someone else
+    """
+
+    directory = os.path.join(DIRECTORY, BATCHES_DIRECTORY)
+    if not os.path.isdir(directory):
+        try:
+            os.makedirs(directory)
+        except OSError as e:
+            if e.errno != errno.EEXIST:
+                raise
+    key = u'{}\n{}'.format(login, batch).encode('utf-8')
+    path = os.path.join(directory, hashlib.sha1(key).hexdigest())
+    fd = os.open(path, os.O_RDWR | os.O_CREAT, 0o664)
+    try:
+        if not _try_lock(fd):
+            yield False
+            return
+        # the lock file is removed once the batch is handed off: a file
+        # opened before its removal is no longer the lock file of the batch
+        try:
+            claimed = os.stat(path).st_ino == os.fstat(fd).st_ino
+        except OSError:
+            claimed = False
+        if not claimed:
+            yield False
+            return
+        try:
+            yield True
+        finally:
+            os.remove(path)
+    finally:
+        os.close(fd)
+
+
+def set_handed_off(uid, handed_off=True):
+    """ Mark a complete upload whose file may be owned by an UploadFile
+        entity, so that its file is kept when the upload expires.
+
+    Parameters:
+        uid: id of the upload
+        handed_off: whether the transaction creating the entity may be
+                    committed
+    """
+
+    info = get_info(uid)
+    info['handed_off'] = handed_off
+    _write_info(uid, dict((k, v) for k, v in info.items() if k != 'offset'))
+
+
+##############################################################################
+def expire(max_age):
+    """ Remove the uploads, complete or not, and the lock files of batches
+        left without activity for max_age seconds. The file of an upload
+        handed off is kept.
+
+    Parameters:
+        max_age: age in seconds of the last chunk of an expired upload
+
+    Return:
+        Return the number of removed uploads.
+    """
+
+    if not DIRECTORY or not os.path.isdir(DIRECTORY):
+        return 0
+    limit = time.time() - max_age
+    uids = set(name.partition('.')[0] for name in os.listdir(DIRECTORY))
+    expired = 0
+    for uid in sorted(uid for uid in uids if _is_uid(uid)):
+        mtimes = []
+        for extension in ('.json', '.json.tmp', '.part'):
+            try:
+                mtimes.append(os.path.getmtime(_path(uid, extension)))
+            except OSError:
+                pass
+        if not mtimes or max(mtimes) >= limit:
+            continue
+        try:
+            part = os.open(_path(uid, '.part'), os.O_RDONLY)
+        except OSError:
+            part = None
+        try:
+            # an upload receiving a chunk is kept
+            if part is not None and not _try_lock(part):
+                continue
+            try:
+                keep_file = get_info(uid).get('handed_off', False)
+            except (ResumableError, ValueError, EnvironmentError):
+                keep_file = False
+            remove(uid, keep_file)
+            expired += 1
+        finally:
+            if part is not None:
+                os.close(part)
+    directory = os.path.join(DIRECTORY, BATCHES_DIRECTORY)
+    for name in os.listdir(directory) if os.path.isdir(directory) else ():
+        path = os.path.join(directory, name)
+        try:
+            fd = os.open(path, os.O_RDONLY)
+        except OSError:
+            continue
+        try:
+            if os.fstat(fd).st_mtime < limit and _try_lock(fd):
+                os.remove(path)
+        finally:
+            os.close(fd)
+    if expired and LOGGER:
+        LOGGER.info("{} resumable uploads expired".format(expired))
+    return expired
+
+
+##############################################################################
+def remove(uid, keep_file=False):
+    """ Remove an upload.
+
+    Parameters:
+        uid: id of the upload
+        keep_file: keep the file of a complete upload, now owned by an
+                   UploadFile entity
+    """
+
+    with _HASHES_LOCK:
+        _HASHES.pop(uid, None)
+    for extension in ('.json', '.json.tmp', '.part'):
+        try:
+            os.remove(_path(uid, extension))
+        except OSError as e:
+            if e.errno != errno.ENOENT:
+                raise
+    if not keep_file:
+        shutil.rmtree(os.path.join(DIRECTORY, 'files', uid),
+                      ignore_errors=True)
@@ -0,0 +1,242 @@
+# -*- coding: utf-8 -*-
+
+# Copyright (c) 2019 CEA
+#
+# This software is governed by the CeCILL license under French law and
+# abiding by the rules of distribution of free software. You can use,
+# modify and/ or redistribute the software under the terms of the CeCILL
+# license as circulated by CEA, CNRS and INRIA at the following URL
+# "http://www.cecill.info".
+#
+# As a counterpart to the access to the source code and rights to copy,
+# modify and redistribute granted by the license, users are provided only
+# with a limited warranty and the software's author, the holder of the
+# economic rights, and the successive licensors have only limited
+# liability.
+#
+# In this respect, the user's attention is drawn to the risks associated
+# with loading, using, modifying and/or developing or reproducing the
+# software by the user in light of its specific status of free software,
+# that may mean that it is complicated to manipulate, and that also
+# therefore means that it is reserved for developers and experienced
+# professionals having in-depth computer knowledge. Users are therefore
+# encouraged to load and test the software's suitability as regards their
+# requirements in conditions enabling the security of their systems and/or
+# data to be ensured and, more generally, to use and operate it in the
+# same conditions as regards security.
+#
+# The fact that you are presently reading this means that you have had
+# knowledge of the CeCILL license and that you accept its terms.
+
+
+""" Persistent cache of the results of the content sanity checks.
+
+Results are stored in a SQLite database, keyed by the SHA-1 of the checked
+file, the check function, the posted fields it is given and the version of
+imagen_databank. The least recently used results are evicted when the cache
+holds more than CACHE_SIZE results.
+
+The errors are stored as JSON, their samples by their repr() which is all
+that is displayed of them, so that reading the cache never runs code.
+"""
+
+from collections import namedtuple
+import hashlib
+import json
+import os
+import sqlite3
+import time
+
+import imagen_databank
+
+LOGGER = None
+CACHE_FILE = None
+CACHE_SIZE = 10000
+# stand for the file path used by CW, which differs between uploads
+FILEPATH = u'\x00filepath\x00'
+FILENAME = u'\x00filename\x00'
+
+SanityError = namedtuple('SanityError', ['message', 'path', 'sample'])
+
+
+class _Sample(str):
+    """ Sample of a cached error, whose repr() is the repr() of the
+        sample originally returned by the check.
+    """
+
+    def __repr__(self):
+        return str(self)
+
+
+##############################################################################
+def get_checker_version():
+    """ Return the version of imagen_databank, None if it is unknown. """
+
+    version = getattr(imagen_databank, '__version__', None)
+    if version is None:
+        try:
+            import pkg_resources
+            version = pkg_resources.get_distribution(
+                'imagen_databank').version
+        except Exception:
+            version = None
+    return version
+
+
+##############################################################################
+def _normalize(value):
+    """ Return a representation of value independent of dictionary order.
+    """
+
+    if isinstance(value, dict):
+        return tuple(sorted((k, _normalize(v)) for k, v in value.items()))
+    if isinstance(value, (list, tuple)):
+        return tuple(_normalize(v) for v in value)
+    return value
+
+
+##############################################################################
+def get_key(check, sha1hex, args):
+    """ Build the cache key of a check result.
+
+    Parameters:
+        check: sanity check function
+        sha1hex: SHA-1 hex digest of the checked file
+        args: arguments given to the check function after the file path
+    """
+
+    version = get_checker_version()
+    if not CACHE_FILE or not sha1hex or version is None:
+        return None
+    key = repr((check.__module__, check.__name__, sha1hex,
+                _normalize(args), version))
+    return hashlib.sha1(key).hexdigest()
+
+
+##############################################################################
+def _connect():
+    """ Open the cache database, creating its table if needed. """
+
+    cnx = sqlite3.connect(CACHE_FILE, timeout=10)
+    cnx.execute("CREATE TABLE IF NOT EXISTS results"
+                " (key TEXT PRIMARY KEY, errors BLOB, atime REAL)")
+    cnx.execute("CREATE INDEX IF NOT EXISTS results_atime"
+                " ON results (atime)")
+    return cnx
+
+
+##############################################################################
+def _replace(value, old, new):
+    """ Replace old by new in value if it is a string. """
+
+    if isinstance(value, basestring) and old:
+        return value.replace(old, new)
+    return value
+
+
+##############################################################################
+def get(key, filepath):
+    """ Return the cached errors of a check, None if not cached.
+
+    Parameters:
+        key: cache key built by get_key
+        filepath: file path used by CW for uploaded file
+    """
+
+    try:
+        cnx = _connect()
+        try:
+            row = cnx.execute("SELECT errors FROM results WHERE key = ?",
+                              (key,)).fetchone()
+            if row is None:
+                return None
+            cnx.execute("UPDATE results SET atime = ? WHERE key = ?",
+                        (time.time(), key))
+            cnx.commit()
+        finally:
+            cnx.close()
+    except sqlite3.Error as e:
+        LOGGER.warning("sanity cache not readable: {}".format(e))
+        return None
+    try:
+        records = json.loads(str(row[0]))
+    except ValueError:
+        # written by an earlier version, checked again
+        return None
+    errors = []
+    for message, path, sample in records:
+        if sample is not None:
+            sample = _Sample(sample)
+        message = _replace(message, FILEPATH, filepath)
+        message = _replace(message, FILENAME, os.path.basename(filepath))
+        path = _replace(path, FILEPATH, filepath)
+        path = _replace(path, FILENAME, os.path.basename(filepath))
+        errors.append(SanityError(message, path, sample))
+    return errors
+
+
+##############################################################################
+def put(key, filepath, errors):
+    """ Store the errors of a check and evict the least recently used
+        results beyond CACHE_SIZE.
+
+    Parameters:
+        key: cache key built by get_key
+        filepath: file path used by CW for uploaded file
+        errors: errors returned by the check
+    """
+
+    records = []
+    for err in errors or []:
+        message = _replace(err.message, filepath, FILEPATH)
+        message = _replace(message, os.path.basename(filepath), FILENAME)
+        path = _replace(err.path, filepath, FILEPATH)
+        path = _replace(path, os.path.basename(filepath), FILENAME)
+        sample = repr(err.sample) if err.sample else None
+        records.append((message, path, sample))
+    try:
+        data = json.dumps(records)
+    except (TypeError, ValueError) as e:
+        LOGGER.warning("sanity check result not cached: {}".format(e))
+        return
+    try:
+        cnx = _connect()
+        try:
+            cnx.execute("INSERT OR REPLACE INTO results VALUES (?, ?, ?)",
+                        (key, sqlite3.Binary(data), time.time()))
+            cnx.execute("DELETE FROM results WHERE key IN"
+                        " (SELECT key FROM results ORDER BY atime DESC"
+                        " LIMIT -1 OFFSET ?)", (CACHE_SIZE,))
+            cnx.commit()
+        finally:
+            cnx.close()
+    except sqlite3.Error as e:
+        LOGGER.warning("sanity cache not writable: {}".format(e))
+
+
+##############################################################################
+def cached_check(check, sha1hex, filepath, *args):
+    """ Call a content sanity check unless its result is cached.
+
+    Parameters:
+        check: sanity check function, called with filepath and args
+        sha1hex: SHA-1 hex digest of the checked file
+        filepath: file path used by CW for uploaded file
+        args: other arguments of the check function
+
+    Return:
+        Return the tuple (psc1, errors) of the check, psc1 being None
+        when errors come from the cache
+    """
+
+    key = get_key(check, sha1hex, args)
+    if key is not None:
+        errors = get(key, filepath)
+        if errors is not None:
+            LOGGER.info("sanity check {} of {} found in cache".format(
+                check.__name__, sha1hex))
+            return None, errors
+    psc1, errors = check(filepath, *args)
+    if key is not None:
+        put(key, filepath, errors)
+    return psc1, errors
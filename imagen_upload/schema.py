@@ -32,5 +32,11 @@
 
 from yams.buildobjs import String
 from cubicweb.schemas.bootstrap import CWGroup
+from cubes.rql_upload.schema import CWUpload
 
 CWGroup.add_relation(String(maxsize=512), name='description')
+
+# '<form>:<sid>:<time point>' for uploads not rejected, used to detect
+# duplicate uploads with an indexed lookup (see entities.upload_key)
+CWUpload.add_relation(String(maxsize=64, indexed=True, unique=True),
+                      name='upload_key')
@@ -0,0 +1,198 @@
+# -*- coding: utf-8 -*-
+
+# Copyright (c) 2019 CEA
+#
+# This software is governed by the CeCILL license under French law and
+# abiding by the rules of distribution of free software. You can use,
+# modify and/ or redistribute the software under the terms of the CeCILL
+# license as circulated by CEA, CNRS and INRIA at the following URL
+# "http://www.cecill.info".
+#
+# As a counterpart to the access to the source code and rights to copy,
+# modify and redistribute granted by the license, users are provided only
+# with a limited warranty and the software's author, the holder of the
+# economic rights, and the successive licensors have only limited
+# liability.
+#
+# In this respect, the user's attention is drawn to the risks associated
+# with loading, using, modifying and/or developing or reproducing the
+# software by the user in light of its specific status of free software,
+# that may mean that it is complicated to manipulate, and that also
+# therefore means that it is reserved for developers and experienced
+# professionals having in-depth computer knowledge. Users are therefore
+# encouraged to load and test the software's suitability as regards their
+# requirements in conditions enabling the security of their systems and/or
+# data to be ensured and, more generally, to use and operate it in the
+# same conditions as regards security.
+#
+# The fact that you are presently reading this means that you have had
+# knowledge of the CeCILL license and that you accept its terms.
+
+
+
+""" Incremental verification of the integrity of the validated files.
+
+Each call of scrub verifies a slice of files against the SHA-1 computed by
+CubicWeb at upload time, reading at most RATE bytes per second. A slice
+stops after a number of bytes read or of files examined, so that a slice
+of files found unchanged does not walk all the files. The state
+of the scrubber is stored in a SQLite database: the cursor from which the
+next slice starts and, for each file, its (size, mtime) and SHA-1 when it
+was last verified. A file is read again when it changed since then, or
+when its last verification is older than PERIOD seconds.
+"""
+
+import errno
+import hashlib
+import os
+import sqlite3
+import time
+
+from .transport import RateLimiter
+
+LOGGER = None
+STATE_FILE = None
+# seconds between two verifications of an unchanged file
+PERIOD = 30 * 24 * 3600
+# bytes per second read by the scrubber, 0 for no limit
+RATE = 0
+CHUNK_SIZE = 1024 * 1024
+
+# results of verify_file
+OK = 'ok'
+MISSING = 'missing'
+CORRUPTED = 'corrupted'
+
+
+##############################################################################
+def _connect():
+    """ Open the state database, creating its tables if needed. """
+
+    cnx = sqlite3.connect(STATE_FILE, timeout=10)
+    cnx.execute("CREATE TABLE IF NOT EXISTS cursor"
+                " (name TEXT PRIMARY KEY, value INTEGER)")
+    cnx.execute("CREATE TABLE IF NOT EXISTS files"
+                " (path TEXT PRIMARY KEY, size INTEGER, mtime REAL,"
+                " sha1 TEXT, verified REAL, status TEXT)")
+    return cnx
+
+
+##############################################################################
+def get_cursor(cnx, name):
+    """ Return the saved cursor of a scrub, 0 if there is none. """
+
+    row = cnx.execute("SELECT value FROM cursor WHERE name = ?",
+                      (name,)).fetchone()
+    return row[0] if row else 0
+
+
+##############################################################################
+def set_cursor(cnx, name, value):
+    """ Save the cursor of a scrub. """
+
+    with cnx:
+        cnx.execute("INSERT OR REPLACE INTO cursor VALUES (?, ?)",
+                    (name, value))
+
+
+##############################################################################
+def verify_file(cnx, path, sha1hex, limiter):
+    """ Verify a file against its SHA-1, unless it was verified unchanged
+        less than PERIOD seconds ago.
+
+    Parameters:
+        cnx: connection to the state database
+        path: path of the file, symlinks are followed
+        sha1hex: expected SHA-1 hex digest
+        limiter: RateLimiter of the bytes read
+
+    Return:
+        Return the status of the file and the number of bytes read.
+    """
+
+    try:
+        stat = os.stat(path)
+    except OSError as e:
+        if e.errno not in (errno.ENOENT, errno.ENOTDIR, errno.ELOOP):
+            raise
+        # missing file or broken symlink
+        _put(cnx, path, None, None, None, MISSING)
+        return MISSING, 0
+    row = cnx.execute("SELECT size, mtime, sha1, verified FROM files"
+                      " WHERE path = ?", (path,)).fetchone()
+    if (row is not None and tuple(row[:3]) ==
+            (stat.st_size, stat.st_mtime, sha1hex) and
+            row[3] > time.time() - PERIOD):
+        return OK, 0
+    sha1 = hashlib.sha1()
+    size = 0
+    with open(path, 'rb') as data:
+        for chunk in iter(lambda: data.read(CHUNK_SIZE), b''):
+            limiter.consume(len(chunk))
+            sha1.update(chunk)
+            size += len(chunk)
+    status = OK if sha1.hexdigest() == sha1hex else CORRUPTED
+    _put(cnx, path, stat.st_size, stat.st_mtime, sha1.hexdigest(), status)
+    return status, size
+
+
+def _put(cnx, path, size, mtime, sha1hex, status):
+    with cnx:
+        cnx.execute("INSERT OR REPLACE INTO files VALUES (?, ?, ?, ?, ?, ?)",
+                    (path, size, mtime, sha1hex, time.time(), status))
+
+
+##############################################################################
+def scrub(name, get_files, slice_bytes, slice_files=None):
+    """ Verify the next slice of files, from the saved cursor.
+
+    Parameters:
+        name: name of the cursor
+        get_files: function called with the cursor, returning the next
+                   (cursor, path, SHA-1) tuples by increasing cursor, an
+                   empty list at the end
+        slice_bytes: number of bytes to read before stopping
+        slice_files: number of files to examine before stopping, None for
+                     no limit
+
+    Return:
+        Return the list of (path, status) of the files failing verification.
+    """
+
+    if not STATE_FILE:
+        return []
+    limiter = RateLimiter(RATE)
+    failures = []
+    read = 0
+    examined = 0
+
+    def done():
+        return (read >= slice_bytes or
+                (slice_files is not None and examined >= slice_files))
+
+    start = time.time()
+    cnx = _connect()
+    try:
+        cursor = get_cursor(cnx, name)
+        while not done():
+            files = get_files(cursor)
+            if not files:
+                # start again from the first file next time
+                cursor = 0
+                break
+            for cursor, path, sha1hex in files:
+                status, size = verify_file(cnx, path, sha1hex, limiter)
+                read += size
+                examined += 1
+                if status != OK:
+                    LOGGER.critical("{} {}".format(path, status))
+                    failures.append((path, status))
+                if done():
+                    break
+            set_cursor(cnx, name, cursor)
+        set_cursor(cnx, name, cursor)
+    finally:
+        cnx.close()
+    LOGGER.info("scrub of {} files, {} bytes in {:.0f}s, {} failures".format(
+        examined, read, time.time() - start, len(failures)))
+    return failures
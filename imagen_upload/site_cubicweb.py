@@ -40,4 +40,298 @@ options = (
             "group": "imagen_upload", "level": 0,
         }
     ),
+    (
+        "cati_ledger_backend",
+        {
+            "type": "choice",
+            "choices": ("csv", "sqlite"),
+            "default": "csv",
+            "help": ("storage of the cati workflow ledgers: the csv files"
+                     " only, or an indexed sqlite database in the cati"
+                     " workflow directory, exported to the csv files at"
+                     " the end of each cycle."),
+            "group": "imagen_upload", "level": 1,
+        }
+    ),
+    (
+        "async_check_workers",
+        {
+            "type": "int",
+            "default": 1,
+            "help": ("number of uploads processed in parallel by the"
+                     " asynchronous checks, each upload in its own"
+                     " transaction (1 to process them sequentially)."),
+            "group": "imagen_upload", "level": 1,
+        }
+    ),
+    (
+        "async_check_batch_size",
+        {
+            "type": "int",
+            "default": 50,
+            "help": ("number of uploads processed by a sequential"
+                     " asynchronous check between two commits."),
+            "group": "imagen_upload", "level": 1,
+        }
+    ),
+    (
+        "async_check_batch_seconds",
+        {
+            "type": "int",
+            "default": 300,
+            "help": ("maximum number of seconds between two commits of a"
+                     " sequential asynchronous check."),
+            "group": "imagen_upload", "level": 1,
+        }
+    ),
+    (
+        "sanity_cache_file",
+        {
+            "type": "string",
+            "default": "",
+            "help": ("SQLite file caching the results of the content sanity"
+                     " checks by file SHA-1 (empty to disable the cache)."),
+            "group": "imagen_upload", "level": 1,
+        }
+    ),
+    (
+        "sanity_cache_size",
+        {
+            "type": "int",
+            "default": 10000,
+            "help": ("maximum number of sanity check results kept in cache,"
+                     " the least recently used results are evicted."),
+            "group": "imagen_upload", "level": 1,
+        }
+    ),
+    (
+        "fail_fast_checks",
+        {
+            "type": "yn",
+            "default": False,
+            "help": ("skip the scan of the MRI zip content when the subject"
+                     " ID, time point, duplicate or file name checks fail,"
+                     " instead of reporting the content errors with them."),
+            "group": "imagen_upload", "level": 1,
+        }
+    ),
+    (
+        "cati_transport_url",
+        {
+            "type": "string",
+            "default": "",
+            "help": ("where the MRI files are sent to cati:"
+                     " sftp://[user@]host[:port]/directory for a SFTP"
+                     " server, or a local directory (empty to only record"
+                     " files as sent)."),
+            "group": "imagen_upload", "level": 1,
+        }
+    ),
+    (
+        "cati_transport_key",
+        {
+            "type": "string",
+            "default": "",
+            "help": ("private key file used to connect to the cati SFTP"
+                     " server (empty for the default keys)."),
+            "group": "imagen_upload", "level": 1,
+        }
+    ),
+    (
+        "cati_send_workers",
+        {
+            "type": "int",
+            "default": 1,
+            "help": "number of files sent to cati at the same time.",
+            "group": "imagen_upload", "level": 1,
+        }
+    ),
+    (
+        "cati_bandwidth",
+        {
+            "type": "int",
+            "default": 0,
+            "help": ("maximum bandwidth used to send files to cati, in KiB/s"
+                     " (0 for no limit)."),
+            "group": "imagen_upload", "level": 1,
+        }
+    ),
+    (
+        "cati_night_bandwidth",
+        {
+            "type": "int",
+            "default": -1,
+            "help": ("maximum bandwidth used to send files to cati during"
+                     " night hours, in KiB/s (0 for no limit, -1 for the"
+                     " same limit as during the day)."),
+            "group": "imagen_upload", "level": 1,
+        }
+    ),
+    (
+        "cati_night_hours",
+        {
+            "type": "string",
+            "default": "22-6",
+            "help": ("night hours, in local time, for the cati night"
+                     " bandwidth."),
+            "group": "imagen_upload", "level": 1,
+        }
+    ),
+    (
+        "cati_response_watcher",
+        {
+            "type": "yn",
+            "default": False,
+            "help": ("watch the cati response file and validate or reject"
+                     " the MRI uploads as soon as cati answers."),
+            "group": "imagen_upload", "level": 1,
+        }
+    ),
+    (
+        "cati_watcher_poll_interval",
+        {
+            "type": "int",
+            "default": 10,
+            "help": ("seconds between two checks of the cati response file"
+                     " when inotify is not available."),
+            "group": "imagen_upload", "level": 1,
+        }
+    ),
+    (
+        "cas_directory",
+        {
+            "type": "string",
+            "default": "",
+            "help": ("content-addressable store of the validated files: each"
+                     " content is stored once under its SHA-1 and the"
+                     " validated directory holds links to it (empty to store"
+                     " the files in the validated directory)."),
+            "group": "imagen_upload", "level": 1,
+        }
+    ),
+    (
+        "cas_link",
+        {
+            "type": "choice",
+            "choices": ("hardlink", "symlink"),
+            "default": "hardlink",
+            "help": ("links from the validated directory to the"
+                     " content-addressable store, symlinks being used when"
+                     " hard links are not possible."),
+            "group": "imagen_upload", "level": 1,
+        }
+    ),
+    (
+        "scrub_state_file",
+        {
+            "type": "string",
+            "default": "",
+            "help": ("SQLite file storing the state of the verification of"
+                     " the validated files against their SHA-1 (empty to"
+                     " disable the verification)."),
+            "group": "imagen_upload", "level": 1,
+        }
+    ),
+    (
+        "scrub_interval",
+        {
+            "type": "int",
+            "default": 3600,
+            "help": ("seconds between two slices of the verification of the"
+                     " validated files."),
+            "group": "imagen_upload", "level": 1,
+        }
+    ),
+    (
+        "scrub_slice_size",
+        {
+            "type": "int",
+            "default": 2048,
+            "help": ("MiB of validated files read by a slice of the"
+                     " verification."),
+            "group": "imagen_upload", "level": 1,
+        }
+    ),
+    (
+        "scrub_slice_files",
+        {
+            "type": "int",
+            "default": 10000,
+            "help": ("maximum number of validated files examined by a slice"
+                     " of the verification, read or found unchanged since"
+                     " their last verification."),
+            "group": "imagen_upload", "level": 1,
+        }
+    ),
+    (
+        "scrub_rate",
+        {
+            "type": "int",
+            "default": 20480,
+            "help": ("maximum reading rate of the verification of the"
+                     " validated files, in KiB/s (0 for no limit)."),
+            "group": "imagen_upload", "level": 1,
+        }
+    ),
+    (
+        "scrub_period",
+        {
+            "type": "int",
+            "default": 30,
+            "help": ("days after which an unchanged validated file is read"
+                     " again by the verification."),
+            "group": "imagen_upload", "level": 1,
+        }
+    ),
+    (
+        "mri_extraction_directory",
+        {
+            "type": "string",
+            "default": "",
+            "help": ("directory where the validated MRI zips are extracted"
+                     " by sequence, with a manifest of each zip and an index"
+                     " (empty to keep the zips only)."),
+            "group": "imagen_upload", "level": 1,
+        }
+    ),
+    (
+        "mri_extraction_workers",
+        {
+            "type": "int",
+            "default": 2,
+            "help": "number of validated MRI zips extracted at the same time.",
+            "group": "imagen_upload", "level": 1,
+        }
+    ),
+    (
+        "resumable_upload_directory",
+        {
+            "type": "string",
+            "default": "",
+            "help": ("directory where the files sent in chunks to the"
+                     " resumable-upload controller are assembled and kept"
+                     " (empty to disable resumable uploads)."),
+            "group": "imagen_upload", "level": 1,
+        }
+    ),
+    (
+        "resumable_upload_max_size",
+        {
+            "type": "int",
+            "default": 0,
+            "help": ("maximum size of a resumable upload, in MiB (0 for no"
+                     " limit)."),
+            "group": "imagen_upload", "level": 1,
+        }
+    ),
+    (
+        "resumable_upload_expiry",
+        {
+            "type": "int",
+            "default": 72,
+            "help": ("hours without a chunk after which a resumable upload,"
+                     " complete or not, is removed (0 to keep them)."),
+            "group": "imagen_upload", "level": 1,
+        }
+    ),
 )
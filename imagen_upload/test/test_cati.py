@@ -0,0 +1,288 @@
+# -*- coding: utf-8 -*-
+
+# Copyright (c) 2019 CEA
+#
+# This software is governed by the CeCILL license under French law and
+# abiding by the rules of distribution of free software. You can use,
+# modify and/ or redistribute the software under the terms of the CeCILL
+# license as circulated by CEA, CNRS and INRIA at the following URL
+# "http://www.cecill.info".
+#
+# As a counterpart to the access to the source code and rights to copy,
+# modify and redistribute granted by the license, users are provided only
+# with a limited warranty and the software's author, the holder of the
+# economic rights, and the successive licensors have only limited
+# liability.
+#
+# In this respect, the user's attention is drawn to the risks associated
+# with loading, using, modifying and/or developing or reproducing the
+# software by the user in light of its specific status of free software,
+# that may mean that it is complicated to manipulate, and that also
+# therefore means that it is reserved for developers and experienced
+# professionals having in-depth computer knowledge. Users are therefore
+# encouraged to load and test the software's suitability as regards their
+# requirements in conditions enabling the security of their systems and/or
+# data to be ensured and, more generally, to use and operate it in the
+# same conditions as regards security.
+#
+# The fact that you are presently reading this means that you have had
+# knowledge of the CeCILL license and that you accept its terms.
+
+""" Tests of the cati ledger: CSV journal, consumed responses, compaction,
+recovery after a crash and SQLite backend.
+"""
+
+import logging
+import os
+import shutil
+import tempfile
+import unittest
+
+from cubes.imagen_upload import cati
+
+
+class CatiTC(unittest.TestCase):
+
+    backend = cati.CSV_BACKEND
+
+    def setUp(self):
+        self.directory = tempfile.mkdtemp()
+        cati.LOGGER = logging.getLogger('imagen_upload.test')
+        cati.CATI_WORFLOW_DIRECTORY = self.directory
+        cati.LEDGER_BACKEND = self.backend
+        cati._CACHE.clear()
+        cati._LIVE.clear()
+        self.assertTrue(cati.is_system_OK())
+
+    def tearDown(self):
+        cati.LEDGER_BACKEND = cati.CSV_BACKEND
+        cati.COMPACTION_MIN_RECORDS = 1000
+        cati._RECOVERED.clear()
+        cnx = getattr(cati._DB, 'cnx', None)
+        if cnx is not None:
+            cnx.close()
+            cati._DB.cnx = None
+        shutil.rmtree(self.directory)
+
+    def respond(self, data):
+        """ Append data to the response file, as the CATI side does. """
+
+        with open(cati.get_response_file_path(), 'a') as response_file:
+            response_file.write(data)
+
+    def read(self, path):
+        with open(path) as ledger_file:
+            return ledger_file.read()
+
+
+class CsvLedgerTC(CatiTC):
+
+    def test_send_and_done(self):
+        cati.add_sent('a.zip')
+        self.assertTrue(cati.has_sent('a.zip'))
+        self.assertEqual(cati.get_response('a.zip'), None)
+        self.respond('a.zip;Rejected;bad name\n')
+        self.assertEqual(cati.get_response('a.zip'), ['Rejected', 'bad name'])
+        cati.set_done('a.zip', 'sha1')
+        self.assertFalse(cati.has_sent('a.zip'))
+        self.assertEqual(cati.get_response('a.zip'), None)
+        self.assertEqual(cati.get_delivered(['sha1', 'other']),
+                         {'sha1': ['a.zip', 'Rejected', 'bad name']})
+        done = self.read(cati.get_done_file_path()).splitlines()
+        self.assertEqual(len(done), 1)
+        self.assertEqual(done[0].split(';')[1], 'a.zip')
+        self.assertEqual(done[0].split(';')[3:], ['Rejected', 'bad name'])
+
+    def test_response_file_not_written(self):
+        cati.add_sent('a.zip')
+        self.respond('a.zip;Validated\n')
+        cati.set_done('a.zip')
+        self.assertEqual(self.read(cati.get_response_file_path()),
+                         'a.zip;Validated\n')
+        self.assertEqual(self.read(cati.get_consumed_file_path()),
+                         'a.zip;1\n')
+
+    def test_new_response_after_done(self):
+        cati.add_sent('a.zip')
+        self.respond('a.zip;Rejected;bad name\n')
+        cati.set_done('a.zip')
+        # sent again, answered again
+        cati.add_sent('a.zip')
+        self.assertEqual(cati.get_responses(['a.zip']), {})
+        self.respond('a.zip;Validated\n')
+        self.assertEqual(cati.get_responses(['a.zip']),
+                         {'a.zip': ['Validated']})
+
+    def test_tombstones(self):
+        cati.add_sent('a.zip')
+        cati.add_sent('b.zip')
+        self.respond('a.zip;Validated\n')
+        cati.set_done('a.zip')
+        self.assertEqual(sorted(cati.read_sent_file()), ['b.zip'])
+        self.assertTrue(self.read(cati.get_sent_file_path()).endswith(
+            'a.zip;{}\n'.format(cati.TOMBSTONE)))
+        # the tombstones written by earlier versions consume the response
+        self.respond('b.zip;Validated\nb.zip;{}\n'.format(cati.TOMBSTONE))
+        self.assertEqual(cati.read_response_file(), {})
+
+    def test_compaction(self):
+        cati.COMPACTION_MIN_RECORDS = 4
+        entries = ['{}.zip'.format(i) for i in range(10)]
+        for entry in entries:
+            cati.add_sent(entry)
+            self.respond('{};Validated\n'.format(entry))
+        cati.add_sent('kept.zip')
+        for entry in entries:
+            cati.set_done(entry)
+        self.assertEqual(sorted(cati.read_sent_file()), ['kept.zip'])
+        # compacted once the tombstones outnumber the live records
+        self.assertLess(
+            len(self.read(cati.get_sent_file_path()).splitlines()), 21)
+        cati._CACHE.clear()
+        cati._LIVE.clear()
+        self.assertEqual(sorted(cati.read_sent_file()), ['kept.zip'])
+        self.assertEqual(cati.read_response_file(), {})
+        self.assertEqual(len(self.read(
+            cati.get_response_file_path()).splitlines()), 10)
+
+    def test_partial_response_ignored(self):
+        cati.add_sent('a.zip')
+        cati.add_sent('b.zip')
+        self.respond('a.zip;Validated\nb.zip;Vali')
+        self.assertEqual(cati.get_responses(['a.zip', 'b.zip']),
+                         {'a.zip': ['Validated']})
+        cati._RECOVERED.clear()
+        cati.recover()
+        # the CATI side may still be writing the record
+        self.assertEqual(self.read(cati.get_response_file_path()),
+                         'a.zip;Validated\nb.zip;Vali')
+        self.respond('dated\n')
+        self.assertEqual(cati.get_response('b.zip'), ['Validated'])
+
+    def test_recover_interrupted_record(self):
+        with open(cati.get_sent_file_path(), 'a') as sent_file:
+            sent_file.write('a.zip;2019-01-01 00:00:00\nb.zip;2019')
+        cati._RECOVERED.clear()
+        cati.recover()
+        self.assertEqual(self.read(cati.get_sent_file_path()),
+                         'a.zip;2019-01-01 00:00:00\n')
+        cati.add_sent('b.zip')
+        self.assertEqual(sorted(cati.read_sent_file()), ['a.zip', 'b.zip'])
+
+    def test_recover_interrupted_set_done(self):
+        sent = '2019-01-01 00:00:00'
+        with open(cati.get_sent_file_path(), 'a') as sent_file:
+            sent_file.write('a.zip;{}\n'.format(sent))
+        with open(cati.get_done_file_path(), 'a') as done_file:
+            done_file.write('2019-01-02 00:00:00;a.zip;{};Validated\n'.format(
+                sent))
+        self.respond('a.zip;Validated\n')
+        cati._RECOVERED.clear()
+        cati._CACHE.clear()
+        cati.recover()
+        self.assertFalse(cati.has_sent('a.zip'))
+        self.assertEqual(cati.get_response('a.zip'), None)
+
+    def test_claim_entry(self):
+        with cati.claim_entry('a.zip') as claimed:
+            self.assertTrue(claimed)
+            with cati.claim_entry('a.zip') as again:
+                self.assertFalse(again)
+            with cati.claim_entry('b.zip') as other:
+                self.assertTrue(other)
+        with cati.claim_entry('a.zip') as claimed:
+            self.assertTrue(claimed)
+
+
+class SqliteLedgerTC(CatiTC):
+
+    backend = cati.SQLITE_BACKEND
+
+    def test_send_and_done(self):
+        cati.add_sent('a.zip')
+        self.respond('a.zip;Validated\nunknown.zip;Validated\n')
+        cati.start_cycle()
+        self.assertEqual(cati.read_response_file(), {'a.zip': 'Validated'})
+        cati.set_done('a.zip', 'sha1')
+        cati.end_cycle()
+        self.assertFalse(cati.has_sent('a.zip'))
+        self.assertEqual(cati.get_delivered(['sha1']),
+                         {'sha1': ['a.zip', 'Validated']})
+        self.assertEqual(self.read(cati.get_consumed_file_path()),
+                         'a.zip;1\n')
+        self.assertEqual(self.read(cati.get_response_file_path()),
+                         'a.zip;Validated\nunknown.zip;Validated\n')
+        # the consumed response is not imported again
+        cati.add_sent('a.zip')
+        cati.start_cycle()
+        self.assertEqual(cati.get_response('a.zip'), None)
+        self.respond('a.zip;Rejected;bad name\n')
+        cati.start_cycle()
+        self.assertEqual(cati.get_response('a.zip'), ['Rejected', 'bad name'])
+
+    def test_export_unchanged(self):
+        cati.add_sent('a.zip')
+        cati.end_cycle()
+        inode = os.stat(cati.get_sent_file_path()).st_ino
+        cati.end_cycle()
+        self.assertEqual(os.stat(cati.get_sent_file_path()).st_ino, inode)
+
+    def test_import_csv(self):
+        cati.LEDGER_BACKEND = cati.CSV_BACKEND
+        cati.add_sent('a.zip')
+        cati.add_sent('b.zip')
+        self.respond('a.zip;Validated\n')
+        cati.set_done('a.zip', 'sha1')
+        cati.LEDGER_BACKEND = cati.SQLITE_BACKEND
+        cati.import_csv()
+        self.assertFalse(cati.has_sent('a.zip'))
+        self.assertTrue(cati.has_sent('b.zip'))
+        self.assertEqual(cati.get_response('a.zip'), None)
+        self.assertEqual(cati.get_delivered(['sha1']),
+                         {'sha1': ['a.zip', 'Validated']})
+
+
+class MetricsTC(CatiTC):
+
+    def setUp(self):
+        super(MetricsTC, self).setUp()
+        cati._METRICS.clear()
+
+    def test_metrics(self):
+        cati.add_sent('a.zip')
+        cati.add_sent('b.zip')
+        cati.add_sent('c.zip')
+        self.respond('a.zip;Validated\nb.zip;Rejected;bad name\n')
+        cati.set_done('a.zip')
+        cati.set_done('b.zip')
+        metrics = cati.get_metrics(lambda entries: dict(
+            (entry, 'LONDON') for entry in entries))
+        self.assertEqual((metrics['done'], metrics['pending'],
+                          metrics['waiting']), (2, 1, 1))
+        self.assertEqual(metrics['latency'], {50: 0, 90: 0, 99: 0})
+        self.assertEqual(metrics['centres'], {'LONDON': (1, 1, 0.5)})
+        self.assertEqual(len(metrics['days']), 1)
+
+    def test_missing_files(self):
+        # a workflow directory whose files are not all created yet
+        for path in (cati.get_sent_file_path(),
+                     cati.get_response_file_path(),
+                     cati.get_done_file_path(),
+                     cati.get_consumed_file_path()):
+            os.remove(path)
+        metrics = cati.get_metrics()
+        self.assertEqual((metrics['done'], metrics['pending'],
+                          metrics['waiting'], metrics['oldest']), (0, 0, 0, 0))
+        self.assertEqual(metrics['latency'], {50: None, 90: None, 99: None})
+
+    def test_missing_consumed_file(self):
+        cati.add_sent('a.zip')
+        self.respond('a.zip;Validated\n')
+        os.remove(cati.get_consumed_file_path())
+        metrics = cati.get_metrics()
+        self.assertEqual((metrics['pending'], metrics['waiting']), (1, 0))
+
+
+if __name__ == '__main__':
+    from logilab.common.testlib import unittest_main
+    unittest_main()
@@ -0,0 +1,457 @@
+# -*- coding: utf-8 -*-
+
+# Copyright (c) 2019 CEA
+#
+# This software is governed by the CeCILL license under French law and
+# abiding by the rules of distribution of free software. You can use,
+# modify and/ or redistribute the software under the terms of the CeCILL
+# license as circulated by CEA, CNRS and INRIA at the following URL
+# "http://www.cecill.info".
+#
+# As a counterpart to the access to the source code and rights to copy,
+# modify and redistribute granted by the license, users are provided only
+# with a limited warranty and the software's author, the holder of the
+# economic rights, and the successive licensors have only limited
+# liability.
+#
+# In this respect, the user's attention is drawn to the risks associated
+# with loading, using, modifying and/or developing or reproducing the
+# software by the user in light of its specific status of free software,
+# that may mean that it is complicated to manipulate, and that also
+# therefore means that it is reserved for developers and experienced
+# professionals having in-depth computer knowledge. Users are therefore
+# encouraged to load and test the software's suitability as regards their
+# requirements in conditions enabling the security of their systems and/or
+# data to be ensured and, more generally, to use and operate it in the
+# same conditions as regards security.
+#
+# The fact that you are presently reading this means that you have had
+# knowledge of the CeCILL license and that you accept its terms.
+
+""" Tests of the promotion of the uploaded files and of the checks of the
+uploads which need no CubicWeb instance.
+"""
+
+from contextlib import contextmanager
+import hashlib
+import logging
+import os
+import re
+import shutil
+import stat
+import tempfile
+import threading
+import unittest
+
+from cubes.imagen_upload import checks
+
+LOGGER = logging.getLogger('imagen_upload.test')
+
+
+class FilesTC(unittest.TestCase):
+
+    def setUp(self):
+        self.directory = tempfile.mkdtemp()
+        self.data = os.urandom(100000)
+        self.sha1hex = unicode(hashlib.sha1(self.data).hexdigest())
+        self.from_file = self.path('upload', 'a.zip')
+        with open(self.from_file, 'wb') as upload:
+            upload.write(self.data)
+
+    def tearDown(self):
+        shutil.rmtree(self.directory)
+
+    def path(self, *names):
+        path = os.path.join(self.directory, *names)
+        if not os.path.isdir(os.path.dirname(path)):
+            os.makedirs(os.path.dirname(path))
+        return path
+
+    def read(self, path):
+        with open(path, 'rb') as data:
+            return data.read()
+
+
+class TransferFileTC(FilesTC):
+
+    def test_transfer(self):
+        os.chmod(self.from_file, 0o640)
+        to_file = self.path('validated', 'a.zip')
+        sha1, size, elapsed = checks.transfer_file(
+            self.from_file, to_file, chunk_size=4096)
+        self.assertEqual((sha1, size), (self.sha1hex, len(self.data)))
+        self.assertEqual(self.read(to_file), self.data)
+        self.assertEqual(stat.S_IMODE(os.stat(to_file).st_mode), 0o640)
+        self.assertEqual(os.listdir(os.path.dirname(to_file)), ['a.zip'])
+
+    def test_expected_sha1(self):
+        to_file = self.path('validated', 'a.zip')
+        sha1, size, elapsed = checks.transfer_file(
+            self.from_file, to_file, self.sha1hex)
+        self.assertEqual(self.read(to_file), self.data)
+
+    def test_wrong_sha1(self):
+        to_file = self.path('validated', 'a.zip')
+        sha1, size, elapsed = checks.transfer_file(
+            self.from_file, to_file, u'0' * 40)
+        self.assertEqual(sha1, self.sha1hex)
+        # the copy is discarded, not renamed
+        self.assertEqual(os.listdir(os.path.dirname(to_file)), [])
+
+    def test_missing_source(self):
+        to_file = self.path('validated', 'a.zip')
+        self.assertRaises(IOError, checks.transfer_file,
+                          self.path('upload', 'missing.zip'), to_file)
+        self.assertEqual(os.listdir(os.path.dirname(to_file)), [])
+
+
+class LinkFileTC(FilesTC):
+
+    def test_hard_link(self):
+        to_file = self.path('validated', 'a.zip')
+        self.assertEqual(checks.link_file(self.from_file, to_file),
+                         'hard link')
+        self.assertEqual(os.stat(to_file).st_ino,
+                         os.stat(self.from_file).st_ino)
+        self.assertEqual(os.listdir(os.path.dirname(to_file)), ['a.zip'])
+
+    def test_replace(self):
+        to_file = self.path('validated', 'a.zip')
+        with open(to_file, 'wb') as validated:
+            validated.write(b'old')
+        checks.link_file(self.from_file, to_file)
+        self.assertEqual(self.read(to_file), self.data)
+
+
+class PromoteFileTC(FilesTC):
+
+    def test_promote(self):
+        to_file = self.path('validated', 'FU3', 'a.zip')
+        self.assertTrue(checks.promote_file(self.from_file, to_file,
+                                            self.sha1hex, LOGGER))
+        self.assertEqual(self.read(to_file), self.data)
+        # the uploaded file is a relative symlink to the validated file
+        self.assertTrue(os.path.islink(self.from_file))
+        self.assertEqual(os.readlink(self.from_file),
+                         os.path.join('..', 'validated', 'FU3', 'a.zip'))
+        self.assertEqual(self.read(self.from_file), self.data)
+
+    def test_promote_again(self):
+        to_file = self.path('validated', 'a.zip')
+        checks.promote_file(self.from_file, to_file, self.sha1hex, LOGGER)
+        self.assertTrue(checks.promote_file(self.from_file, to_file,
+                                            self.sha1hex, LOGGER))
+        self.assertEqual(self.read(to_file), self.data)
+
+
+class CASPromoteFileTC(FilesTC):
+    """ Promote files into the content-addressable store. """
+
+    def setUp(self):
+        super(CASPromoteFileTC, self).setUp()
+        self.config = (checks.CAS_DIRECTORY, checks.CAS_LINK)
+        checks.CAS_DIRECTORY = self.path('cas', 'objects')
+        checks.CAS_LINK = 'hardlink'
+        self.object_file = os.path.join(
+            checks.CAS_DIRECTORY, self.sha1hex[:2], self.sha1hex[2:])
+
+    def tearDown(self):
+        checks.CAS_DIRECTORY, checks.CAS_LINK = self.config
+        super(CASPromoteFileTC, self).tearDown()
+
+    def upload(self, name):
+        path = self.path('upload', name)
+        with open(path, 'wb') as upload:
+            upload.write(self.data)
+        return path
+
+    def test_object_path(self):
+        self.assertEqual(checks.get_object_path(self.sha1hex),
+                         self.object_file)
+
+    def test_promote(self):
+        to_file = self.path('validated', 'FU3', 'a.zip')
+        self.assertTrue(checks.promote_file(self.from_file, to_file,
+                                            self.sha1hex, LOGGER))
+        self.assertEqual(self.read(self.object_file), self.data)
+        self.assertEqual(stat.S_IMODE(os.stat(self.object_file).st_mode),
+                         0o444)
+        self.assertEqual(os.stat(to_file).st_ino,
+                         os.stat(self.object_file).st_ino)
+        self.assertEqual(os.readlink(self.from_file),
+                         os.path.join('..', 'validated', 'FU3', 'a.zip'))
+        self.assertEqual(os.listdir(os.path.dirname(to_file)), ['a.zip'])
+
+    def test_shared_content(self):
+        to_file = self.path('validated', 'FU3', 'a.zip')
+        checks.promote_file(self.from_file, to_file, self.sha1hex, LOGGER)
+        # the same content uploaded again is only linked
+        other_file = self.path('validated', 'FU2', 'b.zip')
+        self.assertTrue(checks.promote_file(self.upload('b.zip'), other_file,
+                                            self.sha1hex, LOGGER))
+        self.assertEqual(os.stat(other_file).st_ino,
+                         os.stat(self.object_file).st_ino)
+        self.assertEqual(os.stat(self.object_file).st_nlink, 3)
+        self.assertEqual(os.listdir(os.path.dirname(self.object_file)),
+                         [self.sha1hex[2:]])
+
+    def test_symlink(self):
+        checks.CAS_LINK = 'symlink'
+        to_file = self.path('validated', 'FU3', 'a.zip')
+        self.assertTrue(checks.promote_file(self.from_file, to_file,
+                                            self.sha1hex, LOGGER))
+        self.assertEqual(os.readlink(to_file), os.path.join(
+            '..', '..', 'cas', 'objects', self.sha1hex[:2],
+            self.sha1hex[2:]))
+        self.assertEqual(self.read(to_file), self.data)
+        self.assertEqual(self.read(self.from_file), self.data)
+
+    def test_promote_again(self):
+        to_file = self.path('validated', 'a.zip')
+        checks.promote_file(self.from_file, to_file, self.sha1hex, LOGGER)
+        self.assertTrue(checks.promote_file(self.from_file, to_file,
+                                            self.sha1hex, LOGGER))
+        self.assertEqual(self.read(to_file), self.data)
+
+    def test_no_sha1(self):
+        # files without SHA-1 are not stored
+        to_file = self.path('validated', 'a.zip')
+        self.assertTrue(checks.promote_file(self.from_file, to_file,
+                                            None, LOGGER))
+        self.assertFalse(os.path.exists(self.object_file))
+        self.assertEqual(self.read(to_file), self.data)
+
+
+class IdentifySequenceTC(unittest.TestCase):
+    """ Identify the members of the MRI zips, the series descriptions being
+        identified by a dictionnary instead of imagen_databank.
+    """
+
+    def setUp(self):
+        self.series_type = checks.series_type_from_description
+        checks.series_type_from_description = {
+            'DTI_NODDI': checks.SEQUENCE_NODDI,
+            'ep2d_diff_mddw': checks.SEQUENCE_DTI,
+            't2_tse': checks.SEQUENCE_T2,
+            'localizer': checks.SEQUENCE_LOCALIZER_CALIBRATION,
+        }.get
+
+    def tearDown(self):
+        checks.series_type_from_description = self.series_type
+
+    def test_series(self):
+        self.assertEqual(checks.identify_sequence('DTI_NODDI', '1.dcm'),
+                         'NODDI')
+        self.assertEqual(checks.identify_sequence('ep2d_diff_mddw', '1.dcm'),
+                         'DTI')
+        self.assertEqual(checks.identify_sequence('t2_tse', '1.dcm'), 'T2')
+
+    def test_behavioral(self):
+        for filename, directory in (('ft_000012345678.csv', 'FT'),
+                                    ('MID_000012345678.csv', 'MID'),
+                                    ('ss_000012345678.csv', 'SST'),
+                                    ('recog_000012345678.csv', 'RECOG')):
+            self.assertEqual(
+                checks.identify_sequence('Behavioural', filename), directory)
+            self.assertEqual(checks.identify_sequence(None, filename),
+                             directory)
+
+    def test_unexpected(self):
+        # the localizer is not an expected sequence of the MRI form
+        self.assertEqual(checks.identify_sequence('localizer', '1.dcm'),
+                         None)
+        self.assertEqual(checks.identify_sequence('unknown', '1.dcm'), None)
+        self.assertEqual(checks.identify_sequence(None, 'ft_1.dcm'), None)
+
+
+class FakeEntity(object):
+
+    def __init__(self, eid):
+        self.eid = eid
+
+
+class FakeConnection(object):
+    """ Connection to the CWUpload entities of a FakeRepository, whose
+        changes are applied when committed.
+    """
+
+    def __init__(self, repository):
+        self.repository = repository
+        self.changes = {}
+
+    def execute(self, rql, args=None):
+        statuses = self.repository.statuses
+        if rql.startswith('SET'):
+            self.changes[args['eid']] = 'Rejected'
+            return []
+        eids = sorted(eid for eid, status in statuses.items()
+                      if status == 'Quarantine')
+        if 'cursor' in args:
+            eids = [eid for eid in eids if eid > args['cursor']]
+        limit = re.search(r'LIMIT (\d+)', rql)
+        if limit:
+            eids = eids[:int(limit.group(1))]
+        return FakeResultSet(eids)
+
+    def entity_from_eid(self, eid):
+        return FakeEntity(eid)
+
+    def commit(self):
+        with self.repository.lock:
+            self.repository.statuses.update(self.changes)
+            self.repository.commits.append(sorted(self.changes))
+        self.changes = {}
+
+    def rollback(self):
+        self.changes = {}
+
+
+class FakeResultSet(list):
+
+    def __init__(self, eids):
+        super(FakeResultSet, self).__init__([eid] for eid in eids)
+
+    def entities(self):
+        return [FakeEntity(row[0]) for row in self]
+
+
+class FakeRepository(object):
+
+    def __init__(self, count, **config):
+        self.statuses = dict((eid, 'Quarantine')
+                             for eid in range(1, count + 1))
+        self.commits = []
+        self.lock = threading.Lock()
+        options = {'async_check_workers': 1, 'async_check_batch_size': 100,
+                   'async_check_batch_seconds': 3600}
+        options.update(config)
+        self.vreg = type('FakeRegistry', (object,), {'config': options})
+
+    @contextmanager
+    def internal_cnx(self):
+        yield FakeConnection(self)
+
+
+class ProcessUploadsTC(unittest.TestCase):
+
+    def setUp(self):
+        self.processed = []
+        self.lock = threading.Lock()
+
+    def process(self, cnx, entity):
+        """ Validate the uploads with an even eid, reject the others. """
+
+        with self.lock:
+            self.processed.append(entity.eid)
+        if entity.eid % 2:
+            raise ValueError('check failed')
+        cnx.changes[entity.eid] = 'Validated'
+
+    def test_workers(self):
+        repository = FakeRepository(10, async_check_workers=3)
+        checks.process_uploads(repository, u'MRI', self.process, LOGGER)
+        self.assertEqual(sorted(self.processed), range(1, 11))
+        # each upload is committed in its own transaction
+        self.assertEqual(sorted(repository.commits), [[eid] for eid in
+                                                      range(1, 11)])
+        self.assertEqual(repository.statuses, dict(
+            (eid, 'Rejected' if eid % 2 else 'Validated')
+            for eid in range(1, 11)))
+
+    def test_workers_eids(self):
+        repository = FakeRepository(10, async_check_workers=3)
+        checks.process_uploads(repository, u'MRI', self.process, LOGGER,
+                               set([2, 3]))
+        self.assertEqual(sorted(self.processed), [2, 3])
+        self.assertEqual(repository.statuses[4], 'Quarantine')
+
+    def test_batches(self):
+        repository = FakeRepository(5, async_check_batch_size=2)
+        checks.process_uploads(repository, u'MRI', self.process, LOGGER)
+        self.assertEqual(self.processed, [1, 2, 3, 4, 5])
+        self.assertEqual(repository.commits, [[1, 2], [3, 4], [5]])
+
+    def test_batch_seconds(self):
+        repository = FakeRepository(3, async_check_batch_seconds=0)
+        checks.process_uploads(repository, u'MRI', self.process, LOGGER)
+        self.assertEqual(repository.commits, [[1], [2], [3], []])
+
+    def test_cursor(self):
+        repository = FakeRepository(5, async_check_batch_size=2)
+        callbacks = []
+
+        def process(cnx, entity):
+            # left in Quarantine, the upload is not selected again
+            self.processed.append(entity.eid)
+            return lambda: callbacks.append(
+                (entity.eid, len(repository.commits)))
+
+        checks.process_uploads(repository, u'MRI', process, LOGGER,
+                               set([1, 4]))
+        self.assertEqual(self.processed, [1, 4])
+        # called once the transaction of the upload is committed
+        self.assertEqual(callbacks, [(1, 1), (4, 1)])
+
+
+class PreflightConnection(object):
+    """ Connection to the existing uploads, by upload key. """
+
+    def __init__(self, existing):
+        self.existing = existing
+        self.queries = []
+
+    def execute(self, rql, args):
+        self.queries.append((rql, args))
+        return [[key] for key in args.values() if key in self.existing]
+
+
+class PreflightManifestTC(unittest.TestCase):
+
+    def test_valid(self):
+        cnx = PreflightConnection(set())
+        report = checks.preflight_manifest(cnx, [
+            (u'000012345678', u'FU3', u'MRI'),
+            (u'000012345678', u'FU3', u'Cantab')])
+        self.assertEqual(report, [
+            (u'000012345678', u'FU3', u'MRI', []),
+            (u'000012345678', u'FU3', u'Cantab', [])])
+        self.assertEqual(len(cnx.queries), 1)
+
+    def test_errors(self):
+        cnx = PreflightConnection(set())
+        report = checks.preflight_manifest(cnx, [
+            (u'', u'FU3', u'MRI'),
+            (u'000012345678', u'FU3', u'EEG'),
+            (u'000012345678', u'FU2', u'MRI'),
+            (u'abc', u'FU3', u'MRI'),
+            (u'010001000001', u'FU3', u'MRI')])
+        self.assertEqual([len(errors) for sid, tid, form, errors in report],
+                         [1, 1, 1, 1, 1])
+        self.assertEqual(report[1][3], [u'Unknown form EEG.'])
+        self.assertEqual(report[2][3], [u'Unknown time point FU2.'])
+
+    def test_existing(self):
+        cnx = PreflightConnection(set([u'mri:000012345678:FU3']))
+        report = checks.preflight_manifest(cnx, [
+            (u'000012345678', u'FU3', u'MRI'),
+            (u'000012345678', u'FU3', u'Cantab')])
+        self.assertEqual(report[0][3], [u'A similar upload already exists.'])
+        self.assertEqual(report[1][3], [])
+
+    def test_repeated_row(self):
+        cnx = PreflightConnection(set([u'mri:000000000001:FU3']))
+        report = checks.preflight_manifest(cnx, [
+            (u'000000000001', u'FU3', u'MRI'),
+            (u'000000000001', u'FU3', u'mri'),
+            (u'abc', u'FU3', u'Cantab')])
+        rql, args = cnx.queries[0]
+        self.assertEqual(sorted(args.values()), [
+            u'cantab:abc:FU3', u'mri:000000000001:FU3'])
+        self.assertEqual(report[0][3], [u'A similar upload already exists.'])
+        self.assertEqual(report[1][3], [
+            u'Same upload as row 1.', u'A similar upload already exists.'])
+
+
+if __name__ == '__main__':
+    from logilab.common.testlib import unittest_main
+    unittest_main()
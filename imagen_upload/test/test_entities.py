@@ -0,0 +1,62 @@
+# -*- coding: utf-8 -*-
+
+# Copyright (c) 2019 CEA
+#
+# This software is governed by the CeCILL license under French law and
+# abiding by the rules of distribution of free software. You can use,
+# modify and/ or redistribute the software under the terms of the CeCILL
+# license as circulated by CEA, CNRS and INRIA at the following URL
+# "http://www.cecill.info".
+#
+# As a counterpart to the access to the source code and rights to copy,
+# modify and redistribute granted by the license, users are provided only
+# with a limited warranty and the software's author, the holder of the
+# economic rights, and the successive licensors have only limited
+# liability.
+#
+# In this respect, the user's attention is drawn to the risks associated
+# with loading, using, modifying and/or developing or reproducing the
+# software by the user in light of its specific status of free software,
+# that may mean that it is complicated to manipulate, and that also
+# therefore means that it is reserved for developers and experienced
+# professionals having in-depth computer knowledge. Users are therefore
+# encouraged to load and test the software's suitability as regards their
+# requirements in conditions enabling the security of their systems and/or
+# data to be ensured and, more generally, to use and operate it in the
+# same conditions as regards security.
+#
+# The fact that you are presently reading this means that you have had
+# knowledge of the CeCILL license and that you accept its terms.
+
+""" Tests of the key identifying equivalent uploads. """
+
+import unittest
+
+from cubes.imagen_upload.entities import upload_key, UPLOAD_KEY_SIZE
+
+
+class UploadKeyTC(unittest.TestCase):
+
+    def test_key(self):
+        self.assertEqual(upload_key(u'MRI', u'000012345678', u'FU3'),
+                         u'mri:000012345678:FU3')
+        self.assertEqual(upload_key(u'mri', u'000012345678', u'FU3'),
+                         upload_key(u'MRI', u'000012345678', u'FU3'))
+        self.assertNotEqual(upload_key(u'MRI', u'000012345678', u'FU3'),
+                            upload_key(u'Cantab', u'000012345678', u'FU3'))
+
+    def test_missing_value(self):
+        self.assertEqual(upload_key(u'MRI', u'', u'FU3'), None)
+        self.assertEqual(upload_key(u'MRI', u'000012345678', None), None)
+        self.assertEqual(upload_key(None, u'000012345678', u'FU3'), None)
+
+    def test_too_long(self):
+        sid = u'0' * (UPLOAD_KEY_SIZE - len(u'mri::FU3'))
+        self.assertEqual(len(upload_key(u'MRI', sid, u'FU3')),
+                         UPLOAD_KEY_SIZE)
+        self.assertEqual(upload_key(u'MRI', sid + u'0', u'FU3'), None)
+
+
+if __name__ == '__main__':
+    from logilab.common.testlib import unittest_main
+    unittest_main()
@@ -0,0 +1,106 @@
+# -*- coding: utf-8 -*-
+
+# Copyright (c) 2019 CEA
+#
+# This software is governed by the CeCILL license under French law and
+# abiding by the rules of distribution of free software. You can use,
+# modify and/ or redistribute the software under the terms of the CeCILL
+# license as circulated by CEA, CNRS and INRIA at the following URL
+# "http://www.cecill.info".
+#
+# As a counterpart to the access to the source code and rights to copy,
+# modify and redistribute granted by the license, users are provided only
+# with a limited warranty and the software's author, the holder of the
+# economic rights, and the successive licensors have only limited
+# liability.
+#
+# In this respect, the user's attention is drawn to the risks associated
+# with loading, using, modifying and/or developing or reproducing the
+# software by the user in light of its specific status of free software,
+# that may mean that it is complicated to manipulate, and that also
+# therefore means that it is reserved for developers and experienced
+# professionals having in-depth computer knowledge. Users are therefore
+# encouraged to load and test the software's suitability as regards their
+# requirements in conditions enabling the security of their systems and/or
+# data to be ensured and, more generally, to use and operate it in the
+# same conditions as regards security.
+#
+# The fact that you are presently reading this means that you have had
+# knowledge of the CeCILL license and that you accept its terms.
+
+""" Tests of the structured errors of the uploads. """
+
+from collections import namedtuple
+import unittest
+
+from cubes.imagen_upload import errors
+
+SanityError = namedtuple('SanityError', ['message', 'path', 'sample'])
+
+
+class ErrorsTC(unittest.TestCase):
+
+    def test_error_record(self):
+        self.assertEqual(errors.error_record(errors.SID_MALFORMED),
+                         {u'code': u'sid'})
+        self.assertEqual(errors.error_record(errors.INCONSISTENT_PREFIX,
+                                             sid=u'010001000001', tid=u''),
+                         {u'code': u'prefix', 'sid': u'010001000001'})
+
+    def test_sanity_records(self):
+        records = errors.sanity_records(
+            [SanityError(u'1234: bad line', u'/upload/1234', None),
+             SanityError(u'bad header', u'1234/header.csv', u'x' * 100)],
+            u'a.csv', u'a_<PSC1>.csv', u'/upload/1234')
+        self.assertEqual(records[0], {
+            u'code': errors.SANITY_ERROR, 'file': u'a.csv',
+            'pattern': u'a_<PSC1>.csv', 'message': u'a.csv: bad line'})
+        self.assertEqual(records[1]['path'], u'a.csv/header.csv')
+        self.assertEqual(len(records[1]['sample']),
+                         errors.SAMPLE_LENGTH + 3)
+
+    def test_dumps_loads(self):
+        self.assertEqual(errors.dumps([]), None)
+        records = [errors.error_record(errors.SID_MALFORMED)]
+        self.assertEqual(errors.dumps(records), u'[{"code":"sid"}]')
+        self.assertEqual(errors.loads(errors.dumps(records)), records)
+        self.assertEqual(errors.loads(u'<dl>legacy</dl>'), None)
+        self.assertEqual(errors.loads(None), None)
+
+    def test_to_html(self):
+        html = errors.to_html([
+            errors.error_record(errors.INCONSISTENT_PREFIX,
+                                sid=u'010001000001', tid=u'FU3'),
+            errors.error_record(errors.SANITY_ERROR, file=u'a.csv',
+                                pattern=u'a_<PSC1>.csv', message=u'one'),
+            errors.error_record(errors.SANITY_ERROR, file=u'a.csv',
+                                pattern=u'a_<PSC1>.csv', message=u'two',
+                                path=u'x', sample=u'<s>'),
+            errors.error_record(errors.SANITY_ERROR, file=u'b.csv',
+                                message=u'three'),
+        ])
+        self.assertEqual(html, (
+            u'<dl><dt>PSC1 code 010001000001</dt>'
+            u'<dd>PSC1 codes starting with 010001'
+            u' cannot be used with time point FU3</dd></dl>'
+            u'<dl><dt>File a.csv [a_&lt;PSC1&gt;.csv]</dt>'
+            u'<dd>one</dd><dd>two [x] [&lt;s&gt;]</dd></dl>'
+            u'<dl><dt>File b.csv []</dt><dd>three</dd></dl>'))
+
+    def test_escape(self):
+        html = errors.to_html([errors.error_record(
+            errors.CATI_REJECTED, message=u'<script>')])
+        self.assertNotIn(u'<script>', html)
+        self.assertIn(u'&lt;script&gt;', html)
+
+    def test_render(self):
+        self.assertEqual(errors.render(u'<dl>legacy</dl>'), u'<dl>legacy</dl>')
+        self.assertEqual(errors.render(None), u'')
+        self.assertEqual(
+            errors.render(errors.dumps([errors.error_record(u'unknown')])),
+            u'<dl><dt>unknown</dt></dl>')
+
+
+if __name__ == '__main__':
+    from logilab.common.testlib import unittest_main
+    unittest_main()
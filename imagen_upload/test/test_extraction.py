@@ -0,0 +1,189 @@
+# -*- coding: utf-8 -*-
+
+# Copyright (c) 2019 CEA
+#
+# This software is governed by the CeCILL license under French law and
+# abiding by the rules of distribution of free software. You can use,
+# modify and/ or redistribute the software under the terms of the CeCILL
+# license as circulated by CEA, CNRS and INRIA at the following URL
+# "http://www.cecill.info".
+#
+# As a counterpart to the access to the source code and rights to copy,
+# modify and redistribute granted by the license, users are provided only
+# with a limited warranty and the software's author, the holder of the
+# economic rights, and the successive licensors have only limited
+# liability.
+#
+# In this respect, the user's attention is drawn to the risks associated
+# with loading, using, modifying and/or developing or reproducing the
+# software by the user in light of its specific status of free software,
+# that may mean that it is complicated to manipulate, and that also
+# therefore means that it is reserved for developers and experienced
+# professionals having in-depth computer knowledge. Users are therefore
+# encouraged to load and test the software's suitability as regards their
+# requirements in conditions enabling the security of their systems and/or
+# data to be ensured and, more generally, to use and operate it in the
+# same conditions as regards security.
+#
+# The fact that you are presently reading this means that you have had
+# knowledge of the CeCILL license and that you accept its terms.
+
+""" Tests of the extraction of the validated MRI zips. """
+
+import json
+import logging
+import os
+import shutil
+import tempfile
+import unittest
+import zipfile
+
+from cubes.imagen_upload import extraction
+
+
+# sequence directories of the series directories, as configured by checks
+SERIES = {
+    'T2_FLAIR': 'FLAIR',
+    't2_tse': 'T2',
+    'ep2d_stop_signal': 'SST',
+}
+
+
+def identify(series, filename):
+    if filename.startswith('ft_'):
+        return 'FT'
+    return SERIES.get(series)
+
+
+class ClassifyTC(unittest.TestCase):
+
+    def setUp(self):
+        extraction.IDENTIFY = identify
+
+    def tearDown(self):
+        extraction.IDENTIFY = None
+
+    def test_sequence(self):
+        self.assertEqual(extraction.classify('a/T2_FLAIR/1.dcm'),
+                         ('FLAIR', 'a/T2_FLAIR/1.dcm'))
+        self.assertEqual(extraction.classify('a/t2_tse/1.dcm'),
+                         ('T2', 'a/t2_tse/1.dcm'))
+        self.assertEqual(extraction.classify('a/b/ep2d_stop_signal/1.dcm'),
+                         ('SST', 'a/b/ep2d_stop_signal/1.dcm'))
+
+    def test_file_name(self):
+        self.assertEqual(extraction.classify('a/behavioural/ft_1.csv'),
+                         ('FT', 'a/behavioural/ft_1.csv'))
+        self.assertEqual(extraction.classify('ft_1.csv'), ('FT', 'ft_1.csv'))
+
+    def test_other(self):
+        self.assertEqual(extraction.classify('a/localizer/1.dcm'),
+                         (extraction.OTHER, 'a/localizer/1.dcm'))
+        extraction.IDENTIFY = None
+        self.assertEqual(extraction.classify('a/t2_tse/1.dcm'),
+                         (extraction.OTHER, 'a/t2_tse/1.dcm'))
+
+    def test_full_path(self):
+        self.assertNotEqual(extraction.classify('a/1/Series1/1.dcm'),
+                            extraction.classify('a/2/Series1/1.dcm'))
+        self.assertEqual(extraction.classify('/a/../b/./t2_tse/1.dcm'),
+                         ('T2', 'a/b/t2_tse/1.dcm'))
+
+
+class ExtractionTC(unittest.TestCase):
+
+    def setUp(self):
+        self.directory = tempfile.mkdtemp()
+        extraction.LOGGER = logging.getLogger('imagen_upload.test')
+        extraction.IDENTIFY = identify
+        self.root = os.path.join(self.directory, 'extracted')
+        self.zip_path = os.path.join(self.directory, 'a.zip')
+        self.write_zip({'a/1/Series1/1.dcm': b'one',
+                        'a/2/Series1/1.dcm': b'two',
+                        'a/t2_tse/1.dcm': b't2'})
+        self.job = extraction.Job(self.zip_path,
+                                  os.path.join(self.root, 'FU3', 'a'),
+                                  'FU3;LONDON;a.zip')
+
+    def tearDown(self):
+        extraction.IDENTIFY = None
+        shutil.rmtree(self.directory)
+
+    def write_zip(self, members):
+        with zipfile.ZipFile(self.zip_path, 'w') as archive:
+            for name, data in sorted(members.items()):
+                archive.writestr(name, data)
+
+    def read(self, *path):
+        with open(os.path.join(self.job.destination, *path), 'rb') as data:
+            return data.read()
+
+    def index(self):
+        with open(os.path.join(self.root, extraction.INDEX_FILE)) as index:
+            return index.read().splitlines()
+
+    def pending(self):
+        with open(os.path.join(self.root, extraction.PENDING_FILE)) as pending:
+            return json.load(pending)
+
+    def test_extract(self):
+        self.assertEqual(extraction.extract_all(self.root, [self.job]), [])
+        self.assertEqual(self.read('Other', 'a', '1', 'Series1', '1.dcm'),
+                         b'one')
+        self.assertEqual(self.read('Other', 'a', '2', 'Series1', '1.dcm'),
+                         b'two')
+        self.assertEqual(self.read('T2', 'a', 't2_tse', '1.dcm'), b't2')
+        manifest = json.loads(self.read(extraction.MANIFEST_FILE).decode())
+        self.assertEqual(len(manifest), 3)
+        self.assertEqual(self.index(),
+                         ['FU3;LONDON;a.zip;FU3/a;Other:2,T2:1'])
+        self.assertEqual(self.pending(), [])
+
+    def test_extract_again(self):
+        extraction.extract_all(self.root, [self.job])
+        # same size, other content
+        self.write_zip({'a/1/Series1/1.dcm': b'eno',
+                        'a/2/Series1/1.dcm': b'two',
+                        'a/t2_tse/1.dcm': b't2'})
+        extraction.extract_all(self.root, [self.job])
+        self.assertEqual(self.read('Other', 'a', '1', 'Series1', '1.dcm'),
+                         b'eno')
+        self.assertEqual(len(self.index()), 1)
+
+    def test_unsafe_member(self):
+        self.write_zip({'../../evil.dcm': b'evil', 'a/t2_tse/1.dcm': b't2'})
+        extraction.extract_all(self.root, [self.job])
+        self.assertEqual(self.read('Other', 'evil.dcm'), b'evil')
+        self.assertFalse(os.path.exists(
+            os.path.join(self.directory, 'evil.dcm')))
+
+    def test_failed_job_pending(self):
+        missing = extraction.Job(os.path.join(self.directory, 'missing.zip'),
+                                 os.path.join(self.root, 'FU3', 'missing'),
+                                 'FU3;LONDON;missing.zip')
+        failed = extraction.extract_all(self.root, [self.job, missing])
+        self.assertEqual(failed, [missing])
+        self.assertEqual([extraction.Job(*job) for job in self.pending()],
+                         [missing])
+        self.assertEqual(len(self.index()), 1)
+        # retried by the next extraction
+        self.write_zip({'b/t2_tse/1.dcm': b't2'})
+        shutil.copy(self.zip_path, missing.zip_path)
+        self.assertEqual(extraction.extract_all(self.root, []), [])
+        self.assertEqual(self.pending(), [])
+        self.assertEqual(len(self.index()), 2)
+
+    def test_extraction_in_progress(self):
+        os.makedirs(self.root)
+        with extraction._lock(self.root, extraction.EXTRACTION_LOCK_FILE):
+            self.assertEqual(extraction.extract_all(self.root, [self.job]),
+                             [])
+        self.assertEqual([extraction.Job(*job) for job in self.pending()],
+                         [self.job])
+        extraction.extract_all(self.root, [])
+        self.assertEqual(self.pending(), [])
+
+
+if __name__ == '__main__':
+    from logilab.common.testlib import unittest_main
+    unittest_main()
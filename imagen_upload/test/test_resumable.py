@@ -0,0 +1,163 @@
+# -*- coding: utf-8 -*-
+
+# Copyright (c) 2019 CEA
+#
+# This software is governed by the CeCILL license under French law and
+# abiding by the rules of distribution of free software. You can use,
+# modify and/ or redistribute the software under the terms of the CeCILL
+# license as circulated by CEA, CNRS and INRIA at the following URL
+# "http://www.cecill.info".
+#
+# As a counterpart to the access to the source code and rights to copy,
+# modify and redistribute granted by the license, users are provided only
+# with a limited warranty and the software's author, the holder of the
+# economic rights, and the successive licensors have only limited
+# liability.
+#
+# In this respect, the user's attention is drawn to the risks associated
+# with loading, using, modifying and/or developing or reproducing the
+# software by the user in light of its specific status of free software,
+# that may mean that it is complicated to manipulate, and that also
+# therefore means that it is reserved for developers and experienced
+# professionals having in-depth computer knowledge. Users are therefore
+# encouraged to load and test the software's suitability as regards their
+# requirements in conditions enabling the security of their systems and/or
+# data to be ensured and, more generally, to use and operate it in the
+# same conditions as regards security.
+#
+# The fact that you are presently reading this means that you have had
+# knowledge of the CeCILL license and that you accept its terms.
+
+""" Tests of the assembly of the resumable uploads sent in chunks. """
+
+import hashlib
+import io
+import logging
+import os
+import shutil
+import tempfile
+import time
+import unittest
+
+from cubes.imagen_upload import resumable
+
+
+class ResumableTC(unittest.TestCase):
+
+    def setUp(self):
+        self.directory = tempfile.mkdtemp()
+        resumable.LOGGER = logging.getLogger('imagen_upload.test')
+        resumable.DIRECTORY = self.directory
+        resumable.MAX_SIZE = 0
+        self.metadata = {'filename': 'a.zip', 'batch': 'b1'}
+
+    def tearDown(self):
+        shutil.rmtree(self.directory)
+
+    def append(self, uid, offset, data, login='user'):
+        return resumable.append(uid, offset, io.BytesIO(data), login)
+
+    def assertStatus(self, status, function, *args):
+        try:
+            function(*args)
+        except resumable.ResumableError as e:
+            self.assertEqual(e.status, status)
+        else:
+            self.fail('ResumableError not raised')
+
+    def test_create(self):
+        uid = resumable.create(10, self.metadata, 'user')
+        info = resumable.get_info(uid, 'user')
+        self.assertEqual(info['offset'], 0)
+        self.assertEqual(info['length'], 10)
+        self.assertEqual(info['path'], None)
+        self.assertStatus(404, resumable.get_info, uid, 'other')
+        self.assertStatus(404, resumable.get_info, '../' + uid)
+        resumable.MAX_SIZE = 5
+        self.assertStatus(413, resumable.create, 10, self.metadata, 'user')
+
+    def test_append(self):
+        uid = resumable.create(10, self.metadata, 'user')
+        info = self.append(uid, 0, b'01234')
+        self.assertEqual((info['offset'], info['path']), (5, None))
+        self.assertStatus(409, self.append, uid, 3, b'34')
+        self.assertStatus(413, self.append, uid, 5, b'56789x')
+        info = self.append(uid, 5, b'56789')
+        self.assertEqual(info['offset'], 10)
+        self.assertEqual(info['sha1'], hashlib.sha1(b'0123456789').hexdigest())
+        with open(info['path'], 'rb') as complete:
+            self.assertEqual(complete.read(), b'0123456789')
+        self.assertEqual(os.path.basename(info['path']), 'a.zip')
+        self.assertFalse(os.path.exists(resumable._path(uid, '.part')))
+
+    def test_sha1_computed_again(self):
+        uid = resumable.create(10, self.metadata, 'user')
+        self.append(uid, 0, b'01234')
+        # the previous chunk was received by another process
+        resumable._HASHES.clear()
+        info = self.append(uid, 5, b'56789')
+        self.assertEqual(info['sha1'], hashlib.sha1(b'0123456789').hexdigest())
+
+    def test_append_complete(self):
+        uid = resumable.create(2, self.metadata, 'user')
+        self.append(uid, 0, b'01')
+        self.assertStatus(409, self.append, uid, 0, b'01')
+        self.assertFalse(os.path.exists(resumable._path(uid, '.part')))
+        # an empty chunk at the end is accepted to retry the hand off
+        info = self.append(uid, 2, b'')
+        self.assertEqual(info['offset'], 2)
+        self.assertStatus(413, self.append, uid, 2, b'2')
+
+    def test_get_batch(self):
+        first = resumable.create(1, self.metadata, 'user')
+        second = resumable.create(1, self.metadata, 'user')
+        resumable.create(1, {'filename': 'c', 'batch': 'b2'}, 'user')
+        self.append(first, 0, b'a')
+        self.assertEqual([uid for uid, info in resumable.get_batch(
+            'b1', 'user')], [first])
+        self.append(second, 0, b'b')
+        self.assertEqual(sorted(uid for uid, info in resumable.get_batch(
+            'b1', 'user')), sorted([first, second]))
+        self.assertEqual(resumable.get_batch('b1', 'other'), [])
+
+    def test_claim_batch(self):
+        with resumable.claim_batch('b1', 'user') as claimed:
+            self.assertTrue(claimed)
+            with resumable.claim_batch('b1', 'user') as again:
+                self.assertFalse(again)
+            with resumable.claim_batch('b1', 'other') as other:
+                self.assertTrue(other)
+        with resumable.claim_batch('b1', 'user') as claimed:
+            self.assertTrue(claimed)
+
+    def test_remove(self):
+        uid = resumable.create(1, self.metadata, 'user')
+        path = self.append(uid, 0, b'a')['path']
+        resumable.remove(uid, keep_file=True)
+        self.assertStatus(404, resumable.get_info, uid)
+        self.assertTrue(os.path.exists(path))
+        resumable.remove(uid)
+        self.assertFalse(os.path.exists(path))
+
+    def test_expire(self):
+        incomplete = resumable.create(10, self.metadata, 'user')
+        handed_off = resumable.create(1, self.metadata, 'user')
+        path = self.append(handed_off, 0, b'a')['path']
+        resumable.set_handed_off(handed_off)
+        complete = resumable.create(1, self.metadata, 'user')
+        complete_path = self.append(complete, 0, b'a')['path']
+        old = time.time() - 7200
+        for name in os.listdir(self.directory):
+            os.utime(os.path.join(self.directory, name), (old, old))
+        recent = resumable.create(10, self.metadata, 'user')
+        self.assertEqual(resumable.expire(3600), 3)
+        for uid in (incomplete, handed_off, complete):
+            self.assertStatus(404, resumable.get_info, uid)
+        self.assertEqual(resumable.get_info(recent)['offset'], 0)
+        self.assertTrue(os.path.exists(path))
+        self.assertFalse(os.path.exists(complete_path))
+
+
+if __name__ == '__main__':
+    from logilab.common.testlib import unittest_main
+    unittest_main()
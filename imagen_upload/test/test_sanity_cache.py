@@ -0,0 +1,133 @@
+# -*- coding: utf-8 -*-
+
+# Copyright (c) 2019 CEA
+#
+# This software is governed by the CeCILL license under French law and
+# abiding by the rules of distribution of free software. You can use,
+# modify and/ or redistribute the software under the terms of the CeCILL
+# license as circulated by CEA, CNRS and INRIA at the following URL
+# "http://www.cecill.info".
+#
+# As a counterpart to the access to the source code and rights to copy,
+# modify and redistribute granted by the license, users are provided only
+# with a limited warranty and the software's author, the holder of the
+# economic rights, and the successive licensors have only limited
+# liability.
+#
+# In this respect, the user's attention is drawn to the risks associated
+# with loading, using, modifying and/or developing or reproducing the
+# software by the user in light of its specific status of free software,
+# that may mean that it is complicated to manipulate, and that also
+# therefore means that it is reserved for developers and experienced
+# professionals having in-depth computer knowledge. Users are therefore
+# encouraged to load and test the software's suitability as regards their
+# requirements in conditions enabling the security of their systems and/or
+# data to be ensured and, more generally, to use and operate it in the
+# same conditions as regards security.
+#
+# The fact that you are presently reading this means that you have had
+# knowledge of the CeCILL license and that you accept its terms.
+
+""" Tests of the persistent cache of the content sanity checks. """
+
+import logging
+import os
+import shutil
+import sqlite3
+import tempfile
+import unittest
+
+from cubes.imagen_upload import sanity_cache
+from cubes.imagen_upload.sanity_cache import SanityError
+
+
+class FakeTime(object):
+
+    def __init__(self):
+        self.now = 1000.0
+
+    def time(self):
+        self.now += 1
+        return self.now
+
+
+class SanityCacheTC(unittest.TestCase):
+
+    def setUp(self):
+        self.directory = tempfile.mkdtemp()
+        sanity_cache.LOGGER = logging.getLogger('imagen_upload.test')
+        sanity_cache.CACHE_FILE = os.path.join(self.directory, 'cache.db')
+        sanity_cache.CACHE_SIZE = 10000
+        self.real_time = sanity_cache.time
+        sanity_cache.time = FakeTime()
+        self.calls = []
+
+    def tearDown(self):
+        sanity_cache.time = self.real_time
+        sanity_cache.CACHE_FILE = None
+        shutil.rmtree(self.directory)
+
+    def check(self, filepath, tid, sid):
+        """ Check returning an error on the file path and a sample. """
+
+        self.calls.append(filepath)
+        return sid, [SanityError(
+            u'{}: wrong subject {}'.format(os.path.basename(filepath), sid),
+            filepath, [1, u'a'])]
+
+    def test_round_trip(self):
+        psc1, errors = sanity_cache.cached_check(
+            self.check, 'sha1', '/upload/1/a.csv', 'FU3', '000012345678')
+        self.assertEqual(psc1, '000012345678')
+        psc1, cached = sanity_cache.cached_check(
+            self.check, 'sha1', '/upload/2/b.csv', 'FU3', '000012345678')
+        self.assertEqual(self.calls, ['/upload/1/a.csv'])
+        self.assertEqual(psc1, None)
+        # the file path of the new upload is used
+        self.assertEqual(cached[0].message,
+                         u'b.csv: wrong subject 000012345678')
+        self.assertEqual(cached[0].path, u'/upload/2/b.csv')
+        self.assertEqual(repr(cached[0].sample), repr([1, u'a']))
+
+    def test_key(self):
+        sanity_cache.cached_check(self.check, 'sha1', '/a', 'FU3', '1')
+        sanity_cache.cached_check(self.check, 'sha1', '/a', 'FU3', '2')
+        sanity_cache.cached_check(self.check, 'other', '/a', 'FU3', '1')
+        self.assertEqual(len(self.calls), 3)
+        sanity_cache.CACHE_FILE = None
+        sanity_cache.cached_check(self.check, 'sha1', '/a', 'FU3', '1')
+        self.assertEqual(len(self.calls), 4)
+
+    def test_eviction(self):
+        sanity_cache.CACHE_SIZE = 2
+        for sha1 in ('a', 'b'):
+            sanity_cache.cached_check(self.check, sha1, '/a', 'FU3', '1')
+        # 'a' used more recently than 'b'
+        sanity_cache.cached_check(self.check, 'a', '/a', 'FU3', '1')
+        sanity_cache.cached_check(self.check, 'c', '/a', 'FU3', '1')
+        cached = [
+            sanity_cache.get(sanity_cache.get_key(self.check, sha1,
+                                                  ('FU3', '1')), '/a')
+            is not None
+            for sha1 in ('a', 'b', 'c')]
+        self.assertEqual(cached, [True, False, True])
+
+    def test_not_serializable(self):
+        key = sanity_cache.get_key(self.check, 'sha1', ('FU3', '1'))
+        sanity_cache.put(key, '/a', [SanityError(object(), '/a', None)])
+        self.assertEqual(sanity_cache.get(key, '/a'), None)
+
+    def test_earlier_version(self):
+        key = sanity_cache.get_key(self.check, 'sha1', ('FU3', '1'))
+        sanity_cache.put(key, '/a', [])
+        cnx = sqlite3.connect(sanity_cache.CACHE_FILE)
+        cnx.execute("UPDATE results SET errors = ?",
+                    (sqlite3.Binary(b'\x80\x02]q\x00.'),))
+        cnx.commit()
+        cnx.close()
+        self.assertEqual(sanity_cache.get(key, '/a'), None)
+
+
+if __name__ == '__main__':
+    from logilab.common.testlib import unittest_main
+    unittest_main()
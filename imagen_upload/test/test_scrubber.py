@@ -0,0 +1,152 @@
+# -*- coding: utf-8 -*-
+
+# Copyright (c) 2019 CEA
+#
+# This software is governed by the CeCILL license under French law and
+# abiding by the rules of distribution of free software. You can use,
+# modify and/ or redistribute the software under the terms of the CeCILL
+# license as circulated by CEA, CNRS and INRIA at the following URL
+# "http://www.cecill.info".
+#
+# As a counterpart to the access to the source code and rights to copy,
+# modify and redistribute granted by the license, users are provided only
+# with a limited warranty and the software's author, the holder of the
+# economic rights, and the successive licensors have only limited
+# liability.
+#
+# In this respect, the user's attention is drawn to the risks associated
+# with loading, using, modifying and/or developing or reproducing the
+# software by the user in light of its specific status of free software,
+# that may mean that it is complicated to manipulate, and that also
+# therefore means that it is reserved for developers and experienced
+# professionals having in-depth computer knowledge. Users are therefore
+# encouraged to load and test the software's suitability as regards their
+# requirements in conditions enabling the security of their systems and/or
+# data to be ensured and, more generally, to use and operate it in the
+# same conditions as regards security.
+#
+# The fact that you are presently reading this means that you have had
+# knowledge of the CeCILL license and that you accept its terms.
+
+""" Tests of the incremental integrity scrubber. """
+
+import hashlib
+import logging
+import os
+import shutil
+import tempfile
+import unittest
+
+from cubes.imagen_upload import scrubber
+from cubes.imagen_upload.transport import RateLimiter
+
+
+class ScrubberTC(unittest.TestCase):
+    """ Scrub 5 files of 100 bytes, with cursors 1 to 5. """
+
+    def setUp(self):
+        self.tmpdir = tempfile.mkdtemp()
+        self.config = (scrubber.LOGGER, scrubber.STATE_FILE,
+                       scrubber.PERIOD)
+        scrubber.LOGGER = logging.getLogger('imagen_upload.test')
+        scrubber.STATE_FILE = os.path.join(self.tmpdir, 'scrub.sqlite')
+        self.files = []
+        for cursor in range(1, 6):
+            path = os.path.join(self.tmpdir, '{}.zip'.format(cursor))
+            data = os.urandom(100)
+            with open(path, 'wb') as f:
+                f.write(data)
+            self.files.append((cursor, path, hashlib.sha1(data).hexdigest()))
+        self.queries = []
+
+    def tearDown(self):
+        (scrubber.LOGGER, scrubber.STATE_FILE,
+         scrubber.PERIOD) = self.config
+        shutil.rmtree(self.tmpdir)
+
+    def get_files(self, cursor):
+        """ Files after cursor, two at a time. """
+
+        self.queries.append(cursor)
+        return [f for f in self.files if f[0] > cursor][:2]
+
+    def cursor(self):
+        cnx = scrubber._connect()
+        try:
+            return scrubber.get_cursor(cnx, 'validated')
+        finally:
+            cnx.close()
+
+    def verify(self, index):
+        cnx = scrubber._connect()
+        try:
+            return scrubber.verify_file(cnx, self.files[index][1],
+                                        self.files[index][2], RateLimiter())
+        finally:
+            cnx.close()
+
+    def test_verify_file(self):
+        self.assertEqual(self.verify(0), (scrubber.OK, 100))
+        # an unchanged file is not read again before PERIOD
+        self.assertEqual(self.verify(0), (scrubber.OK, 0))
+        scrubber.PERIOD = -1
+        self.assertEqual(self.verify(0), (scrubber.OK, 100))
+
+    def test_corrupted(self):
+        self.assertEqual(self.verify(0), (scrubber.OK, 100))
+        with open(self.files[0][1], 'r+b') as f:
+            f.write(b'x' * 10)
+        self.assertEqual(self.verify(0), (scrubber.CORRUPTED, 100))
+
+    def test_missing(self):
+        os.remove(self.files[0][1])
+        self.assertEqual(self.verify(0), (scrubber.MISSING, 0))
+
+    def test_slice_bytes(self):
+        self.assertEqual(scrubber.scrub('validated', self.get_files, 250),
+                         [])
+        self.assertEqual(self.cursor(), 3)
+        scrubber.scrub('validated', self.get_files, 250)
+        self.assertEqual(self.queries, [0, 2, 3, 5])
+        # back to the first file after the last one
+        self.assertEqual(self.cursor(), 0)
+
+    def test_slice_files(self):
+        # unchanged files read no bytes but count in the slice
+        scrubber.scrub('validated', self.get_files, 10 ** 6)
+        self.assertEqual(self.cursor(), 0)
+        self.queries = []
+        scrubber.scrub('validated', self.get_files, 10 ** 6, 3)
+        self.assertEqual(self.queries, [0, 2])
+        self.assertEqual(self.cursor(), 3)
+        scrubber.scrub('validated', self.get_files, 10 ** 6, 3)
+        self.assertEqual(self.queries, [0, 2, 3, 5])
+        self.assertEqual(self.cursor(), 0)
+
+    def test_failures(self):
+        os.remove(self.files[1][1])
+        with open(self.files[3][1], 'ab') as f:
+            f.write(b'x')
+        failures = scrubber.scrub('validated', self.get_files, 10 ** 6)
+        self.assertEqual(failures, [(self.files[1][1], scrubber.MISSING),
+                                    (self.files[3][1], scrubber.CORRUPTED)])
+
+    def test_cursors(self):
+        scrubber.scrub('validated', self.get_files, 150)
+        self.assertEqual(self.cursor(), 2)
+        cnx = scrubber._connect()
+        try:
+            self.assertEqual(scrubber.get_cursor(cnx, 'other'), 0)
+        finally:
+            cnx.close()
+
+    def test_disabled(self):
+        scrubber.STATE_FILE = None
+        self.assertEqual(scrubber.scrub('validated', self.get_files, 150),
+                         [])
+        self.assertEqual(self.queries, [])
+
+
+if __name__ == '__main__':
+    from logilab.common.testlib import unittest_main
+    unittest_main()
@@ -0,0 +1,351 @@
+# -*- coding: utf-8 -*-
+
+# Copyright (c) 2019 CEA
+#
+# This software is governed by the CeCILL license under French law and
+# abiding by the rules of distribution of free software. You can use,
+# modify and/ or redistribute the software under the terms of the CeCILL
+# license as circulated by CEA, CNRS and INRIA at the following URL
+# "http://www.cecill.info".
+#
+# As a counterpart to the access to the source code and rights to copy,
+# modify and redistribute granted by the license, users are provided only
+# with a limited warranty and the software's author, the holder of the
+# economic rights, and the successive licensors have only limited
+# liability.
+#
+# In this respect, the user's attention is drawn to the risks associated
+# with loading, using, modifying and/or developing or reproducing the
+# software by the user in light of its specific status of free software,
+# that may mean that it is complicated to manipulate, and that also
+# therefore means that it is reserved for developers and experienced
+# professionals having in-depth computer knowledge. Users are therefore
+# encouraged to load and test the software's suitability as regards their
+# requirements in conditions enabling the security of their systems and/or
+# data to be ensured and, more generally, to use and operate it in the
+# same conditions as regards security.
+#
+# The fact that you are presently reading this means that you have had
+# knowledge of the CeCILL license and that you accept its terms.
+
+""" Tests of the resumable and verified sending of files to cati, and of
+the bandwidth limiter.
+"""
+
+import hashlib
+import os
+import shutil
+import tempfile
+import time
+import unittest
+
+from cubes.imagen_upload import transport
+
+
+class CountingTransport(transport.DirectoryTransport):
+    """ Directory transport counting the bytes written, whose checksum
+        may be replaced by digest, False for a server which cannot compute
+        it.
+    """
+
+    written = 0
+    digest = None
+
+    def append(self, name):
+        remote = super(CountingTransport, self).append(name)
+        write = remote.write
+
+        def counted(data):
+            self.written += len(data)
+            write(data)
+
+        remote.write = counted
+        return remote
+
+    def checksum(self, name):
+        if self.digest is False:
+            return None
+        if self.digest is not None:
+            return self.digest
+        return super(CountingTransport, self).checksum(name)
+
+
+class DirectoryTransportTC(unittest.TestCase):
+
+    def setUp(self):
+        self.directory = tempfile.mkdtemp()
+        self.remote = os.path.join(self.directory, 'remote')
+        os.mkdir(self.remote)
+        self.filepath = os.path.join(self.directory, 'a.zip')
+        self.data = b''.join(bytes(bytearray([i % 256]))
+                             for i in range(100))
+        with open(self.filepath, 'wb') as local:
+            local.write(self.data)
+        self.transport = CountingTransport(self.remote, chunk_size=16)
+
+    def tearDown(self):
+        shutil.rmtree(self.directory)
+
+    def read(self, name):
+        with open(os.path.join(self.remote, name), 'rb') as remote:
+            return remote.read()
+
+    def write_part(self, data):
+        with open(os.path.join(self.remote, 'a.zip.part'), 'wb') as part:
+            part.write(data)
+
+    def test_send(self):
+        digest = self.transport.send('a.zip', self.filepath,
+                                     {'sid': '000012345678', 'tid': 'FU3'})
+        self.assertEqual(self.read('a.zip'), self.data)
+        self.assertEqual(self.read('a.zip.fields'),
+                         b'sid;000012345678\ntid;FU3\n')
+        self.assertEqual(digest, hashlib.sha1(self.data).hexdigest())
+        self.assertEqual(self.read('a.zip.sha1'),
+                         '{}  a.zip\n'.format(digest).encode('ascii'))
+        self.assertEqual(sorted(os.listdir(self.remote)),
+                         ['a.zip', 'a.zip.fields', 'a.zip.sha1'])
+        self.assertEqual(self.transport.written, 100 + 25 + 48)
+
+    def test_no_remote_checksum(self):
+        # the SHA-1 is left to be verified by the cati side
+        self.transport.digest = False
+        digest = self.transport.send('a.zip', self.filepath, {})
+        self.assertEqual(self.read('a.zip'), self.data)
+        self.assertEqual(self.read('a.zip.sha1'),
+                         '{}  a.zip\n'.format(digest).encode('ascii'))
+
+    def test_send_empty(self):
+        open(self.filepath, 'wb').close()
+        self.transport.send('a.zip', self.filepath, {})
+        self.assertEqual(self.read('a.zip'), b'')
+
+    def test_resume(self):
+        self.write_part(self.data[:40])
+        self.transport.send('a.zip', self.filepath, {})
+        self.assertEqual(self.read('a.zip'), self.data)
+        self.assertEqual(self.transport.written, 60 + 48)
+
+    def test_resume_different_part(self):
+        self.write_part(self.data[:30] + b'x' * 10)
+        self.transport.send('a.zip', self.filepath, {})
+        self.assertEqual(self.read('a.zip'), self.data)
+        self.assertEqual(self.transport.written, 100 + 48)
+
+    def test_resume_longer_part(self):
+        self.write_part(self.data + b'x')
+        self.transport.send('a.zip', self.filepath, {})
+        self.assertEqual(self.read('a.zip'), self.data)
+        self.assertEqual(self.transport.written, 100 + 48)
+
+    def test_corrupted(self):
+        self.transport.digest = '0' * 40
+        self.assertRaises(transport.TransportError, self.transport.send,
+                          'a.zip', self.filepath, {})
+        self.assertEqual(os.listdir(self.remote), [])
+
+    def test_missing_directory(self):
+        shutil.rmtree(self.remote)
+        self.assertRaises(transport.TransportError, self.transport.send,
+                          'a.zip', self.filepath, {})
+
+
+class FakeFile(object):
+    """ Remote file of FakeSFTP, failing on write when the connection is
+        broken.
+    """
+
+    def __init__(self, sftp, path, mode):
+        self.sftp = sftp
+        self.file = open(path, mode)
+
+    def __enter__(self):
+        return self
+
+    def __exit__(self, *args):
+        self.close()
+
+    def seek(self, offset):
+        self.file.seek(offset)
+
+    def read(self, length):
+        return self.file.read(length)
+
+    def write(self, data):
+        if self.sftp.broken:
+            raise EOFError('connection lost')
+        self.file.write(data)
+
+    def set_pipelined(self, pipelined):
+        pass
+
+    def check(self, hash_algorithm, block_size):
+        raise IOError('check-file not supported')
+
+    def close(self):
+        self.file.close()
+
+
+class FakeSFTP(object):
+    """ SFTP client on the local file system. """
+
+    def __init__(self, broken=False):
+        self.broken = broken
+        self.closed = False
+
+    def stat(self, path):
+        try:
+            return os.stat(path)
+        except OSError as e:
+            raise IOError(e.errno, e.strerror)
+
+    def open(self, path, mode):
+        return FakeFile(self, path, mode)
+
+    def posix_rename(self, path, target):
+        os.rename(path, target)
+
+    def rename(self, path, target):
+        os.rename(path, target)
+
+    def remove(self, path):
+        os.remove(path)
+
+    def close(self):
+        self.closed = True
+
+
+class FakeClient(object):
+
+    def close(self):
+        pass
+
+
+class FakeSFTPTransport(transport.SFTPTransport):
+    """ SFTP transport whose first connections are broken. """
+
+    def __init__(self, directory, broken=0):
+        super(FakeSFTPTransport, self).__init__('localhost', directory,
+                                                chunk_size=16)
+        self.broken = broken
+        self.opened = []
+
+    def _connect(self):
+        sftp = FakeSFTP(len(self.opened) < self.broken)
+        self.opened.append(sftp)
+        return (FakeClient(), sftp)
+
+
+class SFTPTransportTC(unittest.TestCase):
+
+    def setUp(self):
+        self.tmpdir = tempfile.mkdtemp()
+        self.filepath = os.path.join(self.tmpdir, 'a.zip')
+        self.data = os.urandom(100)
+        with open(self.filepath, 'wb') as f:
+            f.write(self.data)
+        self.remote = os.path.join(self.tmpdir, 'remote')
+        os.mkdir(self.remote)
+
+    def tearDown(self):
+        shutil.rmtree(self.tmpdir)
+
+    def test_connection_kept(self):
+        sftp = FakeSFTPTransport(self.remote)
+        sftp.send('a.zip', self.filepath, {})
+        sftp.send('b.zip', self.filepath, {})
+        self.assertEqual(len(sftp.opened), 1)
+        sftp.close()
+        self.assertTrue(sftp.opened[0].closed)
+        self.assertEqual(sftp.connections, [])
+
+    def test_send_after_failure(self):
+        sftp = FakeSFTPTransport(self.remote, broken=1)
+        with self.assertRaises(EOFError):
+            sftp.send('a.zip', self.filepath, {})
+        self.assertTrue(sftp.opened[0].closed)
+        self.assertEqual(sftp.connections, [])
+        # the same transport sends again over a new connection
+        digest = sftp.send('a.zip', self.filepath, {})
+        self.assertEqual(len(sftp.opened), 2)
+        self.assertEqual(digest, hashlib.sha1(self.data).hexdigest())
+        with open(os.path.join(self.remote, 'a.zip'), 'rb') as f:
+            self.assertEqual(f.read(), self.data)
+        sftp.close()
+
+
+class FakeTime(object):
+    """ Clock of the time module, advanced by sleep. """
+
+    def __init__(self, now, hour=12):
+        self.now = now
+        self.hour = hour
+        self.sleeps = []
+
+    def time(self):
+        return self.now
+
+    def sleep(self, seconds):
+        self.sleeps.append(seconds)
+        self.now += seconds
+
+    def localtime(self):
+        return time.struct_time((2019, 1, 1, self.hour, 0, 0, 1, 1, 0))
+
+
+class RateLimiterTC(unittest.TestCase):
+
+    def setUp(self):
+        self.time = FakeTime(1000.0)
+        self.real_time = transport.time
+        transport.time = self.time
+
+    def tearDown(self):
+        transport.time = self.real_time
+
+    def test_no_limit(self):
+        limiter = transport.RateLimiter()
+        limiter.consume(10 ** 9)
+        self.assertEqual(self.time.sleeps, [])
+
+    def test_rate(self):
+        limiter = transport.RateLimiter(100)
+        # one second of unused bandwidth is available at once
+        limiter.consume(100)
+        self.assertEqual(self.time.sleeps, [])
+        limiter.consume(100)
+        limiter.consume(50)
+        self.assertEqual(self.time.sleeps, [1.0, 0.5])
+
+    def test_burst_after_idle(self):
+        limiter = transport.RateLimiter(100)
+        limiter.consume(300)
+        self.assertEqual(self.time.sleeps, [2.0])
+        self.time.now += 60
+        limiter.consume(100)
+        self.assertEqual(self.time.sleeps, [2.0])
+
+    def test_night_rate(self):
+        limiter = transport.RateLimiter(100, 0, (22, 6))
+        self.assertEqual(limiter.current_rate(), 100)
+        self.time.hour = 23
+        self.assertEqual(limiter.current_rate(), 0)
+        self.time.hour = 5
+        self.assertEqual(limiter.current_rate(), 0)
+        self.time.hour = 6
+        self.assertEqual(limiter.current_rate(), 100)
+        limiter = transport.RateLimiter(100, 200, (1, 5))
+        self.time.hour = 3
+        self.assertEqual(limiter.current_rate(), 200)
+        self.time.hour = 5
+        self.assertEqual(limiter.current_rate(), 100)
+        self.assertEqual(transport.RateLimiter(100).current_rate(), 100)
+
+    def test_parse_hours(self):
+        self.assertEqual(transport.parse_hours('22-6'), (22, 6))
+        self.assertEqual(transport.parse_hours('24-30'), (0, 6))
+
+
+if __name__ == '__main__':
+    from logilab.common.testlib import unittest_main
+    unittest_main()
@@ -0,0 +1,155 @@
+# -*- coding: utf-8 -*-
+
+# Copyright (c) 2019 CEA
+#
+# This software is governed by the CeCILL license under French law and
+# abiding by the rules of distribution of free software. You can use,
+# modify and/ or redistribute the software under the terms of the CeCILL
+# license as circulated by CEA, CNRS and INRIA at the following URL
+# "http://www.cecill.info".
+#
+# As a counterpart to the access to the source code and rights to copy,
+# modify and redistribute granted by the license, users are provided only
+# with a limited warranty and the software's author, the holder of the
+# economic rights, and the successive licensors have only limited
+# liability.
+#
+# In this respect, the user's attention is drawn to the risks associated
+# with loading, using, modifying and/or developing or reproducing the
+# software by the user in light of its specific status of free software,
+# that may mean that it is complicated to manipulate, and that also
+# therefore means that it is reserved for developers and experienced
+# professionals having in-depth computer knowledge. Users are therefore
+# encouraged to load and test the software's suitability as regards their
+# requirements in conditions enabling the security of their systems and/or
+# data to be ensured and, more generally, to use and operate it in the
+# same conditions as regards security.
+#
+# The fact that you are presently reading this means that you have had
+# knowledge of the CeCILL license and that you accept its terms.
+
+""" Tests of the watcher of the CATI response file. """
+
+import os
+import shutil
+import tempfile
+import threading
+import time
+import unittest
+
+from cubes.imagen_upload import watcher
+
+
+def event(name, mask=watcher.IN_CLOSE_WRITE):
+    """ Buffer of an inotify event, its name padded with zeros. """
+
+    name = name.encode('utf-8')
+    name += b'\0' * (16 - len(name) % 16)
+    return watcher.EVENT_HEADER.pack(1, mask, 0, len(name)) + name
+
+
+class EventNamesTC(unittest.TestCase):
+
+    def test_names(self):
+        data = event('response.csv') + event('other.csv')
+        self.assertEqual(watcher._event_names(data),
+                         ['response.csv', 'other.csv'])
+
+    def test_overflow(self):
+        data = event('') + event('', watcher.IN_Q_OVERFLOW)
+        self.assertEqual(watcher._event_names(data), ['', None])
+
+    def test_truncated(self):
+        self.assertEqual(watcher._event_names(event('a.csv')[:10]), [])
+
+
+class FileWatcherTC(unittest.TestCase):
+    """ Watch response.csv, by inotify unless polling. """
+
+    polling = False
+
+    def setUp(self):
+        self.tmpdir = tempfile.mkdtemp()
+        self.path = os.path.join(self.tmpdir, 'response.csv')
+        self.write('a;1\n')
+        self.calls = []
+        self.called = threading.Event()
+        self.inotify_fd = watcher._inotify_fd
+        if self.polling:
+            watcher._inotify_fd = lambda directory: None
+
+    def tearDown(self):
+        watcher._inotify_fd = self.inotify_fd
+        shutil.rmtree(self.tmpdir)
+
+    def write(self, data):
+        # never let the watcher parse a truncated file
+        with open(self.path + '.tmp', 'w') as f:
+            f.write(data)
+        os.rename(self.path + '.tmp', self.path)
+
+    def parse(self, path):
+        with open(path) as f:
+            return f.read()
+
+    def callback(self):
+        self.calls.append(self.parse(self.path))
+        self.called.set()
+
+    def start(self, **kwargs):
+        thread = watcher.FileWatcher(self.tmpdir, 'response.csv',
+                                     self.callback, poll_interval=0.05,
+                                     delay=0.05, **kwargs)
+        thread.start()
+        self.addCleanup(thread.join, 5)
+        self.addCleanup(thread.stop)
+        # let the thread read the initial signature
+        time.sleep(0.2)
+        return thread
+
+    def wait_call(self):
+        self.assertTrue(self.called.wait(5))
+        self.called.clear()
+
+    def test_change(self):
+        self.start()
+        self.write('a;1\nb;2\n')
+        self.wait_call()
+        self.assertEqual(self.calls, ['a;1\nb;2\n'])
+
+    def test_same_content(self):
+        self.start(parse=self.parse)
+        # a file rewritten with the same content is ignored
+        self.write('a;1\n')
+        time.sleep(0.5)
+        self.assertEqual(self.calls, [])
+        self.write('b;2\n')
+        self.wait_call()
+        self.assertEqual(self.calls, ['b;2\n'])
+
+    def test_failed_callback(self):
+        def callback():
+            self.called.set()
+            raise ValueError('failed')
+        self.callback = callback
+        self.start()
+        self.write('b;2\n')
+        self.wait_call()
+        self.write('c;3\n')
+        self.wait_call()
+
+    def test_stop(self):
+        thread = self.start()
+        thread.stop()
+        thread.join(5)
+        self.assertFalse(thread.is_alive())
+
+
+class PollingFileWatcherTC(FileWatcherTC):
+
+    polling = True
+
+
+if __name__ == '__main__':
+    from logilab.common.testlib import unittest_main
+    unittest_main()
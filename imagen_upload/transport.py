@@ -0,0 +1,492 @@
+# -*- coding: utf-8 -*-
+
+# Copyright (c) 2019 CEA
+#
+# This software is governed by the CeCILL license under French law and
+# abiding by the rules of distribution of free software. You can use,
+# modify and/ or redistribute the software under the terms of the CeCILL
+# license as circulated by CEA, CNRS and INRIA at the following URL
+# "http://www.cecill.info".
+#
+# As a counterpart to the access to the source code and rights to copy,
+# modify and redistribute granted by the license, users are provided only
+# with a limited warranty and the software's author, the holder of the
+# economic rights, and the successive licensors have only limited
+# liability.
+#
+# In this respect, the user's attention is drawn to the risks associated
+# with loading, using, modifying and/or developing or reproducing the
+# software by the user in light of its specific status of free software,
+# that may mean that it is complicated to manipulate, and that also
+# therefore means that it is reserved for developers and experienced
+# professionals having in-depth computer knowledge. Users are therefore
+# encouraged to load and test the software's suitability as regards their
+# requirements in conditions enabling the security of their systems and/or
+# data to be ensured and, more generally, to use and operate it in the
+# same conditions as regards security.
+#
+# The fact that you are presently reading this means that you have had
+# knowledge of the CeCILL license and that you accept its terms.
+
+
+
+""" Transports of the uploaded MRI files to the cati repository.
+
+A transport drops each file under its entry name in a remote directory,
+together with a '<entry>.fields' file listing the upload fields and a
+'<entry>.sha1' file giving its SHA-1 in the sha1sum format. Files are
+first written to '<entry>.part' in chunks: an interrupted transfer resumes
+from the size already written, and the file is renamed only once its size
+and, when the server can compute it, its SHA-1 have been verified.
+Otherwise the SHA-1 is left to be verified by the cati side.
+
+Transports are opened for a whole cycle of the MRI asynchronous check, so
+that a backlog of files is sent over a connection per sending thread. The
+bandwidth used by all the threads is limited by BANDWIDTH.
+"""
+
+import errno
+import hashlib
+import os
+import posixpath
+import threading
+import time
+try:
+    from urllib.parse import urlparse
+except ImportError:
+    from urlparse import urlparse
+
+LOGGER = None
+CHUNK_SIZE = 1024 * 1024
+PART_SUFFIX = '.part'
+FIELDS_SUFFIX = '.fields'
+SHA1_SUFFIX = '.sha1'
+LINE_SEP = '\n'
+COL_SEP = ';'
+
+
+##############################################################################
+class RateLimiter(object):
+    """ Bandwidth shared by the threads sending files.
+
+    Parameters:
+        rate: bytes per second, 0 for no limit
+        night_rate: bytes per second during night hours, 0 for no limit,
+                    None for the same limit as during the day
+        night_hours: (start, end) hours of the night, in local time
+    """
+
+    # seconds of unused bandwidth which can be consumed at once
+    BURST = 1.0
+
+    def __init__(self, rate=0, night_rate=None, night_hours=(22, 6)):
+        self.rate = rate
+        self.night_rate = night_rate
+        self.night_hours = night_hours
+        self.lock = threading.Lock()
+        self.available = 0.0
+
+    def current_rate(self):
+        if self.night_rate is None:
+            return self.rate
+        start, end = self.night_hours
+        hour = time.localtime().tm_hour
+        if start <= end:
+            night = start <= hour < end
+        else:
+            night = hour >= start or hour < end
+        return self.night_rate if night else self.rate
+
+    def consume(self, size):
+        """ Wait until size bytes can be sent. """
+
+        rate = self.current_rate()
+        if not rate:
+            return
+        with self.lock:
+            now = time.time()
+            self.available = (max(self.available, now - self.BURST) +
+                              float(size) / rate)
+            delay = self.available - now
+        if delay > 0:
+            time.sleep(delay)
+
+
+def parse_hours(hours):
+    """ Parse hours given as 'start-end', for instance '22-6'. """
+
+    start, end = hours.split('-')
+    return int(start) % 24, int(end) % 24
+
+
+BANDWIDTH = RateLimiter()
+
+
+##############################################################################
+class TransportError(Exception):
+    """ A file could not be sent to the cati repository. """
+
+
+##############################################################################
+class Transport(object):
+    """ Resumable and verified sending of files to a remote directory.
+
+    Subclasses implement the primitive operations on remote files.
+    """
+
+    def __init__(self, chunk_size=CHUNK_SIZE):
+        self.chunk_size = chunk_size
+
+    def open(self):
+        """ Open the connection of the current thread, if any, before
+            sending files.
+        """
+
+    def close(self):
+        """ Close all the connections, if any, after sending files. """
+
+    def reset(self):
+        """ Drop the connection of the current thread, which may have been
+            broken by an error.
+        """
+
+        self.close()
+
+    # primitive operations on the remote files
+    def size(self, name):
+        """ Size of a remote file, None if it does not exist. """
+        raise NotImplementedError
+
+    def read(self, name, offset, length):
+        raise NotImplementedError
+
+    def append(self, name):
+        """ Remote file object opened for appending binary data. """
+        raise NotImplementedError
+
+    def checksum(self, name):
+        """ SHA-1 of a remote file, None if it cannot be computed
+            remotely.
+        """
+        raise NotImplementedError
+
+    def replace(self, name, target):
+        """ Rename a remote file, replacing target if it exists. """
+        raise NotImplementedError
+
+    def remove(self, name):
+        raise NotImplementedError
+
+    ##########################################################################
+    def send(self, entry, filepath, fields):
+        """ Send a file to the remote directory.
+
+        Parameters:
+            entry: name of the remote file
+            filepath: the file to send
+            fields: dictionnary of upload fields
+
+        Return:
+            The SHA-1 of the sent file.
+        """
+
+        try:
+            self.open()
+            return self._send(entry, filepath, fields)
+        except BaseException:
+            self.reset()
+            raise
+
+    def _send(self, entry, filepath, fields):
+        part = entry + PART_SUFFIX
+        offset = self._resume_offset(part, filepath)
+        if offset and LOGGER:
+            LOGGER.info("{} resumed at byte {}".format(entry, offset))
+        sha1 = hashlib.sha1()
+        size = 0
+        with open(filepath, 'rb') as local:
+            remote = self.append(part) if offset else None
+            try:
+                for chunk in iter(lambda: local.read(self.chunk_size), b''):
+                    sha1.update(chunk)
+                    end = size + len(chunk)
+                    if end > offset:
+                        if remote is None:
+                            remote = self.append(part)
+                        data = chunk[max(offset - size, 0):]
+                        BANDWIDTH.consume(len(data))
+                        remote.write(data)
+                    size = end
+            finally:
+                if remote is not None:
+                    remote.close()
+        if size == 0:
+            # make sure an empty file is dropped too
+            self.append(part).close()
+        digest = sha1.hexdigest()
+        remote_size = self.size(part)
+        remote_digest = self.checksum(part)
+        if remote_size != size or remote_digest not in (None, digest):
+            self.remove(part)
+            raise TransportError(
+                "{} corrupted during transfer: {} bytes, SHA-1 {} instead"
+                " of {} bytes, SHA-1 {}".format(
+                    entry, remote_size, remote_digest, size, digest))
+        if remote_digest is None and LOGGER:
+            LOGGER.info("{} checked by size only, SHA-1 sent in {}".format(
+                entry, entry + SHA1_SUFFIX))
+        self._write_file(entry + SHA1_SUFFIX,
+                         u"{0}  {1}{2}".format(digest, entry, LINE_SEP))
+        self._write_file(entry + FIELDS_SUFFIX, u''.join(
+            u"{0}{1}{2}{3}".format(name, COL_SEP, value, LINE_SEP)
+            for name, value in sorted(fields.items())))
+        self.replace(part, entry)
+        return digest
+
+    def _resume_offset(self, part, filepath):
+        """ Number of bytes of a previous transfer which can be kept. """
+
+        offset = self.size(part)
+        if not offset:
+            return 0
+        if offset > os.path.getsize(filepath):
+            self.remove(part)
+            return 0
+        # compare the last chunk written with the local file
+        length = min(offset, self.chunk_size)
+        with open(filepath, 'rb') as local:
+            local.seek(offset - length)
+            expected = local.read(length)
+        if self.read(part, offset - length, length) != expected:
+            self.remove(part)
+            return 0
+        return offset
+
+    def _write_file(self, name, data):
+        """ Replace a small remote file by data. """
+
+        part = name + PART_SUFFIX
+        if self.size(part) is not None:
+            self.remove(part)
+        remote = self.append(part)
+        try:
+            remote.write(data.encode('utf-8'))
+        finally:
+            remote.close()
+        self.replace(part, name)
+
+
+##############################################################################
+class DirectoryTransport(Transport):
+    """ Drop the files in a local directory, for instance a directory
+        mounted from the cati repository or a stand-in for tests.
+    """
+
+    def __init__(self, directory, chunk_size=CHUNK_SIZE):
+        super(DirectoryTransport, self).__init__(chunk_size)
+        self.directory = directory
+
+    def open(self):
+        if not os.path.isdir(self.directory):
+            raise TransportError("{} is not a directory".format(
+                self.directory))
+
+    def close(self):
+        pass
+
+    def _path(self, name):
+        return os.path.join(self.directory, name)
+
+    def size(self, name):
+        try:
+            return os.path.getsize(self._path(name))
+        except OSError as e:
+            if e.errno == errno.ENOENT:
+                return None
+            raise
+
+    def read(self, name, offset, length):
+        with open(self._path(name), 'rb') as remote:
+            remote.seek(offset)
+            return remote.read(length)
+
+    def append(self, name):
+        return _SyncedFile(self._path(name))
+
+    def checksum(self, name):
+        sha1 = hashlib.sha1()
+        with open(self._path(name), 'rb') as remote:
+            for chunk in iter(lambda: remote.read(self.chunk_size), b''):
+                sha1.update(chunk)
+        return sha1.hexdigest()
+
+    def replace(self, name, target):
+        os.rename(self._path(name), self._path(target))
+
+    def remove(self, name):
+        os.remove(self._path(name))
+
+
+class _SyncedFile(object):
+    """ File opened for appending, flushed to disk when closed. """
+
+    def __init__(self, path):
+        self.file = open(path, 'ab')
+
+    def write(self, data):
+        self.file.write(data)
+
+    def close(self):
+        try:
+            self.file.flush()
+            os.fsync(self.file.fileno())
+        finally:
+            self.file.close()
+
+
+##############################################################################
+class SFTPTransport(Transport):
+    """ Send the files to a SFTP server, over connections kept open during
+        a cycle: one connection per thread sending files.
+
+        Requires paramiko. The server host key must be known by the system.
+    """
+
+    def __init__(self, host, directory, port=22, username=None,
+                 key_filename=None, chunk_size=CHUNK_SIZE):
+        super(SFTPTransport, self).__init__(chunk_size)
+        self.host = host
+        self.directory = directory
+        self.port = port
+        self.username = username
+        self.key_filename = key_filename
+        self.local = threading.local()
+        self.lock = threading.Lock()
+        self.connections = []
+
+    @property
+    def sftp(self):
+        return getattr(self.local, 'connection', (None, None))[1]
+
+    def open(self):
+        if self.sftp is not None:
+            return
+        connection = self._connect()
+        self.local.connection = connection
+        with self.lock:
+            self.connections.append(connection)
+        if LOGGER:
+            LOGGER.info("connected to sftp://{}:{}".format(self.host,
+                                                           self.port))
+
+    def reset(self):
+        connection = getattr(self.local, 'connection', None)
+        if connection is not None:
+            # the next send opens a new connection
+            del self.local.connection
+            with self.lock:
+                self.connections.remove(connection)
+            self._disconnect(connection)
+
+    def close(self):
+        with self.lock:
+            connections, self.connections = self.connections, []
+        # threads keep a reference to closed connections
+        self.local = threading.local()
+        for connection in connections:
+            self._disconnect(connection)
+
+    def _connect(self):
+        """ Open a new connection, a (client, sftp) tuple. """
+
+        import paramiko
+        client = paramiko.SSHClient()
+        client.load_system_host_keys()
+        client.connect(self.host, port=self.port, username=self.username,
+                       key_filename=self.key_filename)
+        try:
+            return (client, client.open_sftp())
+        except BaseException:
+            client.close()
+            raise
+
+    @staticmethod
+    def _disconnect(connection):
+        client, sftp = connection
+        try:
+            sftp.close()
+        finally:
+            client.close()
+
+    def _path(self, name):
+        return posixpath.join(self.directory, name)
+
+    def size(self, name):
+        try:
+            return self.sftp.stat(self._path(name)).st_size
+        except IOError as e:
+            if e.errno == errno.ENOENT:
+                return None
+            raise
+
+    def read(self, name, offset, length):
+        with self.sftp.open(self._path(name), 'rb') as remote:
+            remote.seek(offset)
+            return remote.read(length)
+
+    def append(self, name):
+        remote = self.sftp.open(self._path(name), 'ab')
+        # do not wait for the acknowledgement of each write
+        remote.set_pipelined(True)
+        return remote
+
+    def checksum(self, name):
+        # needs the check-file extension, seldom supported by servers
+        try:
+            with self.sftp.open(self._path(name), 'rb') as remote:
+                return _hexlify(remote.check('sha1', block_size=0))
+        except IOError:
+            return None
+
+    def replace(self, name, target):
+        try:
+            self.sftp.posix_rename(self._path(name), self._path(target))
+        except IOError:
+            # no posix-rename extension
+            if self.size(target) is not None:
+                self.remove(target)
+            self.sftp.rename(self._path(name), self._path(target))
+
+    def remove(self, name):
+        self.sftp.remove(self._path(name))
+
+
+def _hexlify(data):
+    return ''.join('{:02x}'.format(c) for c in bytearray(data))
+
+
+##############################################################################
+def get_transport(url, key_filename=None):
+    """ Return the transport to the cati repository described by an URL.
+
+    Parameters:
+        url: 'sftp://[user@]host[:port]/directory' for a SFTP server,
+             'file:///directory' or a path for a local directory,
+             empty if there is no transport
+        key_filename: private key used to connect to a SFTP server
+
+    Return:
+        A Transport instance, or None.
+    """
+
+    if not url:
+        return None
+    parsed = urlparse(url)
+    if parsed.scheme == 'sftp':
+        return SFTPTransport(parsed.hostname, parsed.path or '.',
+                             port=parsed.port or 22,
+                             username=parsed.username,
+                             key_filename=key_filename)
+    if parsed.scheme in ('', 'file'):
+        return DirectoryTransport(parsed.path)
+    raise ValueError("unsupported cati transport {}".format(url))
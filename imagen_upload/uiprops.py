@@ -32,3 +32,8 @@
 STYLESHEETS += [
     data('cubes.imagen.css')
 ]
+
+JAVASCRIPTS += [
+    data('cubes.imagen.precheck.js'),
+    data('cubes.imagen.resumable.js')
+]
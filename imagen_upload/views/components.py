@@ -98,6 +98,25 @@ class DashboardsBox(component.CtxComponent):
         w(u'My dashboard</a>')
         w(u'</div></div><br/>')
 
+        # pre-flight check of a manifest of planned uploads
+        href = self._cw.build_url("view", vid="preflight-view")
+        w(u'<div class="btn-toolbar">')
+        w(u'<div class="btn-group-vertical btn-block">')
+        w(u'<a class="btn btn-primary" href="{0}">'.format(href))
+        w(u'<span class="glyphicon glyphicon glyphicon-check"></span>')
+        w(u'Pre-flight check</a>')
+        w(u'</div></div><br/>')
+
+        # metrics of the cati workflow
+        if self._cw.user.is_in_group("managers"):
+            href = self._cw.build_url("view", vid="cati-metrics-view")
+            w(u'<div class="btn-toolbar">')
+            w(u'<div class="btn-group-vertical btn-block">')
+            w(u'<a class="btn btn-primary" href="{0}">'.format(href))
+            w(u'<span class="glyphicon glyphicon glyphicon-stats"></span>')
+            w(u'CATI metrics</a>')
+            w(u'</div></div><br/>')
+
         # centre dashboard
         rql = ("DISTINCT Any G ORDERBY N WHERE G is CWGroup,"
                " G cwuri ILIKE '%ou=Centres%',"
@@ -0,0 +1,116 @@
+# -*- coding: utf-8 -*-
+
+# Copyright (c) 2013-2016 CEA
+#
+# This software is governed by the CeCILL license under French law and
+# abiding by the rules of distribution of free software. You can use,
+# modify and/ or redistribute the software under the terms of the CeCILL
+# license as circulated by CEA, CNRS and INRIA at the following URL
+# "http://www.cecill.info".
+#
+# As a counterpart to the access to the source code and rights to copy,
+# modify and redistribute granted by the license, users are provided only
+# with a limited warranty and the software's author, the holder of the
+# economic rights, and the successive licensors have only limited
+# liability.
+#
+# In this respect, the user's attention is drawn to the risks associated
+# with loading, using, modifying and/or developing or reproducing the
+# software by the user in light of its specific status of free software,
+# that may mean that it is complicated to manipulate, and that also
+# therefore means that it is reserved for developers and experienced
+# professionals having in-depth computer knowledge. Users are therefore
+# encouraged to load and test the software's suitability as regards their
+# requirements in conditions enabling the security of their systems and/or
+# data to be ensured and, more generally, to use and operate it in the
+# same conditions as regards security.
+#
+# The fact that you are presently reading this means that you have had
+# knowledge of the CeCILL license and that you accept its terms.
+
+# System import
+import os
+
+# CW import
+from cubicweb.predicates import match_user_groups
+from cubicweb.view import View
+from logilab.mtconverter import xml_escape
+
+# Cubes import
+from cubes.imagen_upload import cati
+
+
+class CatiMetricsView(View):
+    """ View to display the metrics of the cati workflow: latencies,
+        pending entries, rejection rates by centre and throughput by day.
+    """
+
+    __regid__ = "cati-metrics-view"
+    __select__ = match_user_groups("managers")
+    title = _("CATI metrics")
+
+    def call(self, **kwargs):
+        config = self._cw.vreg.config
+        self.w(u'<div class="panel-heading">')
+        self.w(u'<h1>{}</h1>'.format(self._cw._(self.title)))
+        self.w(u'</div>')
+        self.w(u'<div class="panel-body">')
+        directory = config["cati_workflow_directory"]
+        cati.CATI_WORFLOW_DIRECTORY = directory
+        cati.LEDGER_BACKEND = config["cati_ledger_backend"]
+        if not os.path.isfile(cati.get_done_file_path()):
+            self.w(u'<p>No cati workflow in {}.</p>'.format(
+                xml_escape(directory)))
+            self.w(u'</div>')
+            return
+        metrics = cati.get_metrics(self.centre_of)
+
+        self.w(u'<h3>Backlog</h3>')
+        self.write_table(
+            (u'Done', u'Pending', u'Waiting for a response',
+             u'Oldest pending (min)'),
+            [(metrics['done'], metrics['pending'], metrics['waiting'],
+              metrics['oldest'] if metrics['pending'] else u'')])
+        self.w(u'<h3>Latency from sending to done (min)</h3>')
+        self.write_table(
+            (u'50 %', u'90 %', u'99 %'),
+            [[metrics['latency'][p] for p in (50, 90, 99)]])
+        self.w(u'<h3>Rejections by centre</h3>')
+        self.write_table(
+            (u'Centre', u'Validated', u'Rejected', u'Rejection rate'),
+            [(centre, validated, rejected, u'{:.1%}'.format(rate))
+             for centre, (validated, rejected, rate)
+             in sorted(metrics['centres'].items())])
+        self.w(u'<h3>Done by day</h3>')
+        self.write_table((u'Day', u'Done'), reversed(metrics['days']))
+        self.w(u'</div>')
+
+    def centre_of(self, entries):
+        """ Return the centres of the uploads of a list of cati entries.
+        """
+
+        centres = {}
+        for start in range(0, len(entries), 500):
+            chunk = entries[start:start + 500]
+            rql = ("Any N, V WHERE X is CWUpload, X form_name ILIKE 'MRI',"
+                   " X upload_files F, F data_name N,"
+                   " X upload_fields UF, UF name 'centre', UF value V,"
+                   " F data_name IN ({})".format(u', '.join(
+                       u'%(n{})s'.format(i) for i in range(len(chunk)))))
+            rset = self._cw.execute(rql, dict(
+                (u'n{}'.format(i), entry) for i, entry in enumerate(chunk)))
+            centres.update((name, centre) for name, centre in rset)
+        return centres
+
+    def write_table(self, headers, rows):
+        """ Write a table with a header row.
+        """
+
+        self.w(u'<table class="upload-table">')
+        self.w(u'<tr>{}</tr>'.format(u''.join(
+            u'<th>{}</th>'.format(header) for header in headers)))
+        for row in rows:
+            self.w(u'<tr>{}</tr>'.format(u''.join(
+                u'<td>{}</td>'.format(xml_escape(u'{}'.format(
+                    u'' if value is None else value))) for value in row)))
+        self.w(u'</table>')
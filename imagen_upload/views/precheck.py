@@ -0,0 +1,74 @@
+# -*- coding: utf-8 -*-
+
+# Copyright (c) 2013-2016 CEA
+#
+# This software is governed by the CeCILL license under French law and
+# abiding by the rules of distribution of free software. You can use,
+# modify and/ or redistribute the software under the terms of the CeCILL
+# license as circulated by CEA, CNRS and INRIA at the following URL
+# "http://www.cecill.info".
+#
+# As a counterpart to the access to the source code and rights to copy,
+# modify and redistribute granted by the license, users are provided only
+# with a limited warranty and the software's author, the holder of the
+# economic rights, and the successive licensors have only limited
+# liability.
+#
+# In this respect, the user's attention is drawn to the risks associated
+# with loading, using, modifying and/or developing or reproducing the
+# software by the user in light of its specific status of free software,
+# that may mean that it is complicated to manipulate, and that also
+# therefore means that it is reserved for developers and experienced
+# professionals having in-depth computer knowledge. Users are therefore
+# encouraged to load and test the software's suitability as regards their
+# requirements in conditions enabling the security of their systems and/or
+# data to be ensured and, more generally, to use and operate it in the
+# same conditions as regards security.
+#
+# The fact that you are presently reading this means that you have had
+# knowledge of the CeCILL license and that you accept its terms.
+
+# System import
+import json
+
+# CW import
+from cubicweb.predicates import anonymous_user
+from cubicweb.web.controller import Controller
+
+# Cubes import
+from cubes.imagen_upload.checks import precheck_upload
+
+
+class UploadPrecheckController(Controller):
+    """ JSON check of a planned upload, called by the upload forms before
+        sending the files, with the subject ID, the time point, the form
+        and the SHA-1 of the files computed by the browser.
+
+        The answer tells whether a similar upload already exists and
+        lists the uploads with the same file contents.
+    """
+
+    __regid__ = "upload-precheck"
+    __select__ = ~anonymous_user()
+
+    def publish(self, rset=None):
+        form = self._cw.form
+        sha1s = form.get('sha1', [])
+        if isinstance(sha1s, basestring):
+            sha1s = [sha1s]
+        result = precheck_upload(
+            self._cw, form.get('form', u''), form.get('sid', u''),
+            form.get('time_point', u''), [sha1.lower() for sha1 in sha1s])
+        upload = result['upload']
+        self._cw.set_content_type('application/json')
+        return json.dumps({
+            'already_uploaded': upload is not None,
+            'upload': self.url(upload) if upload is not None else None,
+            'files': dict(
+                (sha1, [{'upload': self.url(eid), 'name': name,
+                         'status': status} for eid, name, status in files])
+                for sha1, files in result['files'].items()),
+        })
+
+    def url(self, eid):
+        return self._cw.entity_from_eid(eid).absolute_url()
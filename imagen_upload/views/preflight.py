@@ -0,0 +1,115 @@
+# -*- coding: utf-8 -*-
+
+# Copyright (c) 2013-2016 CEA
+#
+# This software is governed by the CeCILL license under French law and
+# abiding by the rules of distribution of free software. You can use,
+# modify and/ or redistribute the software under the terms of the CeCILL
+# license as circulated by CEA, CNRS and INRIA at the following URL
+# "http://www.cecill.info".
+#
+# As a counterpart to the access to the source code and rights to copy,
+# modify and redistribute granted by the license, users are provided only
+# with a limited warranty and the software's author, the holder of the
+# economic rights, and the successive licensors have only limited
+# liability.
+#
+# In this respect, the user's attention is drawn to the risks associated
+# with loading, using, modifying and/or developing or reproducing the
+# software by the user in light of its specific status of free software,
+# that may mean that it is complicated to manipulate, and that also
+# therefore means that it is reserved for developers and experienced
+# professionals having in-depth computer knowledge. Users are therefore
+# encouraged to load and test the software's suitability as regards their
+# requirements in conditions enabling the security of their systems and/or
+# data to be ensured and, more generally, to use and operate it in the
+# same conditions as regards security.
+#
+# The fact that you are presently reading this means that you have had
+# knowledge of the CeCILL license and that you accept its terms.
+
+# System import
+import re
+
+# CW import
+from cubicweb.predicates import anonymous_user
+from cubicweb.view import View
+from logilab.mtconverter import xml_escape
+
+# Cubes import
+from cubes.imagen_upload.checks import preflight_manifest
+
+
+class PreflightView(View):
+    """ View to validate a manifest of planned uploads, one
+        'sid;time_point;form' row per upload, and display a per-row report.
+    """
+
+    __regid__ = "preflight-view"
+    __select__ = ~anonymous_user()
+    title = _("Pre-flight check")
+
+    def call(self, **kwargs):
+        # get the manifest, pasted or uploaded
+        manifest = self._cw.form.get('manifest', u'')
+        upload = self._cw.form.get('manifest_file')
+        if upload and not isinstance(upload, basestring):
+            manifest = upload[1].read().decode('utf-8', 'replace')
+
+        # write title and form
+        self.w(u'<div class="panel-heading">')
+        self.w(u'<h1>{}</h1>'.format(self._cw._(self.title)))
+        self.w(u'</div>')
+        self.w(u'<div class="panel-body">')
+        self.w(u'<form method="post" enctype="multipart/form-data"'
+               u' action="{}">'.format(
+                   xml_escape(self._cw.build_url('view', vid=self.__regid__))))
+        self.w(u'<p>One upload per line: subject ID, time point and form'
+               u' (Cantab or MRI), separated by commas or semicolons.</p>')
+        self.w(u'<textarea name="manifest" rows="10" cols="60">{}'
+               u'</textarea><br/>'.format(xml_escape(manifest)))
+        self.w(u'<input type="file" name="manifest_file"/><br/>')
+        self.w(u'<input class="btn btn-primary" type="submit"'
+               u' value="Check"/>')
+        self.w(u'</form>')
+
+        rows = self.parse_manifest(manifest)
+        if rows:
+            self.write_report(preflight_manifest(self._cw, rows))
+        self.w(u'</div>')
+
+    def parse_manifest(self, manifest):
+        """ Return the (sid, time_point, form) tuples of a CSV manifest,
+            skipping empty lines and an optional header line.
+        """
+
+        rows = []
+        for line in manifest.splitlines():
+            cells = [cell.strip() for cell in re.split(u'[,;\t]', line)]
+            if not any(cells):
+                continue
+            cells += [u''] * (3 - len(cells))
+            if not rows and cells[0].lower() == u'sid':
+                continue
+            rows.append(tuple(cells[:3]))
+        return rows
+
+    def write_report(self, report):
+        """ Write one table row per manifest row with its errors.
+        """
+
+        self.w(u'<table class="upload-table">')
+        self.w(u'<tr><th>Subject ID</th><th>Time Point</th><th>Form</th>'
+               u'<th>Report</th></tr>')
+        for sid, tid, formname, errors in report:
+            if errors:
+                color = '#800000'
+                status = u'<br/>'.join(xml_escape(e) for e in errors)
+            else:
+                color = '#008080'
+                status = u'OK'
+            self.w(u'<tr><td>{}</td><td>{}</td><td>{}</td>'
+                   u"<td style='color:{}'>{}</td></tr>".format(
+                       xml_escape(sid), xml_escape(tid), xml_escape(formname),
+                       color, status))
+        self.w(u'</table>')
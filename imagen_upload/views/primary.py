@@ -34,6 +34,7 @@
 from cubicweb.web.views.primary import PrimaryView
 from cubicweb.predicates import is_instance
 from cubes.rql_upload.views.primary import CWUploadPrimaryView
+from cubes.imagen_upload.errors import render as render_error
 
 
 class Imagen_CWUploadPrimaryView(PrimaryView):
@@ -63,7 +64,7 @@ class Imagen_CWUploadPrimaryView(PrimaryView):
         print('error: {}'.format(eUpload.error))
         if eUpload.error:
             self.w(u'<div class="panel panel-danger">{}</div>'.format(
-                eUpload.error))
+                render_error(eUpload.error)))
         self.w(u'</div>')
 
         self.w(u'<div>')
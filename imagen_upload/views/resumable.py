@@ -0,0 +1,313 @@
+# -*- coding: utf-8 -*-
+
+# Copyright (c) 2013-2016 CEA
+#
+# This software is governed by the CeCILL license under French law and
+# abiding by the rules of distribution of free software. You can use,
+# modify and/ or redistribute the software under the terms of the CeCILL
+# license as circulated by CEA, CNRS and INRIA at the following URL
+# "http://www.cecill.info".
+#
+# As a counterpart to the access to the source code and rights to copy,
+# modify and redistribute granted by the license, users are provided only
+# with a limited warranty and the software's author, the holder of the
+# economic rights, and the successive licensors have only limited
+# liability.
+#
+# In this respect, the user's attention is drawn to the risks associated
+# with loading, using, modifying and/or developing or reproducing the
+# software by the user in light of its specific status of free software,
+# that may mean that it is complicated to manipulate, and that also
+# therefore means that it is reserved for developers and experienced
+# professionals having in-depth computer knowledge. Users are therefore
+# encouraged to load and test the software's suitability as regards their
+# requirements in conditions enabling the security of their systems and/or
+# data to be ensured and, more generally, to use and operate it in the
+# same conditions as regards security.
+#
+# The fact that you are presently reading this means that you have had
+# knowledge of the CeCILL license and that you accept its terms.
+
+# System import
+import base64
+import re
+
+# CW import
+from logilab.mtconverter import xml_escape
+from cubicweb import Binary
+from cubicweb.predicates import anonymous_user
+from cubicweb.web.controller import Controller
+
+# Cubes import
+from cubes.rql_upload.tools import get_or_create_logger
+from cubes.imagen_upload import resumable
+from cubes.imagen_upload.checks import (get_form_fields,
+                                        synchrone_check_cantab,
+                                        synchrone_check_rmi)
+
+TUS_VERSION = '1.0.0'
+# form names of the uploads by lower case form name, with their check
+FORMS = {
+    u'mri': (u'MRI', synchrone_check_rmi),
+    u'cantab': (u'Cantab', synchrone_check_cantab),
+}
+# metadata of the uploads which are not upload fields
+FILE_METADATA = ('filename', 'form', 'field', 'batch', 'files')
+
+
+class ResumableUploadController(Controller):
+    """ Resumable upload of the files of the MRI and Cantab forms, following
+        the core protocol and the creation extension of tus 1.0.0:
+
+        - POST creates an upload, of Upload-Length bytes, described by the
+          Upload-Metadata header ('key base64(value)' pairs separated by
+          commas) and returns its URL in the Location header,
+        - HEAD returns the offset from which the upload must be resumed,
+        - PATCH appends the body to the upload at Upload-Offset.
+
+        The metadata give the file name, the form ('MRI' or 'Cantab'), the
+        file field, the batch of the files of a form submission with its
+        number of files, and the form fields. The form fields are checked
+        against the definition of the form when an upload is created. Once
+        all the files of a batch are complete, the form fields are checked
+        again, and the CWUpload is created and checked by the synchronous
+        check of its form.
+
+        An empty PATCH at the end of a complete upload hands its batch off
+        again, so that a hand off which failed can be retried.
+    """
+
+    __regid__ = "resumable-upload"
+    __select__ = ~anonymous_user()
+
+    def publish(self, rset=None):
+        config = self._cw.vreg.config
+        resumable.LOGGER = get_or_create_logger(config)
+        resumable.DIRECTORY = config["resumable_upload_directory"]
+        resumable.MAX_SIZE = config["resumable_upload_max_size"] * 1024 ** 2
+        self._cw.set_header('Tus-Resumable', TUS_VERSION)
+        if not resumable.DIRECTORY:
+            return self.respond(404, u'resumable uploads are disabled')
+        method = self._cw.http_method()
+        try:
+            if method == 'OPTIONS':
+                self._cw.set_header('Tus-Version', TUS_VERSION)
+                self._cw.set_header('Tus-Extension', 'creation')
+                if resumable.MAX_SIZE:
+                    self._cw.set_header('Tus-Max-Size', resumable.MAX_SIZE)
+                return self.respond(204)
+            if method == 'POST':
+                return self.create()
+            uid = self._cw.form.get('id')
+            if method == 'HEAD':
+                info = resumable.get_info(uid, self._cw.user.login)
+                self._cw.set_header('Upload-Offset', info['offset'])
+                self._cw.set_header('Upload-Length', info['length'])
+                self._cw.set_header('Cache-Control', 'no-store')
+                return self.respond(200)
+            if method == 'PATCH':
+                return self.append(uid)
+        except resumable.ResumableError as e:
+            return self.respond(e.status, unicode(e))
+        except (TypeError, ValueError) as e:
+            return self.respond(400, unicode(e))
+        return self.respond(405)
+
+    def respond(self, status, message=u''):
+        self._cw.status_out = status
+        return message.encode('utf-8')
+
+    def create(self):
+        length = int(self._cw.get_header('Upload-Length'))
+        metadata = {}
+        for pair in (self._cw.get_header('Upload-Metadata') or '').split(','):
+            if pair.strip():
+                key, _, value = pair.strip().partition(' ')
+                metadata[key] = base64.b64decode(value).decode('utf-8')
+        if metadata.get('form', u'').lower() not in FORMS:
+            raise ValueError(u'unknown form')
+        for key in ('filename', 'field', 'batch', 'files'):
+            if not metadata.get(key):
+                raise ValueError(u'{} metadata missing'.format(key))
+        form_name = FORMS[metadata['form'].lower()][0]
+        definition = get_form_fields(form_name).get(metadata['field'])
+        if definition is None or definition['type'] != 'FileField':
+            raise ValueError(u'unknown file field')
+        if int(metadata['files']) < 1:
+            raise ValueError(u'files metadata must be positive')
+        # refuse the files of a form which cannot be handed off
+        posted, errors = self.validate_fields(form_name, metadata)
+        if errors:
+            raise ValueError(u'; '.join(errors))
+        uid = resumable.create(length, metadata, self._cw.user.login)
+        self._cw.set_header('Location', self._cw.build_url(
+            self.__regid__, id=uid))
+        return self.respond(201)
+
+    def append(self, uid):
+        if (self._cw.get_header('Content-Type') !=
+                'application/offset+octet-stream'):
+            return self.respond(415)
+        offset = int(self._cw.get_header('Upload-Offset'))
+        info = resumable.append(uid, offset, self._cw.content,
+                                self._cw.user.login)
+        self._cw.set_header('Upload-Offset', info['offset'])
+        if info['path'] is not None:
+            error = self.hand_off(info['metadata'])
+            if error is not None:
+                return self.respond(422, error)
+        return self.respond(204)
+
+    def hand_off(self, metadata):
+        """ Create and check the CWUpload of a batch once all its files are
+            complete. Concurrent requests completing the files of a batch
+            hand it off once.
+
+        Return:
+            Return None if checks pass or the batch is not complete, error
+            message otherwise.
+        """
+
+        login = self._cw.user.login
+        with resumable.claim_batch(metadata['batch'], login) as claimed:
+            # the batch is being handed off by a concurrent request
+            if not claimed:
+                return None
+            uploads = resumable.get_batch(metadata['batch'], login)
+            if len(uploads) < int(metadata['files']):
+                return None
+            error = self.create_upload(metadata['form'], uploads)
+            if error is not None:
+                for uid, info in uploads:
+                    resumable.remove(uid)
+        return error
+
+    def create_upload(self, form, uploads):
+        """ Create, check and commit the CWUpload of the complete uploads of
+            a batch.
+
+        Return:
+            Return None if checks pass, error message otherwise.
+        """
+
+        form_name, check = FORMS[form.lower()]
+        metadatas = [info['metadata'] for uid, info in uploads]
+        posted, errors = self.validate_fields(form_name, metadatas[0])
+        errors += self.validate_files(form_name, metadatas)
+        if errors:
+            return xml_escape(u'; '.join(errors))
+        # the complete files are used in place by the file system storage
+        self._cw.transaction_data['fs_importing'] = True
+        files = [
+            self._cw.create_entity(
+                'UploadFile', name=info['metadata']['field'],
+                data=Binary(info['path'].encode('utf-8')),
+                data_name=info['metadata']['filename'],
+                data_sha1hex=info['sha1'])
+            for uid, info in uploads]
+        fields = [
+            self._cw.create_entity('UploadField', name=key,
+                                   value=unicode(value))
+            for key, value in posted.items()]
+        upload = self._cw.create_entity(
+            'CWUpload', form_name=form_name, status=u'Quarantine',
+            upload_files=files, upload_fields=fields)
+        error = check(self._cw, posted, upload, files, fields)
+        if error is not None:
+            self._cw.cnx.rollback()
+            return error
+        # once committed, the files belong to the UploadFile entities
+        for uid, info in uploads:
+            resumable.set_handed_off(uid)
+        try:
+            self._cw.cnx.commit()
+        except Exception:
+            for uid, info in uploads:
+                resumable.set_handed_off(uid, False)
+            raise
+        for uid, info in uploads:
+            resumable.remove(uid, keep_file=True)
+        self._cw.set_header('Location', upload.absolute_url())
+        return None
+
+    def validate_fields(self, form_name, metadata):
+        """ Check the form fields given in the metadata of an upload against
+            the definition of the form, as the upload form does: required
+            fields, maximum length, choices and dates. Unknown fields are
+            ignored.
+
+        Return:
+            Return the dictionnary of the posted fields, with the value of
+            the date fields converted to dates, and the list of the error
+            messages.
+        """
+
+        posted = {}
+        errors = []
+        for name, definition in sorted(get_form_fields(form_name).items()):
+            if definition['type'] == 'FileField':
+                continue
+            label = definition.get('label', name).strip() or name
+            value = metadata.get(name, definition.get('value', u''))
+            if not value:
+                if definition.get('required') == 'True':
+                    errors.append(u'{}: required'.format(label))
+                posted[name] = value
+                continue
+            max_length = definition.get('max_length')
+            if max_length and len(value) > max_length:
+                errors.append(u'{}: longer than {} characters'.format(
+                    label, max_length))
+                continue
+            choices = self.choices(definition)
+            if choices is not None and value not in choices:
+                errors.append(u'{}: unknown value {}'.format(label, value))
+                continue
+            if definition['type'] == 'DateField':
+                try:
+                    value = self._cw.parse_datetime(value, 'Date')
+                except ValueError:
+                    errors.append(u'{}: invalid date {}'.format(label, value))
+                    continue
+            posted[name] = value
+        return posted, errors
+
+    def validate_files(self, form_name, metadatas):
+        """ Check the files of a batch against the file fields of its form,
+            and that its uploads give the same form fields.
+
+        Return:
+            Return the list of the error messages.
+        """
+
+        errors = []
+        fields = [metadata['field'] for metadata in metadatas]
+        for name, definition in sorted(get_form_fields(form_name).items()):
+            if definition['type'] != 'FileField':
+                continue
+            label = definition.get('label', name)
+            if fields.count(name) > 1:
+                errors.append(u'{}: several files'.format(label))
+            elif name not in fields and definition.get('required') == 'True':
+                errors.append(u'{}: required'.format(label))
+        posted = [
+            dict((key, value) for key, value in metadata.items()
+                 if key not in FILE_METADATA)
+            for metadata in metadatas]
+        if any(other != posted[0] for other in posted[1:]):
+            errors.append(u'the files of the batch give different fields')
+        return errors
+
+    def choices(self, definition):
+        """ Return the allowed values of a field, None if any value is
+            allowed. The choices given by a RQL query, such as the centres
+            of the user, are selected for the current user.
+        """
+
+        if 'rql' in definition:
+            # strip the ':choices' suffix and use the login as argument
+            rql = re.sub(r':\w+$', '', definition['rql'])
+            rql = rql.replace("'{}'", '%(login)s')
+            rset = self._cw.execute(rql, {'login': self._cw.user.login})
+            return [row[0] for row in rset]
+        return definition.get('choices')
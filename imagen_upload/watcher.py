@@ -0,0 +1,211 @@
+# -*- coding: utf-8 -*-
+
+# Copyright (c) 2019 CEA
+#
+# This software is governed by the CeCILL license under French law and
+# abiding by the rules of distribution of free software. You can use,
+# modify and/ or redistribute the software under the terms of the CeCILL
+# license as circulated by CEA, CNRS and INRIA at the following URL
+# "http://www.cecill.info".
+#
+# As a counterpart to the access to the source code and rights to copy,
+# modify and redistribute granted by the license, users are provided only
+# with a limited warranty and the software's author, the holder of the
+# economic rights, and the successive licensors have only limited
+# liability.
+#
+# In this respect, the user's attention is drawn to the risks associated
+# with loading, using, modifying and/or developing or reproducing the
+# software by the user in light of its specific status of free software,
+# that may mean that it is complicated to manipulate, and that also
+# therefore means that it is reserved for developers and experienced
+# professionals having in-depth computer knowledge. Users are therefore
+# encouraged to load and test the software's suitability as regards their
+# requirements in conditions enabling the security of their systems and/or
+# data to be ensured and, more generally, to use and operate it in the
+# same conditions as regards security.
+#
+# The fact that you are presently reading this means that you have had
+# knowledge of the CeCILL license and that you accept its terms.
+
+
+
+""" Watch a file of a directory and call a function when it changes.
+
+inotify is used on Linux, through ctypes. Elsewhere, or when inotify is not
+available, the file signature (inode, size, mtime) is polled. A file whose
+signature changed may also be parsed, so that a file rewritten with the
+same content does not trigger a call.
+"""
+
+import ctypes
+import ctypes.util
+import errno
+import os
+import select
+import struct
+import threading
+import time
+
+LOGGER = None
+
+IN_MODIFY = 0x00000002
+IN_CLOSE_WRITE = 0x00000008
+IN_MOVED_TO = 0x00000080
+IN_CREATE = 0x00000100
+IN_Q_OVERFLOW = 0x00004000
+IN_NONBLOCK = 0x00000800
+IN_CLOEXEC = 0x00080000
+EVENT_HEADER = struct.Struct('iIII')
+
+
+##############################################################################
+def _inotify_fd(directory):
+    """ Return an inotify file descriptor watching a directory, None if
+        inotify is not available.
+    """
+
+    name = ctypes.util.find_library('c')
+    if not name:
+        return None
+    libc = ctypes.CDLL(name, use_errno=True)
+    if not hasattr(libc, 'inotify_init1'):
+        return None
+    fd = libc.inotify_init1(IN_NONBLOCK | IN_CLOEXEC)
+    if fd < 0:
+        return None
+    mask = IN_MODIFY | IN_CLOSE_WRITE | IN_MOVED_TO | IN_CREATE
+    path = directory.encode('utf-8') if not isinstance(directory,
+                                                       bytes) else directory
+    if libc.inotify_add_watch(fd, path, mask) < 0:
+        os.close(fd)
+        return None
+    return fd
+
+
+def _event_names(data):
+    """ Names of the files in a buffer of inotify events, None for a queue
+        overflow.
+    """
+
+    names = []
+    offset = 0
+    while offset + EVENT_HEADER.size <= len(data):
+        wd, mask, cookie, length = EVENT_HEADER.unpack_from(data, offset)
+        offset += EVENT_HEADER.size
+        name = data[offset:offset + length].rstrip(b'\0')
+        offset += length
+        names.append(None if mask & IN_Q_OVERFLOW else name.decode('utf-8'))
+    return names
+
+
+def _signature(path):
+    try:
+        stat = os.stat(path)
+    except OSError:
+        return None
+    return (stat.st_ino, stat.st_size, stat.st_mtime)
+
+
+##############################################################################
+class FileWatcher(threading.Thread):
+    """ Thread calling callback() shortly after a file has changed.
+
+    Parameters:
+        directory: the directory of the watched file
+        filename: the name of the watched file
+        callback: function called without argument, exceptions are logged
+        poll_interval: seconds between two checks of the file when inotify
+                       is not available, also the maximum delay before
+                       noticing a change missed by inotify
+        delay: seconds without change to wait before calling callback, so
+               that a burst of writes triggers a single call
+        parse: function called with the path of the file once its
+               signature changed, returning the content compared to the
+               content at the last call, by default the signature itself
+    """
+
+    def __init__(self, directory, filename, callback, poll_interval=10,
+                 delay=1.0, parse=None):
+        super(FileWatcher, self).__init__(name='watcher:' + filename)
+        self.daemon = True
+        self.directory = directory
+        self.filename = filename
+        self.callback = callback
+        self.poll_interval = poll_interval
+        self.delay = delay
+        self.parse = parse
+        self.stopped = threading.Event()
+
+    def stop(self):
+        self.stopped.set()
+
+    def run(self):
+        path = os.path.join(self.directory, self.filename)
+        signature = _signature(path)
+        content = self._parse(path, signature)
+        fd = _inotify_fd(self.directory)
+        if LOGGER:
+            LOGGER.info("watching {} {}".format(
+                path, "with inotify" if fd is not None else "by polling"))
+        try:
+            while not self.stopped.is_set():
+                changed = self._wait(fd, self.poll_interval)
+                # wait for the end of a burst of writes
+                while changed and self._wait(fd, self.delay):
+                    pass
+                current = _signature(path)
+                if current == signature or self.stopped.is_set():
+                    continue
+                signature = current
+                current = self._parse(path, signature)
+                if current != content:
+                    content = current
+                    self._call()
+        finally:
+            if fd is not None:
+                os.close(fd)
+
+    def _parse(self, path, signature):
+        """ Content of the file compared to decide whether it changed. """
+
+        if self.parse is None or signature is None:
+            return signature
+        try:
+            return self.parse(path)
+        except (IOError, OSError):
+            return None
+
+    def _wait(self, fd, timeout):
+        """ Wait for a change of the file, return whether it changed. """
+
+        if fd is None:
+            self.stopped.wait(timeout)
+            return False
+        try:
+            ready = select.select([fd], [], [], timeout)[0]
+        except select.error as e:
+            if e.args[0] == errno.EINTR:
+                return False
+            raise
+        if not ready:
+            return False
+        try:
+            data = os.read(fd, 65536)
+        except OSError as e:
+            if e.errno == errno.EAGAIN:
+                return False
+            raise
+        names = _event_names(data)
+        return None in names or self.filename in names
+
+    def _call(self):
+        start = time.time()
+        try:
+            self.callback()
+        except Exception:
+            if LOGGER:
+                LOGGER.exception("{} watcher failed".format(self.filename))
+        if LOGGER:
+            LOGGER.info("{} change processed in {:.1f}s".format(
+                self.filename, time.time() - start))